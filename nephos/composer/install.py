@@ -1,12 +1,9 @@
-from kubernetes.client.rest import ApiException
-
-
 from nephos.composer.connection_template import json_ct
 from nephos.fabric.crypto import admin_creds
 from nephos.fabric.utils import get_pod
 from nephos.fabric.settings import get_namespace
 from nephos.helpers.helm import helm_install, helm_upgrade
-from nephos.helpers.k8s import get_app_info, cm_create, cm_read, ingress_read, secret_from_file
+from nephos.helpers.k8s import get_app_info, cm_upsert, ingress_read, nephos_labels, secret_from_file
 
 
 def get_composer_data(opts, verbose=False):
@@ -25,33 +22,32 @@ def composer_connection(opts, verbose=False):
     peer_ca_msp = opts['cas'][peer_ca]['msp']
     ingress_urls = ingress_read(peer_ca + '-hlf-ca', namespace=peer_namespace, verbose=verbose)
     peer_ca_url = ingress_urls[0]
-    try:
-        cm_read(opts['composer']['secret_connection'], peer_namespace, verbose=verbose)
-    except ApiException:
-        # Set up connection.json
-        # TODO: Improve json_ct to work directly with opts structure
-        cm_data = {'connection.json': json_ct(
-            opts['peers']['names'],
-            opts['orderers']['names'],
-            [peer + '-hlf-peer.{ns}.svc.cluster.local'.format(ns=peer_namespace) for peer in
-             opts['peers']['names']],
-            [orderer + '-hlf-ord.{ns}.svc.cluster.local'.format(ns=ord_namespace) for orderer in
-             opts['orderers']['names']],
-            peer_ca,
-            peer_ca_url,
-            'AidTech',
-            None,
-            peer_ca_msp,
-            opts['peers']['channel_name']
-        )}
-        cm_create(peer_namespace, opts['composer']['secret_connection'], cm_data)
+    # Set up connection.json
+    # TODO: Improve json_ct to work directly with opts structure
+    cm_data = {'connection.json': json_ct(
+        opts['peers']['names'],
+        opts['orderers']['names'],
+        [peer + '-hlf-peer.{ns}.svc.cluster.local'.format(ns=peer_namespace) for peer in
+         opts['peers']['names']],
+        [orderer + '-hlf-ord.{ns}.svc.cluster.local'.format(ns=ord_namespace) for orderer in
+         opts['orderers']['names']],
+        peer_ca,
+        peer_ca_url,
+        'AidTech',
+        None,
+        peer_ca_msp,
+        opts['peers']['channel_name']
+    )}
+    # Only written if it is missing or its content has changed
+    cm_upsert(cm_data, opts['composer']['secret_connection'], peer_namespace,
+              labels=nephos_labels(msp=opts['peers']['msp'], type='connection'), verbose=verbose)
 
 
 def deploy_composer(opts, upgrade=False, verbose=False):
     peer_namespace = get_namespace(opts, opts['peers']['msp'])
     # Ensure BNA exists
     secret_from_file(secret=opts['composer']['secret_bna'], namespace=peer_namespace,
-                     verbose=verbose)
+                     labels=nephos_labels(msp=opts['peers']['msp'], type='bna'), verbose=verbose)
     composer_connection(opts, verbose=verbose)
 
     # Start Composer
@@ -74,16 +70,20 @@ def setup_admin(opts, verbose=False):
     ls_res = hlc_cli_ex.execute('composer card list --card PeerAdmin@hlfv1')
 
     if not ls_res:
-        hlc_cli_ex.execute(
+        # Create and import the card in a single exec session, where the import may succeed even if the creation
+        # fails (e.g. on a card file left by an interrupted run)
+        results = hlc_cli_ex.batch([
             ('composer card create ' +
              '-p /hl_config/hlc-connection/connection.json ' +
              '-u PeerAdmin -c /hl_config/admin/signcerts/cert.pem ' +
              '-k /hl_config/admin/keystore/key.pem ' +
              ' -r PeerAdmin -r ChannelAdmin ' +
-             '--file /home/composer/PeerAdmin@hlfv1'))
-        hlc_cli_ex.execute(
-            'composer card import ' +
-            '--file /home/composer/PeerAdmin@hlfv1.card')
+             '--file /home/composer/PeerAdmin@hlfv1'),
+            ('composer card import ' +
+             '--file /home/composer/PeerAdmin@hlfv1.card')
+        ], stop_on_error=False)
+        if not results or results[-1].exit_code != 0:
+            raise ValueError('Could not import the PeerAdmin card')
 
 
 def install_network(opts, verbose=False):
@@ -100,22 +100,28 @@ def install_network(opts, verbose=False):
     admin_creds(opts['cas'][peer_ca], peer_namespace, verbose=verbose)
     bna_pw = opts['cas'][peer_ca]['org_adminpw']
 
-    ls_res = hlc_cli_ex.execute('composer card list --card {bna_admin}@{bna_name}'.format(
-            bna_admin=bna_admin, bna_name=bna_name))
+    ping = 'composer network ping --card {bna_admin}@{bna_name}'.format(bna_admin=bna_admin, bna_name=bna_name)
+    # If the admin card exists, the network is already installed, and we only ping it
+    results = hlc_cli_ex.batch([
+        'composer card list --card {bna_admin}@{bna_name}'.format(bna_admin=bna_admin, bna_name=bna_name),
+        ping
+    ])
 
-    if not ls_res:
-        hlc_cli_ex.execute(
+    if results[0].exit_code != 0:
+        # Every step runs, since an interrupted run may have done some (e.g. install fails on an installed network)
+        results = hlc_cli_ex.batch([
             ('composer network install --card PeerAdmin@hlfv1 ' +
-             '--archiveFile /hl_config/blockchain_network/{bna}').format(bna=bna))
-        hlc_cli_ex.execute(
+             '--archiveFile /hl_config/blockchain_network/{bna}').format(bna=bna),
             ('composer network start ' +
              '--card PeerAdmin@hlfv1 ' +
              '--networkName {bna_name} --networkVersion {bna_version} ' +
              '--networkAdmin {bna_admin} --networkAdminEnrollSecret {bna_pw}').format(
                 bna_name=bna_name, bna_version=bna_version, bna_admin=bna_admin, bna_pw=bna_pw
-            ))
-        hlc_cli_ex.execute('composer card import --file {bna_admin}@{bna_name}.card'.format(
-                bna_admin=bna_admin, bna_name=bna_name))
-
-    hlc_cli_ex.execute('composer network ping --card {bna_admin}@{bna_name}'.format(
-        bna_admin=bna_admin, bna_name=bna_name))
+            ),
+            'composer card import --file {bna_admin}@{bna_name}.card'.format(
+                bna_admin=bna_admin, bna_name=bna_name),
+            ping
+        ], stop_on_error=False)
+    # Batches report failed commands without raising, so we check that the network answers in the end
+    if not results or results[-1].exit_code != 0:
+        raise ValueError('Composer network {} does not answer to ping'.format(bna_name))
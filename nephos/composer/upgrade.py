@@ -4,7 +4,7 @@ import os
 
 import click
 
-from nephos.fabric.settings import get_namespace, load_config
+from nephos.fabric.settings import get_namespace, load_config, org_opts, peer_orgs
 from nephos.fabric.utils import get_pod
 from nephos.helpers.k8s import ns_create
 
@@ -45,7 +45,8 @@ def upgrade_network(opts, verbose=False):
 @click.option('--verbose/--quiet', '-v/-q', default=False)
 def main(settings_file, verbose=False):  # pragma: no cover
     opts = load_config(settings_file)
-    upgrade_network(opts, verbose=verbose)
+    # Composer runs with the first peer organisation
+    upgrade_network(org_opts(opts, peer_orgs(opts)[0]), verbose=verbose)
 
 
 if __name__ == "__main__":  # pragma: no cover
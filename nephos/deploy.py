@@ -1,17 +1,23 @@
 #! /usr/bin/env python
 from __future__ import print_function
 
+from functools import partial
 import json
 
 import click
 from blessings import Terminal
 
-from nephos.helpers.k8s import ns_create
-from nephos.fabric.settings import load_config
+from nephos.fabric.settings import load_config, org_opts, parse_config, peer_orgs
 from nephos.fabric.ca import setup_ca
-from nephos.fabric.crypto import admin_msp, genesis_block, channel_tx, setup_nodes
+from nephos.fabric.crypto import admin_msps, genesis_block, channel_tx, setup_nodes
 from nephos.fabric.ord import setup_ord
 from nephos.fabric.peer import setup_peer, setup_channel
+from nephos.fabric.plan import apply_plan, gather_state, plan_actions, plan_read, plan_write, print_plan
+from nephos.fabric.reconcile import RESYNC, Reconciler
+from nephos.fabric.scale import scale_orderers, scale_peers
+from nephos.fabric.status import gather_status, print_status
+from nephos.fabric.utils import org_pipeline, setup_namespaces
+from nephos.helpers.throttle import print_throttle_metrics
 from nephos.composer.install import deploy_composer, install_network, setup_admin
 
 
@@ -30,12 +36,26 @@ def cli(ctx, settings_file, upgrade, verbose):
     ctx.obj['settings_file'] = settings_file
     ctx.obj['upgrade'] = upgrade
     ctx.obj['verbose'] = verbose
+    if verbose:
+        # Report how long requests were held back by the rate limiters
+        ctx.call_on_close(print_throttle_metrics)
+
+
+@cli.command(help=TERM.cyan('Carry out the actions saved by "plan"'))
+@click.option('--plan_file', '-p', required=True,
+              help=TERM.cyan('JSON file of actions, saved by "plan"'))
+@click.pass_context
+def apply(ctx, plan_file):  # pragma: no cover
+    opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
+    apply_plan(opts, plan_read(plan_file), verbose=ctx.obj['verbose'])
 
 
 @cli.command(help=TERM.cyan('Install Hyperledger Fabric Certificate Authorities'))
 @click.pass_context
 def ca(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
     setup_ca(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
 
 
@@ -43,24 +63,28 @@ def ca(ctx):  # pragma: no cover
 @click.pass_context
 def composer(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
-    deploy_composer(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    setup_admin(opts, verbose=ctx.obj['verbose'])
-    install_network(opts, verbose=ctx.obj['verbose'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
+    # Composer runs with the first peer organisation
+    composer_opts = org_opts(opts, peer_orgs(opts)[0])
+    deploy_composer(composer_opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
+    setup_admin(composer_opts, verbose=ctx.obj['verbose'])
+    install_network(composer_opts, verbose=ctx.obj['verbose'])
 
 
 @cli.command(help=TERM.cyan('Obtain cryptographic materials from CAs'))
 @click.pass_context
 def crypto(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
     # Set up Admin MSPs
-    admin_msp(opts, opts['orderers']['msp'], verbose=ctx.obj['verbose'])
-    admin_msp(opts, opts['peers']['msp'], verbose=ctx.obj['verbose'])
-    # Genesis & Channel
+    admin_msps(opts, [opts['orderers']['msp']] + [org['msp'] for org in peer_orgs(opts)], verbose=ctx.obj['verbose'])
+    # Genesis
     genesis_block(opts, verbose=ctx.obj['verbose'])
-    channel_tx(opts, verbose=ctx.obj['verbose'])
     # Setup node MSPs
     setup_nodes(opts, 'orderer', verbose=ctx.obj['verbose'])
-    setup_nodes(opts, 'peer', verbose=ctx.obj['verbose'])
+    # Channel & peer MSPs, for each organisation concurrently
+    org_pipeline(opts, [partial(channel_tx, verbose=ctx.obj['verbose']),
+                        partial(setup_nodes, node_type='peer', verbose=ctx.obj['verbose'])])
 
 
 # TODO: Can we compose several CLI commands here to avoid copied code?
@@ -68,50 +92,52 @@ def crypto(ctx):  # pragma: no cover
 @click.pass_context
 def deploy(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
     # Setup CA
     setup_ca(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
     # Crypto material
-    admin_msp(opts, opts['orderers']['msp'], verbose=ctx.obj['verbose'])
-    admin_msp(opts, opts['peers']['msp'], verbose=ctx.obj['verbose'])
+    admin_msps(opts, [opts['orderers']['msp']] + [org['msp'] for org in peer_orgs(opts)], verbose=ctx.obj['verbose'])
     genesis_block(opts, verbose=ctx.obj['verbose'])
-    channel_tx(opts, verbose=ctx.obj['verbose'])
     setup_nodes(opts, 'orderer', verbose=ctx.obj['verbose'])
-    setup_nodes(opts, 'peer', verbose=ctx.obj['verbose'])
     # Orderers
     setup_ord(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    # Peers
-    setup_peer(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    setup_channel(opts, verbose=ctx.obj['verbose'])
-    # Composer
-    deploy_composer(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    setup_admin(opts, verbose=ctx.obj['verbose'])
-    install_network(opts, verbose=ctx.obj['verbose'])
+    # Peer organisations, each running its crypto -> peers -> channel pipeline concurrently
+    org_pipeline(opts, [partial(channel_tx, verbose=ctx.obj['verbose']),
+                        partial(setup_nodes, node_type='peer', verbose=ctx.obj['verbose']),
+                        partial(setup_peer, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose']),
+                        partial(setup_channel, verbose=ctx.obj['verbose'])])
+    # Composer, with the first peer organisation
+    composer_opts = org_opts(opts, peer_orgs(opts)[0])
+    deploy_composer(composer_opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
+    setup_admin(composer_opts, verbose=ctx.obj['verbose'])
+    install_network(composer_opts, verbose=ctx.obj['verbose'])
 
 
 @cli.command(help=TERM.cyan('Install end-to-end Hyperledger Fabric network'))
 @click.pass_context
 def fabric(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
     # Setup CA
     setup_ca(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
     # Crypto material
-    admin_msp(opts, opts['orderers']['msp'], verbose=ctx.obj['verbose'])
-    admin_msp(opts, opts['peers']['msp'], verbose=ctx.obj['verbose'])
+    admin_msps(opts, [opts['orderers']['msp']] + [org['msp'] for org in peer_orgs(opts)], verbose=ctx.obj['verbose'])
     genesis_block(opts, verbose=ctx.obj['verbose'])
-    channel_tx(opts, verbose=ctx.obj['verbose'])
     setup_nodes(opts, 'orderer', verbose=ctx.obj['verbose'])
-    setup_nodes(opts, 'peer', verbose=ctx.obj['verbose'])
     # Orderers
     setup_ord(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    # Peers
-    setup_peer(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    setup_channel(opts, verbose=ctx.obj['verbose'])
+    # Peer organisations, each running its crypto -> peers -> channel pipeline concurrently
+    org_pipeline(opts, [partial(channel_tx, verbose=ctx.obj['verbose']),
+                        partial(setup_nodes, node_type='peer', verbose=ctx.obj['verbose']),
+                        partial(setup_peer, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose']),
+                        partial(setup_channel, verbose=ctx.obj['verbose'])])
 
 
 @cli.command(help=TERM.cyan('Install Hyperledger Fabric Orderers'))
 @click.pass_context
 def orderer(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
     setup_ord(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
 
 
@@ -119,8 +145,47 @@ def orderer(ctx):  # pragma: no cover
 @click.pass_context
 def peer(ctx):  # pragma: no cover
     opts = load_config(ctx.obj['settings_file'])
-    setup_peer(opts, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose'])
-    setup_channel(opts, verbose=ctx.obj['verbose'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
+    org_pipeline(opts, [partial(setup_peer, upgrade=ctx.obj['upgrade'], verbose=ctx.obj['verbose']),
+                        partial(setup_channel, verbose=ctx.obj['verbose'])])
+
+
+@cli.command(help=TERM.cyan('Show what a deployment would change, without changing anything'))
+@click.option('--plan_file', '-p', default=None,
+              help=TERM.cyan('JSON file to save the actions to, so that "apply" carries out exactly those'))
+@click.pass_context
+def plan(ctx, plan_file):  # pragma: no cover
+    opts = load_config(ctx.obj['settings_file'])
+    _, topology = parse_config(ctx.obj['settings_file'])
+    actions = plan_actions(opts, topology, gather_state(opts, topology, verbose=ctx.obj['verbose']))
+    print_plan(actions)
+    if plan_file:
+        plan_write(actions, plan_file)
+
+
+@cli.command(help=TERM.cyan('Repair any drift between the settings and the cluster'))
+@click.option('--watch', '-w', is_flag=True, default=False,
+              help=TERM.cyan('Keep running, repairing drift as the cluster or the settings change'))
+@click.option('--resync', default=RESYNC, type=int,
+              help=TERM.cyan('Seconds between full reconciliations while watching'))
+@click.pass_context
+def reconcile(ctx, watch, resync):  # pragma: no cover
+    reconciler = Reconciler(ctx.obj['settings_file'], resync=resync, verbose=ctx.obj['verbose'])
+    if watch:
+        reconciler.run()
+    else:
+        reconciler.reconcile()
+
+
+@cli.command(help=TERM.cyan('Install only the nodes added to the settings, leaving existing nodes untouched'))
+@click.pass_context
+def scale(ctx):  # pragma: no cover
+    opts = load_config(ctx.obj['settings_file'])
+    setup_namespaces(opts, verbose=ctx.obj['verbose'])
+    # New orderers first, since new peers fetch the channel from the ordering service
+    scale_orderers(opts, verbose=ctx.obj['verbose'])
+    # New peers of each organisation, concurrently
+    org_pipeline(opts, [partial(scale_peers, verbose=ctx.obj['verbose'])])
 
 
 @cli.command(help=TERM.cyan('Load "nephos" settings YAML file'))
@@ -133,5 +198,19 @@ def settings(ctx):  # pragma: no cover
         print(json.dumps(data, indent=4))
 
 
+@cli.command(help=TERM.cyan('Show the health of every release of the network'))
+@click.option('--output', '-o', type=click.Choice(['table', 'json']), default='table',
+              help=TERM.cyan('Print a table, or JSON for monitoring'))
+@click.pass_context
+def status(ctx, output):  # pragma: no cover
+    opts = load_config(ctx.obj['settings_file'])
+    _, topology = parse_config(ctx.obj['settings_file'])
+    rows = gather_status(opts, topology, verbose=ctx.obj['verbose'])
+    if output == 'json':
+        print(json.dumps(rows, indent=4))
+    else:
+        print_status(rows)
+
+
 if __name__ == "__main__":  # pragma: no cover
     cli(obj={})
@@ -1,3 +1,3 @@
-from . import ca, crypto, ord, peer, settings, utils
+from . import ca, ca_client, crypto, ord, peer, settings, utils
 
-__all__ = ['ca', 'crypto', 'ord', 'peer', 'settings', 'utils']
+__all__ = ['ca', 'ca_client', 'crypto', 'ord', 'peer', 'settings', 'utils']
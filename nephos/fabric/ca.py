@@ -1,12 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from os import path
-from time import sleep
 
 from kubernetes.client.rest import ApiException
+from nephos.fabric.ca_client import PROBE_DEADLINE, get_ca_client
 from nephos.fabric.settings import get_namespace
-from nephos.fabric.utils import get_pod
 from nephos.helpers.helm import HelmPreserve, helm_install, helm_upgrade
 from nephos.helpers.k8s import (ingress_read, secret_read)
-from nephos.helpers.misc import execute_until_success
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map
 
 CURRENT_DIR = path.abspath(path.split(__file__)[0])
 
@@ -32,64 +32,65 @@ def ca_chart(opts, release, upgrade=False, verbose=False):
                      env_vars=env_vars,
                      verbose=verbose)
     else:
-        # TODO: Remove this try/catch once all CAs are updated
-        try:
-            preserve = (HelmPreserve('{}-hlf-ca'.format(release), 'CA_ADMIN', 'adminUsername'),
-                        HelmPreserve('{}-hlf-ca'.format(release), 'CA_PASSWORD', 'adminPassword'))
-            helm_upgrade(repository, 'hlf-ca', release, ca_namespace,
-                         config_yaml='{dir}/hlf-ca/{name}.yaml'.format(dir=values_dir, name=release),
-                         env_vars=env_vars, preserve=preserve,
-                         verbose=verbose)
-        except:
-            preserve = (HelmPreserve('{}-hlf-ca--ca'.format(release), 'CA_ADMIN', 'adminUsername'),
-                        HelmPreserve('{}-hlf-ca--ca'.format(release), 'CA_PASSWORD', 'adminPassword'))
-            helm_upgrade(repository, 'hlf-ca', release, ca_namespace,
-                         config_yaml='{dir}/hlf-ca/{name}.yaml'.format(dir=values_dir, name=release),
-                         env_vars=env_vars, preserve=preserve,
-                         verbose=verbose)
-
-
-def ca_enroll(pod_exec):
-    alive = False
-    while not alive:
-        res = pod_exec.logs()
-        if 'Listening on' in res:
-            alive = True
-        else:
-            sleep(15)
-    # Enroll CA Admin if necessary
-    ca_cert = pod_exec.execute(
-        'cat /var/hyperledger/fabric-ca/msp/signcerts/cert.pem')
-    if not ca_cert:
-        pod_exec.execute(
-            "bash -c 'fabric-ca-client enroll -d -u http://$CA_ADMIN:$CA_PASSWORD@$SERVICE_DNS:7054'")
-
-
-def check_ca(ingress_host, verbose=False):
+        admin_secret, _ = ca_secret(release, ca_namespace, verbose=verbose)
+        preserve = (HelmPreserve(admin_secret, 'CA_ADMIN', 'adminUsername'),
+                    HelmPreserve(admin_secret, 'CA_PASSWORD', 'adminPassword'))
+        helm_upgrade(repository, 'hlf-ca', release, ca_namespace,
+                     config_yaml='{dir}/hlf-ca/{name}.yaml'.format(dir=values_dir, name=release),
+                     env_vars=env_vars, preserve=preserve,
+                     verbose=verbose)
+
+
+# Secret holding the credentials of the CA admin, in form (name, data)
+def ca_secret(release, namespace, verbose=False):
+    # TODO: Remove this try/catch once all CAs are updated
+    try:
+        secret_name = '{}-hlf-ca'.format(release)
+        return secret_name, secret_read(secret_name, namespace, verbose=verbose)
+    except ApiException:
+        secret_name = '{}-hlf-ca--ca'.format(release)
+        return secret_name, secret_read(secret_name, namespace, verbose=verbose)
+
+
+def check_ca(ingress_host, tls_cert=None, deadline=PROBE_DEADLINE, verbose=False):
     # Check that CA ingress is operational
-    command = 'curl https://{ingress}/cainfo'.format(ingress=ingress_host)
-    execute_until_success(command, verbose=verbose)
+    ca_client = get_ca_client(ingress_host, tls_cert=tls_cert)
+    ca_client.wait_until_ready(deadline=deadline, verbose=verbose)
+
+
+def ca_ingress(ca_name, ca_namespace, verbose=False):
+    try:
+        # Get ingress of CA
+        return ingress_read(ca_name + '-hlf-ca', namespace=ca_namespace, verbose=verbose)
+    except ApiException:
+        return None
 
 
 # Runner
 def setup_ca(opts, upgrade=False, verbose=False):
-    for ca_name, ca_values in opts['cas'].items():
+    def ca_pipeline(ca_name):
         ca_namespace = get_namespace(opts, ca=ca_name)
-        # Install Charts
-        ca_chart(opts=opts, release=ca_name,
-                 upgrade=upgrade, verbose=verbose)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Pre-read the CA Ingress while we install the charts (on upgrade it will already exist)
+            ingress_future = executor.submit(ca_ingress, ca_name, ca_namespace, verbose=verbose)
 
-        # Obtain CA pod and Enroll
-        pod_exec = get_pod(namespace=ca_namespace, release=ca_name, app='hlf-ca', verbose=verbose)
-        ca_enroll(pod_exec)
+            # Install Charts
+            ca_chart(opts=opts, release=ca_name,
+                     upgrade=upgrade, verbose=verbose)
+
+            ingress_urls = ingress_future.result()
 
         # Get CA Ingress and check it is running
-        try:
-            # Get ingress of CA
-            ingress_urls = ingress_read(ca_name + '-hlf-ca', namespace=ca_namespace, verbose=verbose)
-        except ApiException:
+        if not ingress_urls:
+            # On a new install, the Ingress is only created by the CA chart
+            ingress_urls = ca_ingress(ca_name, ca_namespace, verbose=verbose)
+        if not ingress_urls:
             print('No ingress found for CA')
-            continue
+            return
 
         # Check the CA is running
-        check_ca(ingress_host=ingress_urls[0], verbose=verbose)
+        check_ca(ingress_host=ingress_urls[0], tls_cert=opts['cas'][ca_name].get('tls_cert'), verbose=verbose)
+
+    # Separate CAs share nothing, so we set them up concurrently and report all failures together
+    parallel_map(ca_pipeline, list(opts['cas'].keys()),
+                 max_workers=opts['core'].get('max_parallel', MAX_PARALLEL))
@@ -0,0 +1,192 @@
+from __future__ import print_function
+
+import base64
+from glob import glob
+import json
+from os import makedirs, path
+import ssl
+from threading import Lock
+import time
+
+from blessings import Terminal
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+from cryptography.x509.oid import NameOID
+import requests
+from requests.adapters import HTTPAdapter
+
+from nephos.helpers.throttle import DEFAULT, PROBE, throttle
+
+t = Terminal()
+
+# Probe timings (in seconds)
+PROBE_TIMEOUT = 10
+PROBE_DELAY = 0.5
+PROBE_MAX_DELAY = 15
+PROBE_DEADLINE = 600
+
+# Order of the NIST P-256 curve, used to produce the low-S signatures Fabric requires
+P256_ORDER = 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551
+
+
+def b64encode(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return base64.b64encode(data).decode('utf-8')
+
+
+def split_pem(pem_data):
+    marker = b'-----END CERTIFICATE-----'
+    return [block.strip() + b'\n' + marker + b'\n' for block in pem_data.split(marker) if block.strip()]
+
+
+# Identity (certificate and private key) with which we can sign requests to the CA
+class Identity:
+    def __init__(self, cert, key):
+        self.cert = cert
+        self.key = key
+
+    @classmethod
+    def from_msp(cls, msp_path):
+        with open(path.join(msp_path, 'signcerts', 'cert.pem'), 'rb') as f:
+            cert = f.read()
+        key_files = glob(path.join(msp_path, 'keystore', '*'))
+        if len(key_files) != 1:
+            raise Exception('We should only find one file in {}'.format(path.join(msp_path, 'keystore')))
+        with open(key_files[0], 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+        return cls(cert, key)
+
+    # Authorization token, in the format the Fabric CA server expects: "<b64 cert>.<b64 signature>"
+    def token(self, body=b''):
+        message = (b64encode(body) + '.' + b64encode(self.cert)).encode('utf-8')
+        r, s = decode_dss_signature(self.key.sign(message, ec.ECDSA(hashes.SHA256())))
+        if s > P256_ORDER // 2:
+            s = P256_ORDER - s
+        return b64encode(self.cert) + '.' + b64encode(encode_dss_signature(r, s))
+
+
+# Adapter to verify the CA server against a pinned certificate bundle
+class PinnedAdapter(HTTPAdapter):
+    def __init__(self, tls_cert, **kwargs):
+        self.ssl_context = ssl.create_default_context(cafile=tls_cert)
+        # Like fabric-ca-client, trust the pinned certificate even if it is an intermediate
+        self.ssl_context.verify_flags |= getattr(ssl, 'VERIFY_X509_PARTIAL_CHAIN', 0)
+        super(PinnedAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(PinnedAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+# Client for the Fabric CA REST API, holding a persistent HTTPS session
+class CaClient:
+    def __init__(self, host, tls_cert=None, scheme='https', timeout=PROBE_TIMEOUT):
+        self.host = host
+        self.url = '{scheme}://{host}'.format(scheme=scheme, host=host)
+        self.tls_cert = tls_cert
+        self.timeout = timeout
+        self.session = requests.Session()
+        if tls_cert:
+            self.session.verify = tls_cert
+            self.session.mount('https://', PinnedAdapter(tls_cert))
+
+    def request(self, method, endpoint, priority=DEFAULT, **kwargs):
+        # Each CA (and the database behind it) gets its own rate limit
+        throttle('ca:' + self.host, priority)
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, self.url + endpoint, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def cainfo(self, priority=DEFAULT):
+        return self.request('GET', '/cainfo', priority=priority)['result']
+
+    def identity(self, registrar, username):
+        try:
+            return self.request('GET', '/api/v1/identities/{}'.format(username),
+                                headers={'Authorization': registrar.token()})['result']
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                return None
+            raise
+
+    def register(self, registrar, username, password, node_type='client', attrs=None):
+        data = {'id': username, 'secret': password, 'type': node_type, 'affiliation': ''}
+        if attrs:
+            data['attrs'] = attrs
+        body = json.dumps(data).encode('utf-8')
+        return self.request('POST', '/api/v1/register', data=body,
+                            headers={'Authorization': registrar.token(body),
+                                     'Content-Type': 'application/json'})['result']
+
+    # Enroll with a locally generated key and CSR, saving the MSP as fabric-ca-client would
+    def enroll(self, username, password, msp_path):
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        csr = x509.CertificateSigningRequestBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, username)])
+        ).sign(key, hashes.SHA256(), default_backend())
+        result = self.request('POST', '/api/v1/enroll',
+                              json={'certificate_request': csr.public_bytes(serialization.Encoding.PEM).decode('utf-8')},
+                              auth=(username, password))['result']
+        cert = base64.b64decode(result['Cert'])
+        ca_chain = base64.b64decode(result['ServerInfo']['CAChain'])
+        # Self-signed certificates are root CA certs, the rest are intermediate CA certs
+        ca_file = self.host.replace('.', '-').replace(':', '-') + '.pem'
+        root_certs, intermediate_certs = b'', b''
+        for ca_cert in split_pem(ca_chain):
+            cert_info = x509.load_pem_x509_certificate(ca_cert, default_backend())
+            if cert_info.issuer == cert_info.subject:
+                root_certs += ca_cert
+            else:
+                intermediate_certs += ca_cert
+        ski = x509.SubjectKeyIdentifier.from_public_key(key.public_key()).digest.hex()
+        key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+        msp_files = [('signcerts', 'cert.pem', cert), ('keystore', ski + '_sk', key_pem),
+                     ('cacerts', ca_file, root_certs), ('intermediatecerts', ca_file, intermediate_certs)]
+        for subfolder, filename, content in msp_files:
+            if content:
+                makedirs(path.join(msp_path, subfolder), exist_ok=True)
+                with open(path.join(msp_path, subfolder, filename), 'wb') as f:
+                    f.write(content)
+        return Identity(cert, key)
+
+    def wait_until_ready(self, deadline=PROBE_DEADLINE, verbose=False):
+        # Retry quickly at first, backing off exponentially up to PROBE_MAX_DELAY
+        end_time = time.monotonic() + deadline
+        delay = PROBE_DELAY
+        first_pass = True
+        while True:
+            try:
+                result = self.cainfo(priority=PROBE)
+                if verbose:
+                    print(t.green('CA {} is operational'.format(self.host)))
+                return result
+            except (requests.RequestException, ValueError, KeyError) as error:
+                if first_pass and verbose:
+                    print(t.red('CA {} is not yet operational: {}'.format(self.host, error)))
+                first_pass = False
+            if time.monotonic() + delay > end_time:
+                raise TimeoutError('CA {} was not operational after {} seconds'.format(self.host, deadline))
+            print(t.red('.'), end='', flush=True)
+            time.sleep(delay)
+            delay = min(delay * 2, PROBE_MAX_DELAY)
+
+
+CLIENTS = {}
+CLIENTS_LOCK = Lock()
+
+
+# Obtain a shared client, so the same session is reused by the health probes and enrollment
+def get_ca_client(host, tls_cert=None):
+    # Relative and absolute paths to the same certificate share a client
+    tls_cert = path.abspath(tls_cert) if tls_cert else None
+    with CLIENTS_LOCK:
+        key = (host, tls_cert)
+        if key not in CLIENTS:
+            CLIENTS[key] = CaClient(host, tls_cert=tls_cert)
+        return CLIENTS[key]
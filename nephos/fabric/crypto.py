@@ -1,88 +1,108 @@
 import shutil
-from collections import namedtuple
-from os import path, chdir, getcwd, listdir, makedirs
+from collections import namedtuple, OrderedDict
+from os import path, listdir, makedirs, rename, walk
+from shlex import quote as shlex_quote
+from threading import Lock
 
+from nephos.fabric.ca import ca_secret
+from nephos.fabric.ca_client import Identity, get_ca_client
 from nephos.fabric.settings import get_namespace
-from nephos.fabric.utils import credentials_secret, crypto_secret, get_pod
-from nephos.helpers.k8s import ns_create, ingress_read, secret_from_file
-from nephos.helpers.misc import execute, execute_until_success
+from nephos.fabric.utils import credentials_secret
+from nephos.helpers.artifacts import artifact_store
+from nephos.helpers.k8s import nephos_labels, ingress_read, secret_sync
+from nephos.helpers.misc import execute
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map
 
-PWD = getcwd()
 CryptoInfo = namedtuple('CryptoInfo', ('secret_type', 'subfolder', 'key', 'required'))
+ID_CRYPTO = (
+    CryptoInfo('idcert', 'signcerts', 'cert.pem', True),
+    CryptoInfo('idkey', 'keystore', 'key.pem', True)
+)
+CA_CRYPTO = (
+    CryptoInfo('cacert', 'cacerts', 'cacert.pem', True),
+    CryptoInfo('caintcert', 'intermediatecerts', 'intermediatecacert.pem', False)
+)
 
 
 # CA Helpers
-def register_node(ca_namespace, ca, node_type, username, password, verbose=False):
-    # Get CA
-    ca_exec = get_pod(namespace=ca_namespace, release=ca, app='hlf-ca', verbose=verbose)
-    # Check if Orderer is registered with the relevant CA
-    ord_id = ca_exec.execute(
-        'fabric-ca-client identity list --id {id}'.format(id=username))
-    # Registered if needed
-    if not ord_id:
-        ca_exec.execute(
-            'fabric-ca-client register --id.name {id} --id.secret {pw} --id.type {type}'.format(
-                id=username, pw=password, type=node_type))
+def ca_rest_client(opts, ca, verbose=False):
+    ca_namespace = get_namespace(opts, ca=ca)
+    ingress_urls = ingress_read(ca + '-hlf-ca', namespace=ca_namespace, verbose=verbose)
+    return get_ca_client(ingress_urls[0], tls_cert=opts['cas'][ca].get('tls_cert'))
+
+
+# Locks per file in dir_config, so that organisations running concurrently create files they share
+# (the CA admin MSP, channel transactions) only once
+CONFIG_LOCKS = {}
+CONFIG_LOCKS_LOCK = Lock()
+
+
+def config_lock(file_path):
+    with CONFIG_LOCKS_LOCK:
+        return CONFIG_LOCKS.setdefault(path.abspath(file_path), Lock())
+
+
+# Identity of the CA admin, used to register other identities with the CA
+def ca_registrar(opts, ca, verbose=False):
+    msp_path = path.join(opts['core']['dir_config'], '{}_CA_ADMIN_MSP'.format(ca))
+    with config_lock(msp_path):
+        if not path.isdir(msp_path):
+            _, secret_data = ca_secret(ca, get_namespace(opts, ca=ca), verbose=verbose)
+            ca_client = ca_rest_client(opts, ca, verbose=verbose)
+            # Enroll into a temporary directory, so an interrupted enrollment never leaves a partial MSP
+            tmp_path = msp_path + '.tmp'
+            if path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            identity = ca_client.enroll(secret_data['CA_ADMIN'], secret_data['CA_PASSWORD'], tmp_path)
+            rename(tmp_path, msp_path)
+            return identity
+    return Identity.from_msp(msp_path)
+
+
+def register_id(opts, ca, username, password, node_type='client', attrs=None, verbose=False):
+    ca_client = ca_rest_client(opts, ca, verbose=verbose)
+    registrar = ca_registrar(opts, ca, verbose=verbose)
+    # Check if identity is registered with the relevant CA, and register it if needed
+    if not ca_client.identity(registrar, username):
+        ca_client.register(registrar, username, password, node_type=node_type, attrs=attrs)
+        if verbose:
+            print('Registered {} with CA {}'.format(username, ca))
+
+
+def register_node(opts, ca, node_type, username, password, verbose=False):
+    register_id(opts, ca, username, password, node_type, verbose=verbose)
+
+
+def enroll_id(opts, ca, username, password, msp_path, verbose=False):
+    ca_client = ca_rest_client(opts, ca, verbose=verbose)
+    ca_client.enroll(username, password, msp_path)
+    if verbose:
+        print('Enrolled {} with CA {} into {}'.format(username, ca, msp_path))
 
 
 def enroll_node(opts, ca, username, password, verbose=False):
     dir_config = opts['core']['dir_config']
-    ca_namespace = get_namespace(opts, ca=ca)
-    ingress_urls = ingress_read(ca + '-hlf-ca', namespace=ca_namespace, verbose=verbose)
     msp_dir = '{}_MSP'.format(username)
     msp_path = path.join(dir_config, msp_dir)
     if not path.isdir(msp_path):
-        # Enroll
-        command = ('FABRIC_CA_CLIENT_HOME={dir} fabric-ca-client enroll ' +
-                   '-u https://{username}:{password}@{ingress} -M {msp_dir} ' +
-                   '--tls.certfiles {ca_server_tls}').format(
-            dir=dir_config,
-            username=username,
-            password=password,
-            ingress=ingress_urls[0],
-            msp_dir=msp_dir,
-            ca_server_tls=path.abspath(opts['cas'][ca]['tls_cert']))
-        execute_until_success(command)
+        enroll_id(opts, ca, username, password, msp_path, verbose=verbose)
     return msp_path
 
 
 def create_admin(opts, msp_name, verbose=False):
     dir_config = opts['core']['dir_config']
     msp_values = opts['msps'][msp_name]
-    ca_values = opts['cas'][msp_values['ca']]
-
-    # TODO: Refactor this into its own function
     ca_name = msp_values['ca']
-    ca_namespace = get_namespace(opts, ca=ca_name)
-
-    # Obtain CA pod
-    pod_exec = get_pod(namespace=ca_namespace, release=ca_name, app='hlf-ca', verbose=verbose)
-
-    # Get CA ingress
-    ingress_urls = ingress_read(ca_name + '-hlf-ca', namespace=ca_namespace, verbose=verbose)
-    ca_ingress = ingress_urls[0]
 
     # Register the Organisation with the CAs
-    admin_id = pod_exec.execute(
-        ('fabric-ca-client identity list --id {id}'
-         ).format(id=msp_values['org_admin']))
-
-    # If we cannot find the identity, we must create it
-    if not admin_id:
-        pod_exec.execute(
-            ("fabric-ca-client register --id.name {id} --id.secret {pw} --id.attrs 'admin=true:ecert'"
-             ).format(id=msp_values['org_admin'], pw=msp_values['org_adminpw']))
+    register_id(opts, ca_name, msp_values['org_admin'], msp_values['org_adminpw'],
+                attrs=[{'name': 'admin', 'value': 'true', 'ecert': True}], verbose=verbose)
 
     # If our keystore does not exist or is empty, we need to enroll the identity...
     keystore = path.join(dir_config, msp_name, 'keystore')
     if not path.isdir(keystore) or not listdir(keystore):
-        execute(
-            ('FABRIC_CA_CLIENT_HOME={dir} fabric-ca-client enroll ' +
-             '-u https://{id}:{pw}@{ingress} -M {msp_dir} --tls.certfiles {ca_server_tls}').format(
-                dir=dir_config, id=msp_values['org_admin'], pw=msp_values['org_adminpw'],
-                ingress=ca_ingress, msp_dir=msp_name,
-                ca_server_tls=ca_values['tls_cert']
-            ), verbose=verbose)
+        enroll_id(opts, ca_name, msp_values['org_admin'], msp_values['org_adminpw'],
+                  path.join(dir_config, msp_name), verbose=verbose)
 
 
 def admin_creds(opts, msp_name, verbose=False):
@@ -92,6 +112,7 @@ def admin_creds(opts, msp_name, verbose=False):
     admin_cred_secret = 'hlf--{}-admincred'.format(msp_values['org_admin'])
     secret_data = credentials_secret(admin_cred_secret, msp_namespace,
                                      username=msp_values['org_admin'], password=msp_values.get('org_adminpw'),
+                                     labels=nephos_labels(msp=msp_name, node=msp_values['org_admin'], type='admincred'),
                                      verbose=verbose)
     msp_values['org_adminpw'] = secret_data['CA_PASSWORD']
 
@@ -111,17 +132,12 @@ def msp_secrets(opts, msp_name, verbose=False):
             makedirs(admin_dir)
         shutil.copy(signcert, admincert)
 
-    # Create ID secrets from Admin MSP
-    id_to_secrets(msp_namespace, msp_path, msp_values['org_admin'], verbose=verbose)
-
-    # Create CA secrets from Admin MSP
-    cacerts_to_secrets(msp_namespace, msp_path, msp_values['org_admin'], verbose=verbose)
+    # Sync ID and CA secrets from Admin MSP
+    sync_msp_secrets(msp_namespace, {msp_values['org_admin']: msp_path}, ID_CRYPTO + CA_CRYPTO,
+                     msp=msp_name, verbose=verbose)
 
 
 def admin_msp(opts, msp_name, verbose=False):
-    admin_namespace = get_namespace(opts, msp_name)
-    ns_create(admin_namespace, verbose=verbose)
-
     # Get/set credentials
     admin_creds(opts, msp_name, verbose=verbose)
 
@@ -132,40 +148,48 @@ def admin_msp(opts, msp_name, verbose=False):
     msp_secrets(opts, msp_name, verbose=verbose)
 
 
-# General helpers
-def item_to_secret(namespace, msp_path, user, item, verbose=False):
-    # Item in form CryptoInfo(name, subfolder, key, required)
-    secret_name = 'hlf--{user}-{type}'.format(user=user, type=item.secret_type)
-    file_path = path.join(msp_path, item.subfolder)
-    try:
-        crypto_secret(secret_name,
-                      namespace,
-                      file_path=file_path,
-                      key=item.key,
-                      verbose=verbose)
-    except Exception as error:
-        if item.required:
-            raise Exception(error)
-        else:
-            print('No {} found, so secret "{}" was not created'.format(file_path, secret_name))
+# Admin MSPs of several organisations, set up concurrently
+def admin_msps(opts, msp_names, verbose=False):
+    def msp_admin(msp_name):
+        admin_msp(opts, msp_name, verbose=verbose)
 
-
-def id_to_secrets(namespace, msp_path, user, verbose=False):
-    crypto_info = [
-        CryptoInfo('idcert', 'signcerts', 'cert.pem', True),
-        CryptoInfo('idkey', 'keystore', 'key.pem', True)
-    ]
-    for item in crypto_info:
-        item_to_secret(namespace, msp_path, user, item, verbose=verbose)
+    msp_names = list(OrderedDict.fromkeys(msp_names))
+    parallel_map(msp_admin, msp_names, max_workers=opts['core'].get('max_parallel', MAX_PARALLEL))
+    return msp_names
 
 
-def cacerts_to_secrets(namespace, msp_path, user, verbose=False):
-    crypto_info = [
-        CryptoInfo('cacert', 'cacerts', 'cacert.pem', True),
-        CryptoInfo('caintcert', 'intermediatecerts', 'intermediatecacert.pem', False)
-    ]
+# General helpers
+# Read (in a single walk of the MSP) the files that feed each crypto secret of a user
+def msp_secret_data(msp_path, user, crypto_info):
+    msp_files = {}
+    for root, _, files in walk(msp_path):
+        msp_files[path.relpath(root, msp_path)] = sorted(files)
+    secrets = OrderedDict()
     for item in crypto_info:
-        item_to_secret(namespace, msp_path, user, item, verbose=verbose)
+        secret_name = 'hlf--{user}-{type}'.format(user=user, type=item.secret_type)
+        file_path = path.join(msp_path, item.subfolder)
+        files = msp_files.get(item.subfolder, [])
+        if len(files) != 1:
+            if item.required:
+                raise Exception('We should only find one file in {}'.format(file_path))
+            else:
+                print('No {} found, so secret "{}" was not created'.format(file_path, secret_name))
+                continue
+        with open(path.join(file_path, files[0]), 'rb') as f:
+            secrets[secret_name] = {item.key: f.read()}
+    return secrets
+
+
+# Sync the crypto secrets of several users (in form {user: msp_path}) within a namespace
+def sync_msp_secrets(namespace, msp_paths, crypto_info, msp=None, max_workers=MAX_PARALLEL, verbose=False):
+    secrets = OrderedDict()
+    labels = {}
+    for user, msp_path in msp_paths.items():
+        secrets.update(msp_secret_data(msp_path, user, crypto_info))
+        for item in crypto_info:
+            secret_name = 'hlf--{user}-{type}'.format(user=user, type=item.secret_type)
+            labels[secret_name] = nephos_labels(msp=msp, node=user, type=item.secret_type)
+    return secret_sync(secrets, namespace, labels=labels, max_workers=max_workers, verbose=verbose)
 
 
 # TODO: Create single function to enroll/register, separate from loop
@@ -173,64 +197,72 @@ def setup_nodes(opts, node_type, verbose=False):
     nodes = opts[node_type + 's']
     msp_values = opts['msps'][nodes['msp']]
     node_namespace = get_namespace(opts, nodes['msp'])
-    ca_namespace = get_namespace(opts, ca=opts['msps'][nodes['msp']]['ca'])
+    msp_paths = OrderedDict()
     for release in nodes['names']:
         # Create secret with Orderer credentials
         secret_name = 'hlf--{}-cred'.format(release)
         secret_data = credentials_secret(secret_name, node_namespace,
                                          username=release,
+                                         labels=nephos_labels(msp=nodes['msp'], node=release, type='cred'),
                                          verbose=verbose)
         # Register node
-        register_node(ca_namespace, msp_values['ca'],
+        register_node(opts, msp_values['ca'],
                       node_type, secret_data['CA_USERNAME'], secret_data['CA_PASSWORD'],
                       verbose=verbose)
         # Enroll node
-        msp_path = enroll_node(opts, msp_values['ca'],
-                               secret_data['CA_USERNAME'], secret_data['CA_PASSWORD'],
-                               verbose=verbose)
-        # Secrets
-        id_to_secrets(namespace=node_namespace, msp_path=msp_path, user=release, verbose=verbose)
+        msp_paths[release] = enroll_node(opts, msp_values['ca'],
+                                         secret_data['CA_USERNAME'], secret_data['CA_PASSWORD'],
+                                         verbose=verbose)
+    # Secrets
+    # Secrets of all nodes are written together
+    sync_msp_secrets(node_namespace, msp_paths, ID_CRYPTO, msp=nodes['msp'],
+                     max_workers=nodes.get('max_parallel', MAX_PARALLEL), verbose=verbose)
 
 
 # ConfigTxGen helpers
+def configtxgen(dir_config, arguments, verbose=False):
+    # configtxgen reads configtx.yaml from its working directory, which we set in the shell
+    # (rather than with chdir), since several organisations may be set up concurrently
+    execute('cd {dir} && configtxgen {arguments}'.format(dir=shlex_quote(dir_config), arguments=arguments),
+            verbose=verbose)
+
+
 def genesis_block(opts, verbose=False):
     ord_namespace = get_namespace(opts, opts['orderers']['msp'])
-    # Change to blockchain materials directory
-    chdir(opts['core']['dir_config'])
+    genesis_file = path.join(opts['core']['dir_config'], 'genesis.block')
     # Create the genesis block
-    if not path.exists('genesis.block'):
+    if not path.exists(genesis_file):
         # Genesis block creation and storage
-        execute(
-            'configtxgen -profile OrdererGenesis -outputBlock genesis.block',
-            verbose=verbose)
+        configtxgen(opts['core']['dir_config'], '-profile OrdererGenesis -outputBlock genesis.block',
+                    verbose=verbose)
     else:
         print('genesis.block already exists')
     # Create the genesis block secret
-    secret_from_file(secret=opts['orderers']['secret_genesis'], namespace=ord_namespace,
-                     key='genesis.block', filename='genesis.block', verbose=verbose)
-    # Return to original directory
-    chdir(PWD)
+    artifact_store(opts['orderers']['secret_genesis'], ord_namespace,
+                   key='genesis.block', filename=genesis_file,
+                   labels=nephos_labels(msp=opts['orderers']['msp'], type='genesis'), verbose=verbose)
 
 
 def channel_tx(opts, verbose=False):
     peer_namespace = get_namespace(opts, opts['peers']['msp'])
-    # Change to blockchain materials directory
-    chdir(opts['core']['dir_config'])
     # Create Channel Tx
     channel_file = '{channel}.tx'.format(channel=opts['peers']['channel_name'])
-    if not path.exists(channel_file):
-        # Channel transaction creation and storage
-        execute(
-            'configtxgen -profile {channel_profile} -channelID {channel} -outputCreateChannelTx {channel_file}'.format(
-                channel_profile=opts['peers']['channel_profile'],
-                channel=opts['peers']['channel_name'],
-                channel_file=channel_file
-            ),
-            verbose=verbose)
-    else:
-        print('{channel}.tx already exists'.format(channel=opts['peers']['channel_name']))
+    channel_path = path.join(opts['core']['dir_config'], channel_file)
+    # Organisations sharing a channel share its transaction, so only the first one generates it
+    with config_lock(channel_path):
+        if not path.exists(channel_path):
+            # Channel transaction creation and storage
+            configtxgen(
+                opts['core']['dir_config'],
+                '-profile {channel_profile} -channelID {channel} -outputCreateChannelTx {channel_file}'.format(
+                    channel_profile=opts['peers']['channel_profile'],
+                    channel=opts['peers']['channel_name'],
+                    channel_file=channel_file
+                ),
+                verbose=verbose)
+        else:
+            print('{channel}.tx already exists'.format(channel=opts['peers']['channel_name']))
     # Create the channel transaction secret
-    secret_from_file(secret=opts['peers']['secret_channel'], namespace=peer_namespace,
-                     key=channel_file, filename=channel_file, verbose=verbose)
-    # Return to original directory
-    chdir(PWD)
+    artifact_store(opts['peers']['secret_channel'], peer_namespace,
+                   key=channel_file, filename=channel_path,
+                   labels=nephos_labels(msp=opts['peers']['msp'], type='channel'), verbose=verbose)
@@ -3,6 +3,7 @@ from time import sleep
 from nephos.fabric.utils import get_pod
 from nephos.fabric.settings import get_namespace
 from nephos.helpers.helm import helm_install, helm_upgrade
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_pipeline, rolling_pipeline
 
 
 def check_ord(namespace, release, verbose=False):
@@ -28,7 +29,9 @@ def setup_ord(opts, upgrade=False, verbose=False):
                      pod_num=opts['orderers']['kafka']['pod_num'],
                      verbose=verbose)
 
-    for release in opts['orderers']['names']:
+    # Kafka is installed above with helm_install, which only returns once all "pod_num" pods are running,
+    # so the orderers below are released behind this readiness gate
+    def ord_chart(release):
         # HL-Ord
         if not upgrade:
             helm_install(opts['core']['chart_repo'], 'hlf-ord', release, ord_namespace,
@@ -38,5 +41,15 @@ def setup_ord(opts, upgrade=False, verbose=False):
             helm_upgrade(opts['core']['chart_repo'], 'hlf-ord', release, ord_namespace,
                          config_yaml='{dir}/hlf-ord/{name}.yaml'.format(dir=opts['core']['dir_values'], name=release),
                          verbose=verbose)
+
+    def ord_check(release):
         # Check that Orderer is running
         check_ord(ord_namespace, release, verbose=verbose)
+
+    if not upgrade:
+        parallel_pipeline([ord_chart, ord_check], opts['orderers']['names'],
+                          max_workers=opts['orderers'].get('max_parallel', MAX_PARALLEL))
+    else:
+        # Rolling upgrade, to preserve the capacity of the ordering service
+        rolling_pipeline([ord_chart, ord_check], opts['orderers']['names'],
+                         max_unavailable=opts['orderers'].get('max_unavailable', 1))
@@ -5,6 +5,7 @@ from nephos.fabric.settings import get_namespace
 from nephos.fabric.utils import get_pod
 from nephos.helpers.helm import helm_install, helm_upgrade
 from nephos.helpers.misc import execute
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map, parallel_pipeline, rolling_pipeline
 
 
 # TODO: Move to Ord module
@@ -31,11 +32,12 @@ def check_peer(namespace, release, verbose=False):
             res = pod_exec.logs(1000)
 
 
-# TODO: Split CouchDB creation from Peer creation
 def setup_peer(opts, upgrade=False, verbose=False):
     peer_namespace = get_namespace(opts, opts['peers']['msp'])
-    for release in opts['peers']['names']:
-        # Deploy the CouchDB instances
+    max_parallel = opts['peers'].get('max_parallel', MAX_PARALLEL)
+
+    # Deploy the CouchDB instances
+    def couchdb_chart(release):
         if not upgrade:
             helm_install(opts['core']['chart_repo'], 'hlf-couchdb', 'cdb-{}'.format(release), peer_namespace,
                          config_yaml='{dir}/hlf-couchdb/cdb-{name}.yaml'.format(dir=opts['core']['dir_values'], name=release),
@@ -51,7 +53,8 @@ def setup_peer(opts, upgrade=False, verbose=False):
             #              preserve=preserve,
             #              verbose=verbose)
 
-        # Deploy the HL-Peer charts
+    # Deploy the HL-Peer charts
+    def peer_chart(release):
         if not upgrade:
             helm_install(opts['core']['chart_repo'], 'hlf-peer', release, peer_namespace,
                          config_yaml='{dir}/hlf-peer/{name}.yaml'.format(dir=opts['core']['dir_values'], name=release),
@@ -61,13 +64,23 @@ def setup_peer(opts, upgrade=False, verbose=False):
                          config_yaml='{dir}/hlf-peer/{name}.yaml'.format(dir=opts['core']['dir_values'], name=release),
                          verbose=verbose)
 
+    def peer_check(release):
         check_peer(peer_namespace, release, verbose=verbose)
 
+    if not upgrade:
+        # All CouchDB charts are scheduled first, and each peer is deployed as soon as its own CouchDB is running
+        parallel_pipeline([couchdb_chart, peer_chart, peer_check], opts['peers']['names'], max_workers=max_parallel)
+    else:
+        # Rolling upgrade, so the organisation keeps endorsing while its peers restart
+        rolling_pipeline([peer_chart, peer_check], opts['peers']['names'],
+                         max_unavailable=opts['peers'].get('max_unavailable', 1))
+
 
-# TODO: Split channel creation from channel joining
-def setup_channel(opts, verbose=False):
+# The first peer creates the channel unless it already exists, after which peers fetch its block and join concurrently
+def setup_channel(opts, create=True, verbose=False):
     peer_namespace = get_namespace(opts, opts['peers']['msp'])
     ord_namespace = get_namespace(opts, opts['orderers']['msp'])
+    max_parallel = opts['peers'].get('max_parallel', MAX_PARALLEL)
     # Get orderer TLS status
     ord_tls = check_ord_tls(opts, verbose=verbose)
     ord_name = random.choice(opts['orderers']['names'])
@@ -78,44 +91,49 @@ def setup_channel(opts, verbose=False):
     else:
         cmd_suffix = ''
 
-    for index, release in enumerate(opts['peers']['names']):
+    channel = opts['peers']['channel_name']
+    has_block = 'ls /var/hyperledger/{channel}.block'.format(channel=channel)
+
+    def peer_join(release, creator=False):
         # Get peer pod
         pod_ex = get_pod(peer_namespace, release, 'hlf-peer', verbose=verbose)
 
-        # Check if the file exists
-        has_channel = False
-        while not has_channel:
-            channel_block = pod_ex.execute('ls /var/hyperledger/{channel}.block'.format(
-                channel=opts['peers']['channel_name']))
-            if not channel_block:
-                if index == 0:
-                    pod_ex.execute(
-                        ("bash -c 'peer channel create " +
-                         "-o {orderer}-hlf-ord.{ns}.svc.cluster.local:7050 " +
-                         "-c {channel} -f /hl_config/channel/{channel}.tx {cmd_suffix}'").format(
-                            orderer=ord_name,
-                            ns=ord_namespace,
-                            channel=opts['peers']['channel_name'],
-                            cmd_suffix=cmd_suffix))
-                # TODO: This should have same ordering as above command
-                pod_ex.execute(
-                    ("bash -c 'peer channel fetch 0 " +
-                     "/var/hyperledger/{channel}.block " +
-                     "-c {channel} " +
-                     "-o {orderer}-hlf-ord.{ns}.svc.cluster.local:7050 {cmd_suffix}'").format(
+        # Check if the file exists, and which channels the peer has joined, in one go
+        block_res, list_res = pod_ex.batch([has_block, 'peer channel list'], stop_on_error=False)
+        while block_res.exit_code != 0:
+            commands = []
+            if creator:
+                commands.append(
+                    ("bash -c 'peer channel create " +
+                     "-o {orderer}-hlf-ord.{ns}.svc.cluster.local:7050 " +
+                     "-c {channel} -f /hl_config/channel/{channel}.tx {cmd_suffix}'").format(
                         orderer=ord_name,
                         ns=ord_namespace,
-                        channel=opts['peers']['channel_name'],
+                        channel=channel,
                         cmd_suffix=cmd_suffix))
-            else:
-                has_channel = True
-        res = pod_ex.execute('peer channel list')
-        channels = (res.split('Channels peers has joined: ')[1]).split()
-        if opts['peers']['channel_name'] not in channels:
+            # TODO: This should have same ordering as above command
+            commands.append(
+                ("bash -c 'peer channel fetch 0 " +
+                 "/var/hyperledger/{channel}.block " +
+                 "-c {channel} " +
+                 "-o {orderer}-hlf-ord.{ns}.svc.cluster.local:7050 {cmd_suffix}'").format(
+                    orderer=ord_name,
+                    ns=ord_namespace,
+                    channel=channel,
+                    cmd_suffix=cmd_suffix))
+            # Create/fetch may fail while the orderers settle, so we keep going and check the block again
+            block_res = pod_ex.batch(commands + [has_block], stop_on_error=False)[-1]
+        channels = (list_res.output.split('Channels peers has joined: ')[1]).split()
+        if channel not in channels:
             pod_ex.execute(
                 ("bash -c " +
                  "'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
                  "peer channel join -b /var/hyperledger/{channel}.block {cmd_suffix}'").format(
-                    channel=opts['peers']['channel_name'],
+                    channel=channel,
                     cmd_suffix=cmd_suffix
                 ))
+
+    releases = list(opts['peers']['names'])
+    if create and releases:
+        peer_join(releases.pop(0), creator=True)
+    parallel_map(peer_join, releases, max_workers=max_parallel)
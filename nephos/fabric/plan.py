@@ -0,0 +1,267 @@
+from __future__ import print_function
+
+from collections import namedtuple, OrderedDict
+import copy
+from functools import partial
+import json
+from os import listdir, path
+
+from nephos.fabric.ca import setup_ca
+from nephos.fabric.crypto import ID_CRYPTO, admin_msps, channel_tx, genesis_block, msp_secret_data, setup_nodes
+from nephos.fabric.ord import setup_ord
+from nephos.fabric.peer import setup_channel, setup_peer
+from nephos.fabric.scale import STATE_CM, nodes_opts, record_applied, state_key
+from nephos.fabric.settings import get_namespace, peer_orgs
+from nephos.fabric.utils import get_pod, org_pipeline
+from nephos.helpers.artifacts import artifact_matches
+from nephos.helpers.helm import helm_releases
+from nephos.helpers.k8s import HASH_ANNOTATION, app_releases, cm_list, secret_body, secret_list
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map
+
+# Cluster state read in bulk, in form:
+# releases {release: {'chart', 'namespace', 'status'}}, secrets {namespace: {name: secret}},
+# configmaps {namespace: {name: configmap}}, pods {(namespace, app): set of releases}
+# and channels {(namespace, peer): set of joined channels}
+ClusterState = namedtuple('ClusterState', ('releases', 'secrets', 'configmaps', 'pods', 'channels'))
+# Step a deployment would take, e.g. Action('install', 'peer', 'peer1', 'peers', 'PeerMSP', 'not installed')
+Action = namedtuple('Action', ('action', 'kind', 'name', 'namespace', 'msp', 'reason'))
+
+# Secrets a node cannot run without, which are those setup_nodes creates
+REQUIRED_SECRETS = ('cred', 'idcert', 'idkey')
+
+
+# Channels a peer has joined, which "peer channel list" prints after its log lines
+def peer_channels(namespace, release, verbose=False):
+    pod_ex = get_pod(namespace, release, 'hlf-peer', verbose=verbose)
+    res = pod_ex.execute('peer channel list') or ''
+    lines = res.splitlines()
+    for index, line in enumerate(lines):
+        if 'has joined' in line:
+            return set(channel.strip() for channel in lines[index + 1:] if channel.strip())
+    return set()
+
+
+def release_installed(state, namespace, release, app):
+    return (state.releases.get(release, {}).get('status') == 'DEPLOYED' and
+            release in state.pods.get((namespace, app), ()))
+
+
+# Read releases, secrets, configmaps and pods with a few concurrent list calls, then the channels of running peers
+def gather_state(opts, topology, verbose=False):
+    max_workers = opts['core'].get('max_parallel', MAX_PARALLEL)
+    apps = [(ca.namespace, 'hlf-ca') for ca in topology.cas.values()]
+    for node in topology.nodes:
+        if node.node_type == 'peer':
+            apps.append((node.namespace, 'hlf-couchdb'))
+        apps.append((node.namespace, node.chart))
+    if topology.orderers and 'kafka' in opts['orderers']:
+        apps.append((topology.orderers[0].namespace, 'kafka'))
+    reads = [('releases', None)] + [('secrets', namespace) for namespace in topology.namespaces]
+    reads += [('configmaps', namespace) for namespace in topology.namespaces]
+    reads += [('pods', app) for app in OrderedDict.fromkeys(apps)]
+
+    def read(item):
+        kind, key = item
+        if kind == 'releases':
+            return helm_releases()
+        elif kind == 'secrets':
+            return secret_list(key, labels={})
+        elif kind == 'configmaps':
+            return cm_list(key)
+        return app_releases(*key)
+
+    results = parallel_map(read, reads, max_workers=max_workers)
+
+    def results_of(read_kind):
+        return {key: result for (kind, key), result in zip(reads, results) if kind == read_kind}
+
+    state = ClusterState(releases=results[0], secrets=results_of('secrets'), configmaps=results_of('configmaps'),
+                         pods=results_of('pods'), channels={})
+
+    def channels_read(peer):
+        return peer_channels(peer.namespace, peer.name, verbose=verbose)
+
+    peers = [peer for peer in topology.peers if release_installed(state, peer.namespace, peer.name, peer.chart)]
+    for peer, channels in zip(peers, parallel_map(channels_read, peers, max_workers=max_workers)):
+        state.channels[(peer.namespace, peer.name)] = channels
+    return state
+
+
+def plan_release(actions, state, kind, namespace, release, app, msp=None):
+    status = state.releases.get(release, {}).get('status')
+    if status is None:
+        reason = 'not installed'
+    elif status != 'DEPLOYED':
+        reason = 'release is {}'.format(status)
+    elif release not in state.pods.get((namespace, app), ()):
+        reason = 'no pods running'
+    else:
+        return
+    actions.append(Action('install', kind, release, namespace, msp, reason))
+
+
+def plan_artifact(actions, state, kind, namespace, secret, key, filename, msp=None):
+    if not path.exists(filename):
+        actions.append(Action('generate', kind, secret, namespace, msp, '{} is missing'.format(key)))
+    elif secret not in state.secrets.get(namespace, {}):
+        actions.append(Action('store', kind, secret, namespace, msp, 'secret is missing'))
+    elif not artifact_matches(state.secrets[namespace][secret], key, filename):
+        actions.append(Action('store', kind, secret, namespace, msp, 'secret differs from {}'.format(key)))
+
+
+# Secrets whose content hash differs from the one the local MSP of a node would give them
+def stale_secrets(dir_config, node, secrets):
+    msp_path = path.join(dir_config, '{}_MSP'.format(node.name))
+    if not path.isdir(msp_path):
+        # The node was enrolled elsewhere, so we can only check that its secrets exist
+        return []
+    stale = []
+    for name, data in msp_secret_data(msp_path, node.name, ID_CRYPTO).items():
+        annotations = secrets[name].metadata.annotations or {}
+        if annotations.get(HASH_ANNOTATION) != secret_body(data, name).metadata.annotations[HASH_ANNOTATION]:
+            stale.append(name)
+    return stale
+
+
+def plan_node(actions, state, node, dir_config):
+    secrets = state.secrets.get(node.namespace, {})
+    missing = [node.secrets[secret_type] for secret_type in REQUIRED_SECRETS
+               if node.secrets[secret_type] not in secrets]
+    if missing:
+        actions.append(Action('enroll', node.node_type, node.name, node.namespace, node.msp,
+                              'missing secrets {}'.format(', '.join(missing))))
+    else:
+        stale = stale_secrets(dir_config, node, secrets)
+        if stale:
+            actions.append(Action('enroll', node.node_type, node.name, node.namespace, node.msp,
+                                  'secrets {} differ from the local MSP'.format(', '.join(stale))))
+    if node.node_type == 'peer':
+        plan_release(actions, state, 'couchdb', node.namespace, 'cdb-' + node.name, 'hlf-couchdb', msp=node.msp)
+    plan_release(actions, state, node.node_type, node.namespace, node.name, node.chart, msp=node.msp)
+
+
+# Nodes that are not in the record of applied nodes, which "nephos scale" relies on
+def plan_record(actions, state, node_type, namespace, msp, names):
+    cm = state.configmaps.get(namespace, {}).get(STATE_CM)
+    applied = json.loads((cm.data or {}).get(state_key(msp, node_type), '[]')) if cm else []
+    unrecorded = [name for name in names if name not in applied]
+    if unrecorded:
+        actions.append(Action('record', node_type, STATE_CM, namespace, msp,
+                              '{} not recorded as applied'.format(', '.join(unrecorded))))
+
+
+# Smallest list of actions that brings the cluster in line with the settings, in the order they must run
+def plan_actions(opts, topology, state):
+    actions = []
+    dir_config = opts['core']['dir_config']
+    for ca in topology.cas.values():
+        plan_release(actions, state, 'ca', ca.namespace, ca.release, 'hlf-ca')
+    # Admin MSPs of the organisations running nodes
+    for msp in OrderedDict.fromkeys(topology.msps[node.msp] for node in topology.nodes):
+        secrets = state.secrets.get(msp.namespace, {})
+        missing = [name for name in (msp.admin_secret, 'hlf--{}-idcert'.format(msp.org_admin)) if name not in secrets]
+        keystore = path.join(dir_config, msp.name, 'keystore')
+        if missing:
+            actions.append(Action('enroll', 'admin', msp.name, msp.namespace, msp.name,
+                                  'missing secrets {}'.format(', '.join(missing))))
+        elif not path.isdir(keystore) or not listdir(keystore):
+            actions.append(Action('enroll', 'admin', msp.name, msp.namespace, msp.name, 'no local keystore'))
+    if topology.orderers:
+        ord_namespace = topology.orderers[0].namespace
+        plan_artifact(actions, state, 'genesis', ord_namespace, topology.genesis_secret, 'genesis.block',
+                      path.join(dir_config, 'genesis.block'), msp=topology.orderers[0].msp)
+        if 'kafka' in opts['orderers']:
+            plan_release(actions, state, 'kafka', ord_namespace, 'kafka-hlf', 'kafka', msp=topology.orderers[0].msp)
+    for node in topology.orderers:
+        plan_node(actions, state, node, dir_config)
+    for org in peer_orgs(opts):
+        peer_namespace = get_namespace(opts, org['msp'])
+        channel_file = '{}.tx'.format(org['channel_name'])
+        plan_artifact(actions, state, 'channel', peer_namespace, org['secret_channel'], channel_file,
+                      path.join(dir_config, channel_file), msp=org['msp'])
+        peers = [peer for peer in topology.peers if peer.msp == org['msp']]
+        for peer in peers:
+            plan_node(actions, state, peer, dir_config)
+        for peer in peers:
+            if org['channel_name'] not in state.channels.get((peer.namespace, peer.name), ()):
+                actions.append(Action('join', 'peer', peer.name, peer.namespace, peer.msp,
+                                      'not in channel {}'.format(org['channel_name'])))
+    # Nodes are recorded once everything else is applied
+    if topology.orderers:
+        plan_record(actions, state, 'orderer', topology.orderers[0].namespace, topology.orderers[0].msp,
+                    [node.name for node in topology.orderers])
+    for org in peer_orgs(opts):
+        plan_record(actions, state, 'peer', get_namespace(opts, org['msp']), org['msp'], org['names'])
+    return actions
+
+
+def print_plan(actions):
+    if not actions:
+        print('Nothing to do, the cluster matches the settings')
+        return
+    for action in actions:
+        print('{a.action} {a.kind} {a.name} in {a.namespace}: {a.reason}'.format(a=action))
+    print('{} actions to apply'.format(len(actions)))
+
+
+def plan_write(actions, filename):
+    with open(filename, 'w') as f:
+        json.dump([dict(action._asdict()) for action in actions], f, indent=4)
+
+
+def plan_read(filename):
+    with open(filename) as f:
+        return [Action(**item) for item in json.load(f)]
+
+
+# Names in the actions of a kind (and optionally of an organisation), in the order they were planned
+def planned(actions, verbs, kind, msp=None):
+    return [action.name for action in actions
+            if action.action in verbs and action.kind == kind and msp in (None, action.msp)]
+
+
+# Carry out exactly the planned actions, with each existing step restricted to the planned names
+def apply_plan(opts, actions, verbose=False):
+    cas = planned(actions, ('install',), 'ca')
+    if cas:
+        ca_view = copy.copy(opts)
+        ca_view['cas'] = OrderedDict((name, values) for name, values in opts['cas'].items() if name in cas)
+        setup_ca(ca_view, verbose=verbose)
+    admins = planned(actions, ('enroll',), 'admin')
+    if admins:
+        admin_msps(opts, admins, verbose=verbose)
+    if planned(actions, ('generate', 'store'), 'genesis'):
+        genesis_block(opts, verbose=verbose)
+    orderers = planned(actions, ('enroll',), 'orderer')
+    if orderers:
+        setup_nodes(nodes_opts(opts, 'orderer', orderers), 'orderer', verbose=verbose)
+    orderers = planned(actions, ('install',), 'orderer')
+    kafka = planned(actions, ('install',), 'kafka')
+    if orderers or kafka:
+        ord_view = nodes_opts(opts, 'orderer', orderers)
+        if kafka:
+            ord_view['orderers']['kafka'] = opts['orderers']['kafka']
+        setup_ord(ord_view, verbose=verbose)
+
+    def org_apply(org_view):
+        msp = org_view['peers']['msp']
+        if planned(actions, ('generate', 'store'), 'channel', msp):
+            channel_tx(org_view, verbose=verbose)
+        # A missing CouchDB is installed along with its peer, which is left as it is if already installed
+        couchdbs = [name[len('cdb-'):] for name in planned(actions, ('install',), 'couchdb', msp)]
+        # The channel already exists unless no peer of the organisation has joined it
+        joins = planned(actions, ('join',), 'peer', msp)
+        steps = ((planned(actions, ('enroll',), 'peer', msp), partial(setup_nodes, node_type='peer')),
+                 (list(OrderedDict.fromkeys(planned(actions, ('install',), 'peer', msp) + couchdbs)), setup_peer),
+                 (joins, partial(setup_channel, create=joins == org_view['peers']['names'])))
+        for peers, step in steps:
+            if peers:
+                step(nodes_opts(org_view, 'peer', peers), verbose=verbose)
+
+    if any(action.kind in ('channel', 'couchdb', 'peer') and action.action != 'record' for action in actions):
+        org_pipeline(opts, [org_apply])
+    for action in actions:
+        if action.action == 'record':
+            names = (opts['orderers']['names'] if action.kind == 'orderer' else
+                     next(org['names'] for org in peer_orgs(opts) if org['msp'] == action.msp))
+            record_applied(action.namespace, action.msp, action.kind, names, verbose=verbose)
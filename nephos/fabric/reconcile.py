@@ -0,0 +1,129 @@
+from __future__ import print_function
+
+from os import stat
+from threading import Event, Lock, Thread
+
+from nephos.fabric.plan import apply_plan, gather_state, plan_actions, print_plan
+from nephos.fabric.settings import load_config, parse_config
+from nephos.fabric.status import network_releases
+from nephos.fabric.utils import setup_namespaces
+from nephos.helpers.k8s import api, ingress_invalidate, objects_watch, pod_invalidate, pod_ready
+
+# Seconds we wait for a burst of changes to settle, so that it is repaired in a single pass
+DEBOUNCE = 2
+# Seconds between full reconciliations, which catch drift we are not told about (e.g. a peer leaving a channel)
+RESYNC = 300
+# Seconds between checks of the settings file
+SETTINGS_POLL = 1
+
+
+# Keep the cluster in line with the settings file, repairing drift as the cluster reports it
+class Reconciler:
+    def __init__(self, settings_file, resync=RESYNC, debounce=DEBOUNCE, verbose=False):
+        self.settings_file = settings_file
+        self.resync = resync
+        self.debounce = debounce
+        self.verbose = verbose
+        self.changed = Event()
+        self.stop = Event()
+        self.lock = Lock()
+        self.reasons = []
+        # Whether we run as a daemon, the namespaces we have set up, and the releases whose pods we care about
+        self.watching = False
+        self.namespaces = set()
+        self.releases = set()
+
+    def notify(self, reason):
+        with self.lock:
+            self.reasons.append(reason)
+        self.changed.set()
+
+    def on_secret(self, event_type, secret):
+        if event_type == 'DELETED':
+            self.notify('secret {} was deleted'.format(secret.metadata.name))
+
+    def on_pod(self, event_type, pod):
+        release = (pod.metadata.labels or {}).get('release')
+        if release not in self.releases:
+            return
+        if event_type == 'DELETED':
+            reason = 'pod {} of {} was deleted'.format(pod.metadata.name, release)
+        elif event_type == 'MODIFIED' and not pod.metadata.deletion_timestamp and not pod_ready(pod):
+            reason = 'pod {} of {} is not ready'.format(pod.metadata.name, release)
+        else:
+            return
+        # The repair must not exec into the pod we resolved before it went away
+        pod_invalidate(pod.metadata.namespace, release)
+        self.notify(reason)
+
+    def watch_namespaces(self, namespaces):
+        for namespace in namespaces:
+            objects_watch(api.list_namespaced_secret, namespace, self.on_secret, self.stop)
+            objects_watch(api.list_namespaced_pod, namespace, self.on_pod, self.stop)
+
+    def watch_settings(self):
+        modified = stat(self.settings_file).st_mtime_ns
+
+        def poll():
+            nonlocal modified
+            while not self.stop.wait(SETTINGS_POLL):
+                try:
+                    current = stat(self.settings_file).st_mtime_ns
+                except OSError:
+                    # The file may be briefly missing while an editor replaces it
+                    continue
+                if current != modified:
+                    modified = current
+                    self.notify('settings file changed')
+
+        thread = Thread(target=poll, daemon=True)
+        thread.start()
+        return thread
+
+    # Plan against the current settings and cluster, and carry out only the actions needed
+    def reconcile(self):
+        # Ingress hosts may have changed since the last pass, and we are not told about it
+        ingress_invalidate()
+        opts = load_config(self.settings_file)
+        _, topology = parse_config(self.settings_file)
+        new_namespaces = [namespace for namespace in topology.namespaces if namespace not in self.namespaces]
+        if new_namespaces:
+            setup_namespaces(opts, verbose=self.verbose)
+            if self.watching:
+                self.watch_namespaces(new_namespaces)
+            self.namespaces.update(new_namespaces)
+        self.releases = set(release.name for release in network_releases(opts, topology))
+        actions = plan_actions(opts, topology, gather_state(opts, topology, verbose=self.verbose))
+        if actions:
+            print_plan(actions)
+            apply_plan(opts, actions, verbose=self.verbose)
+        elif self.verbose:
+            print('Nothing to do, the cluster matches the settings')
+        return actions
+
+    # Take the changes reported since the last pass, after letting them settle
+    def next_reasons(self):
+        if self.changed.wait(self.resync):
+            self.stop.wait(self.debounce)
+        with self.lock:
+            reasons, self.reasons = self.reasons, []
+            self.changed.clear()
+        return reasons or ['periodic resync']
+
+    def shutdown(self):
+        self.stop.set()
+        self.changed.set()
+
+    def run(self):
+        self.watching = True
+        self.watch_settings()
+        while True:
+            try:
+                self.reconcile()
+            except Exception as error:
+                # A failed repair is retried on the next change or resync, rather than stopping the daemon
+                print('Reconciliation failed: {}'.format(error))
+            reasons = self.next_reasons()
+            if self.stop.is_set():
+                return
+            print('Reconciling, since {}'.format('; '.join(reasons)))
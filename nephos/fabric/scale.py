@@ -0,0 +1,95 @@
+import copy
+import json
+from threading import Lock
+
+from kubernetes.client.rest import ApiException
+
+from nephos.fabric.crypto import setup_nodes
+from nephos.fabric.ord import setup_ord
+from nephos.fabric.peer import setup_channel, setup_peer
+from nephos.fabric.settings import get_namespace
+from nephos.fabric.topology import NODE_CHARTS
+from nephos.helpers.k8s import app_releases, cm_read, cm_upsert, nephos_labels
+
+# ConfigMap of each namespace recording the nodes we have applied, in form {"<msp>.<node_type>s": JSON list}
+STATE_CM = 'nephos--applied'
+# Organisations sharing a namespace share its ConfigMap, so we update it under a lock
+STATE_LOCK = Lock()
+
+
+def state_key(msp, node_type):
+    return '{}.{}s'.format(msp, node_type)
+
+
+def state_read(namespace):
+    try:
+        return dict(cm_read(STATE_CM, namespace) or {})
+    except ApiException as error:
+        if error.status != 404:
+            raise
+        return {}
+
+
+def applied_nodes(namespace, msp, node_type):
+    return json.loads(state_read(namespace).get(state_key(msp, node_type), '[]'))
+
+
+def record_applied(namespace, msp, node_type, names, verbose=False):
+    with STATE_LOCK:
+        state = state_read(namespace)
+        state[state_key(msp, node_type)] = json.dumps(list(names))
+        cm_upsert(state, STATE_CM, namespace, labels=nephos_labels(msp=msp, type='state'), verbose=verbose)
+
+
+# Settings restricted to some of the nodes of a type (and without Kafka, which belongs to existing orderers)
+def nodes_opts(opts, node_type, names):
+    nodes = copy.copy(opts[node_type + 's'])
+    nodes['names'] = list(names)
+    nodes.pop('kafka', None)
+    view = copy.copy(opts)
+    view[node_type + 's'] = nodes
+    return view
+
+
+# Nodes in the settings that were neither applied before nor found in the cluster, in form (added, existing)
+def diff_nodes(opts, node_type, verbose=False):
+    nodes = opts[node_type + 's']
+    namespace = get_namespace(opts, nodes['msp'])
+    applied = applied_nodes(namespace, nodes['msp'], node_type)
+    deployed = app_releases(namespace, NODE_CHARTS[node_type])
+    added = [name for name in nodes['names'] if name not in applied and name not in deployed]
+    existing = [name for name in nodes['names'] if name not in added]
+    removed = [name for name in applied if name not in nodes['names']]
+    if removed:
+        print('{} are no longer in the settings, and are left untouched'.format(', '.join(removed)))
+    if verbose:
+        print('{} {}s: {} added, {} existing'.format(nodes['msp'], node_type, len(added), len(existing)))
+    return added, existing
+
+
+def scale_nodes(opts, node_type, setup_steps, verbose=False):
+    nodes = opts[node_type + 's']
+    added, existing = diff_nodes(opts, node_type, verbose=verbose)
+    if added:
+        view = nodes_opts(opts, node_type, added)
+        setup_nodes(view, node_type, verbose=verbose)
+        for setup_step in setup_steps:
+            setup_step(view, verbose=verbose)
+    else:
+        print('No new {}s for {}'.format(node_type, nodes['msp']))
+    record_applied(get_namespace(opts, nodes['msp']), nodes['msp'], node_type, nodes['names'], verbose=verbose)
+    return added
+
+
+# Enroll and install the new orderers only, concurrently
+def scale_orderers(opts, verbose=False):
+    return scale_nodes(opts, 'orderer', [setup_ord], verbose=verbose)
+
+
+# Enroll, install and join to the channel the new peers of an organisation only, concurrently
+def scale_peers(opts, verbose=False):
+    def channel_join(view, verbose=False):
+        # The channel already exists unless every peer of the organisation is new
+        setup_channel(view, create=view['peers']['names'] == opts['peers']['names'], verbose=verbose)
+
+    return scale_nodes(opts, 'peer', [setup_peer, channel_join], verbose=verbose)
@@ -1,22 +1,37 @@
 from collections import OrderedDict
-from os import path
+import copy
+import hashlib
+import json
+from os import O_CREAT, O_TRUNC, O_WRONLY, chmod, environ, fdopen, makedirs, open as os_open, path, replace, stat
+from threading import Lock
 
 import yaml
 
+from nephos.fabric.topology import compile_topology
 from nephos.helpers.k8s import context_get
+from nephos.helpers.throttle import configure_limiters
 
+# Parsed settings are kept on disk (keyed by the hash of the file), so that repeated CLI runs skip YAML parsing.
+# They hold passwords, so only the user may read them
+CACHE_DIR = environ.get('NEPHOS_CACHE_DIR', path.join(
+    environ.get('XDG_CACHE_HOME', path.join(path.expanduser('~'), '.cache')), 'nephos'))
 
-# YAML module will load data using an OrderedDict
-def dict_representer(dumper, data):
-    return dumper.represent_dict(data.iteritems())
+
+# Loader using libyaml when available, which loads mappings as an OrderedDict
+# (a subclass, so that other users of the yaml module are unaffected)
+class OrderedLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    pass
 
 
 def dict_constructor(loader, node):
     return OrderedDict(loader.construct_pairs(node))
 
 
-yaml.add_representer(OrderedDict, dict_representer)
-yaml.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
+OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
+
+
+def yaml_load(stream):
+    return yaml.load(stream, Loader=OrderedLoader)
 
 
 def check_cluster(cluster_name):
@@ -48,9 +63,83 @@ def get_namespace(opts, msp=None, ca=None):
     return opts['core']['namespace']
 
 
+# Peer organisations, whether "peers" is a single block or a list of blocks (one per organisation)
+def peer_orgs(opts):
+    peers = opts.get('peers')
+    if not peers:
+        return []
+    return list(peers) if isinstance(peers, list) else [peers]
+
+
+# Settings as seen by a single peer organisation, so that per-organisation steps keep reading opts['peers']
+def org_opts(opts, org):
+    org_view = copy.copy(opts)
+    org_view['peers'] = org
+    return org_view
+
+
+def cache_read(digest):
+    try:
+        with open(path.join(CACHE_DIR, digest + '.json')) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return None
+
+
+def cache_write(digest, data):
+    try:
+        content = json.dumps(data)
+        # Only settings that survive JSON unchanged are cached (e.g. not dates or non-string keys)
+        if json.loads(content, object_pairs_hook=OrderedDict) != data:
+            return
+        makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        # The directory may predate this, or makedirs may have been restricted by the umask
+        chmod(CACHE_DIR, 0o700)
+        cache_file = path.join(CACHE_DIR, digest + '.json')
+        with fdopen(os_open(cache_file + '.tmp', O_WRONLY | O_CREAT | O_TRUNC, 0o600), 'w') as f:
+            f.write(content)
+        chmod(cache_file + '.tmp', 0o600)
+        replace(cache_file + '.tmp', cache_file)
+    except (OSError, TypeError, ValueError):
+        # The cache is an optimisation, so we carry on without it
+        pass
+
+
+# Parsed and compiled settings, in form {settings_file: (modified, digest, data, topology)}
+CONFIG_CACHE = {}
+CONFIG_CACHE_LOCK = Lock()
+
+
+# Settings of a file and their compiled topology, parsed again only if the file content changes
+def parse_config(settings_file):
+    settings_file = path.abspath(settings_file)
+    file_stat = stat(settings_file)
+    modified = (file_stat.st_mtime_ns, file_stat.st_size)
+    with CONFIG_CACHE_LOCK:
+        cached = CONFIG_CACHE.get(settings_file)
+    if cached and cached[0] == modified:
+        digest, data, topology = cached[1:]
+    else:
+        with open(settings_file, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if cached and cached[1] == digest:
+            data, topology = cached[2:]
+        else:
+            data = cache_read(digest)
+            if data is None:
+                data = yaml_load(content)
+                cache_write(digest, data)
+            topology = compile_topology(data)
+        with CONFIG_CACHE_LOCK:
+            CONFIG_CACHE[settings_file] = (modified, digest, data, topology)
+    # Callers modify their settings, so they each get their own copy
+    return copy.deepcopy(data), topology
+
+
 def load_config(settings_file):
-    with open(settings_file) as f:
-        data = yaml.load(f)
+    # Invalid settings fail here, before touching the cluster
+    data, _ = parse_config(settings_file)
     if 'cluster' in data['core']:
         check_cluster(data['core']['cluster'])
     if path.isdir(data['core']['chart_repo']):
@@ -58,4 +147,5 @@ def load_config(settings_file):
         data['core']['chart_repo'] = path.abspath(path.expanduser(data['core']['chart_repo']))
     data['core']['dir_config'] = path.abspath(path.expanduser(data['core']['dir_config']))
     data['core']['dir_values'] = path.abspath(path.expanduser(data['core']['dir_values']))
+    configure_limiters(data['core'].get('rate_limits'))
     return data
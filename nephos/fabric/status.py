@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+from collections import namedtuple, OrderedDict
+import base64
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+import requests
+
+from nephos.fabric.ca import ca_ingress
+from nephos.fabric.ca_client import get_ca_client, split_pem
+from nephos.fabric.plan import peer_channels
+from nephos.fabric.settings import get_namespace, peer_orgs
+from nephos.helpers.helm import helm_releases
+from nephos.helpers.k8s import pod_ready, release_pods, secret_list
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map
+from nephos.helpers.throttle import PROBE
+
+# Release we report on, e.g. Release('couchdb', 'cdb-peer0', 'peers')
+Release = namedtuple('Release', ('kind', 'name', 'namespace'))
+
+# Columns of the status table, in form (field, header)
+COLUMNS = (('release', 'RELEASE'), ('kind', 'KIND'), ('namespace', 'NAMESPACE'), ('helm', 'HELM'),
+           ('ready', 'READY'), ('restarts', 'RESTARTS'), ('channels', 'CHANNELS'), ('ca', 'CA'),
+           ('expires', 'CERT EXPIRES'))
+
+
+def cert_expiry(pem_data):
+    cert = x509.load_pem_x509_certificate(split_pem(pem_data)[0], default_backend())
+    # Newer versions of cryptography deprecate not_valid_after in favour of not_valid_after_utc
+    not_after = cert.not_valid_after_utc if hasattr(cert, 'not_valid_after_utc') else cert.not_valid_after
+    return not_after.strftime('%Y-%m-%d')
+
+
+# Expiry of the identity certificate stored in a node's idcert secret (as listed from the cluster)
+def secret_cert_expiry(secret, key='cert.pem'):
+    data = (secret.data or {}).get(key) if secret else None
+    return cert_expiry(base64.b64decode(data)) if data else None
+
+
+# Whether the CA answers /cainfo through its ingress, and when its certificate expires
+def ca_probe(ca):
+    hosts = ca_ingress(ca.release, ca.namespace)
+    if not hosts:
+        return 'no ingress', None
+    try:
+        info = get_ca_client(hosts[0], tls_cert=ca.tls_cert).cainfo(priority=PROBE)
+    except (requests.RequestException, ValueError, KeyError):
+        return 'unreachable', None
+    chain = info.get('CAChain')
+    return 'reachable', cert_expiry(base64.b64decode(chain)) if chain else None
+
+
+# Every release of the network, in the order they are deployed
+def network_releases(opts, topology):
+    releases = [Release('ca', ca.release, ca.namespace) for ca in topology.cas.values()]
+    if topology.orderers and 'kafka' in opts['orderers']:
+        releases.append(Release('kafka', 'kafka-hlf', topology.orderers[0].namespace))
+    releases += [Release('orderer', node.name, node.namespace) for node in topology.orderers]
+    for peer in topology.peers:
+        releases += [Release('couchdb', 'cdb-' + peer.name, peer.namespace),
+                     Release('peer', peer.name, peer.namespace)]
+    if opts.get('composer') and peer_orgs(opts):
+        releases.append(Release('composer', opts['composer']['name'], get_namespace(opts, peer_orgs(opts)[0]['msp'])))
+    return releases
+
+
+# Status of each release, gathered with concurrent list calls and CA probes, then the channels of ready peers
+def gather_status(opts, topology, verbose=False):
+    max_workers = opts['core'].get('max_parallel', MAX_PARALLEL)
+    releases = network_releases(opts, topology)
+    namespaces = list(OrderedDict.fromkeys(release.namespace for release in releases))
+    reads = [('releases', None)] + [('pods', namespace) for namespace in namespaces]
+    reads += [('secrets', namespace) for namespace in OrderedDict.fromkeys(node.namespace for node in topology.nodes)]
+    reads += [('ca', ca) for ca in topology.cas.values()]
+
+    def read(item):
+        kind, key = item
+        if kind == 'releases':
+            return helm_releases()
+        elif kind == 'pods':
+            return release_pods(key)
+        elif kind == 'secrets':
+            return secret_list(key, labels={})
+        return ca_probe(key)
+
+    results = dict(zip(reads, parallel_map(read, reads, max_workers=max_workers)))
+    helm = results[('releases', None)]
+
+    def pods_of(release):
+        return results[('pods', release.namespace)].get(release.name, [])
+
+    def channels_read(release):
+        return peer_channels(release.namespace, release.name, verbose=verbose)
+
+    peers = [release for release in releases
+             if release.kind == 'peer' and any(pod_ready(pod) for pod in pods_of(release))]
+    channels = dict(zip(peers, parallel_map(channels_read, peers, max_workers=max_workers)))
+
+    rows = []
+    for release in releases:
+        pods = pods_of(release)
+        row = OrderedDict([
+            ('release', release.name), ('kind', release.kind), ('namespace', release.namespace),
+            ('helm', helm.get(release.name, {}).get('status', 'NOT INSTALLED')),
+            ('pods', len(pods)), ('ready', sum(1 for pod in pods if pod_ready(pod))),
+            ('restarts', sum(container.restart_count for pod in pods
+                             for container in pod.status.container_statuses or [])),
+            ('channels', sorted(channels[release]) if release in channels else None),
+            ('ca', None), ('expires', None)])
+        if release.kind == 'ca':
+            row['ca'], row['expires'] = results[('ca', topology.cas[release.name])]
+        elif release.kind in ('orderer', 'peer'):
+            secrets = results[('secrets', release.namespace)]
+            row['expires'] = secret_cert_expiry(secrets.get('hlf--{}-idcert'.format(release.name)))
+        rows.append(row)
+    return rows
+
+
+def status_cell(row, field):
+    if field == 'ready':
+        return '{}/{}'.format(row['ready'], row['pods'])
+    value = row[field]
+    if value is None:
+        return '-'
+    return ','.join(value) if isinstance(value, list) else str(value)
+
+
+def print_status(rows):
+    table = [[header for _, header in COLUMNS]] + [[status_cell(row, field) for field, _ in COLUMNS] for row in rows]
+    widths = [max(len(line[index]) for line in table) for index in range(len(COLUMNS))]
+    for line in table:
+        print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
@@ -0,0 +1,226 @@
+from collections import OrderedDict
+import re
+from types import MappingProxyType
+
+# Kubernetes namespaces and Helm releases must be DNS-1123 labels
+DNS_LABEL = re.compile(r'^[a-z0-9]([-a-z0-9]*[a-z0-9])?$')
+MAX_NAMESPACE = 63
+MAX_RELEASE = 53
+
+NODE_CHARTS = OrderedDict([('orderer', 'hlf-ord'), ('peer', 'hlf-peer')])
+# Secrets nephos creates for each node (the charts mount the CA certificates of the organisation admin)
+NODE_SECRETS = ('cred', 'idcert', 'idkey')
+
+
+class TopologyError(ValueError):
+    def __init__(self, errors):
+        # Every problem found in the settings, so that they can all be fixed at once
+        self.errors = errors
+        super(TopologyError, self).__init__('Invalid settings:\n' + '\n'.join(' - ' + error for error in errors))
+
+
+# Immutable record, whose fields are listed in __slots__
+class Model:
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            object.__setattr__(self, field, values[field])
+
+    def __setattr__(self, field, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __delattr__(self, field):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.name))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__))
+
+
+class CA(Model):
+    __slots__ = ('name', 'namespace', 'release', 'ingress', 'secret', 'tls_cert')
+
+
+class MSP(Model):
+    __slots__ = ('name', 'ca', 'namespace', 'org_admin', 'admin_secret')
+
+
+class Node(Model):
+    __slots__ = ('name', 'node_type', 'chart', 'msp', 'namespace', 'secrets', 'depends_on')
+
+
+class Channel(Model):
+    __slots__ = ('name', 'profile', 'secret', 'peers')
+
+
+class Topology(Model):
+    __slots__ = ('name', 'core_namespace', 'cas', 'msps', 'orderers', 'peers', 'channels', 'genesis_secret',
+                 'namespaces')
+
+    @property
+    def nodes(self):
+        return self.orderers + self.peers
+
+
+class Compiler:
+    def __init__(self, opts):
+        self.opts = opts
+        self.errors = []
+
+    def error(self, message, *args):
+        self.errors.append(message.format(*args))
+
+    def require(self, values, section, *keys):
+        for key in keys:
+            if values.get(key) in (None, ''):
+                self.error('"{}" is missing "{}"', section, key)
+
+    def check_label(self, name, what, max_length):
+        if not isinstance(name, str) or not DNS_LABEL.match(name) or len(name) > max_length:
+            self.error('{} "{}" must be a lowercase DNS label of at most {} characters', what, name, max_length)
+
+    def namespace(self, values, section):
+        namespace = values.get('namespace', (self.opts.get('core') or {}).get('namespace'))
+        if namespace is None:
+            self.error('"{}" has no namespace, and there is no core namespace', section)
+        else:
+            self.check_label(namespace, 'Namespace', MAX_NAMESPACE)
+        return namespace
+
+    def positive(self, values, section, *keys):
+        for key in keys:
+            if key in values and (not isinstance(values[key], int) or values[key] < 1):
+                self.error('"{}" has "{}" of {!r}, but it must be a positive integer', section, key, values[key])
+
+    def cas(self):
+        cas = OrderedDict()
+        for name, values in (self.opts.get('cas') or {}).items():
+            section = 'cas.' + name
+            self.check_label(name, 'CA release', MAX_RELEASE)
+            cas[name] = CA(name=name, namespace=self.namespace(values, section), release=name,
+                           ingress=name + '-hlf-ca', secret=name + '-hlf-ca', tls_cert=values.get('tls_cert'))
+        return MappingProxyType(cas)
+
+    def msps(self, cas):
+        msps = OrderedDict()
+        for name, values in (self.opts.get('msps') or {}).items():
+            section = 'msps.' + name
+            self.require(values, section, 'ca', 'org_admin')
+            if values.get('ca') and values['ca'] not in cas:
+                self.error('"{}" uses CA "{}", which is not in "cas"', section, values['ca'])
+            msps[name] = MSP(name=name, ca=values.get('ca'), namespace=self.namespace(values, section),
+                             org_admin=values.get('org_admin'),
+                             admin_secret='hlf--{}-admincred'.format(values.get('org_admin')))
+        return MappingProxyType(msps)
+
+    def nodes(self, node_type, values, section, msps, cas):
+        if not values:
+            return ()
+        self.require(values, section, 'msp', 'names')
+        self.positive(values, section, 'max_parallel', 'max_unavailable')
+        msp = msps.get(values.get('msp'))
+        if values.get('msp') and msp is None:
+            self.error('"{}" uses MSP "{}", which is not in "msps"', section, values['msp'])
+        names = values.get('names') or []
+        for name in set(name for name in names if names.count(name) > 1):
+            self.error('"{}" lists node "{}" more than once', section, name)
+        # Nodes need their CA for enrollment, peers need their CouchDB, and orderers need Kafka (if used)
+        depends_on = (cas[msp.ca].release,) if msp and msp.ca in cas else ()
+        if node_type == 'orderer' and 'kafka' in values:
+            depends_on += ('kafka-hlf',)
+        nodes = []
+        for name in names:
+            self.check_label(name, 'Node release', MAX_RELEASE)
+            secrets = OrderedDict((secret_type, 'hlf--{}-{}'.format(name, secret_type))
+                                  for secret_type in NODE_SECRETS)
+            nodes.append(Node(
+                name=name, node_type=node_type, chart=NODE_CHARTS[node_type], msp=values.get('msp'),
+                namespace=msp.namespace if msp else None, secrets=MappingProxyType(secrets),
+                depends_on=depends_on + (('cdb-' + name,) if node_type == 'peer' else ())))
+        return tuple(nodes)
+
+    # Peer organisations, given as a single "peers" block or as a list of blocks, in form [(section, values)]
+    def orgs(self):
+        peers = self.opts.get('peers')
+        if not peers:
+            return []
+        if not isinstance(peers, list):
+            return [('peers', peers)]
+        msp_names = [values.get('msp') for values in peers]
+        for msp_name in set(msp_name for msp_name in msp_names if msp_names.count(msp_name) > 1):
+            self.error('"peers" lists organisation "{}" more than once', msp_name)
+        return [('peers[{}]'.format(index), values) for index, values in enumerate(peers)]
+
+    def channels(self, orgs, peers):
+        # Several organisations may join the same channel
+        channels = OrderedDict()
+        for section, values in orgs:
+            self.require(values, section, 'channel_name', 'channel_profile', 'secret_channel')
+            name = values.get('channel_name')
+            org_peers = tuple(peer.name for peer in peers if peer.msp == values.get('msp'))
+            if name in channels:
+                org_peers = channels[name].peers + org_peers
+            channels[name] = Channel(name=name, profile=values.get('channel_profile'),
+                                     secret=values.get('secret_channel'), peers=org_peers)
+        return tuple(channels.values())
+
+    def composer(self, orgs, cas):
+        values = self.opts.get('composer')
+        if not values:
+            return
+        self.require(values, 'composer', 'name', 'secret_bna', 'secret_connection')
+        if not orgs:
+            self.error('"composer" needs a peer organisation')
+            return
+        # Composer is deployed with the first peer organisation
+        section, org = orgs[0]
+        peer_ca = org.get('ca')
+        if peer_ca is None:
+            self.error('"{}" is missing "ca", which Composer needs', section)
+        elif peer_ca not in cas:
+            self.error('"{}" uses CA "{}", which is not in "cas"', section, peer_ca)
+
+    def compile(self):
+        core = self.opts.get('core') or {}
+        self.require(core, 'core', 'chart_repo', 'dir_config', 'dir_values')
+        self.positive(core, 'core', 'max_parallel')
+        if core.get('namespace') is not None:
+            self.check_label(core['namespace'], 'Namespace', MAX_NAMESPACE)
+        cas = self.cas()
+        msps = self.msps(cas)
+        orderers = self.nodes('orderer', self.opts.get('orderers'), 'orderers', msps, cas)
+        orgs = self.orgs()
+        peers = tuple(peer for section, values in orgs for peer in self.nodes('peer', values, section, msps, cas))
+        # Helm 2 release names are cluster-wide, so CAs, nodes and CouchDBs must have unique names across namespaces
+        # (nodes listed twice in the same section are already reported above)
+        nodes = set((node.name, node.node_type, node.msp) for node in orderers + peers)
+        releases = [ca.release for ca in cas.values()] + [name for name, _, _ in nodes]
+        releases += ['cdb-' + name for name, node_type, _ in nodes if node_type == 'peer']
+        for name in sorted(set(release for release in releases if releases.count(release) > 1)):
+            self.error('Release "{}" is defined more than once, but Helm release names are cluster-wide', name)
+        if orderers:
+            self.require(self.opts['orderers'], 'orderers', 'secret_genesis')
+        channels = self.channels(orgs, peers)
+        self.composer(orgs, cas)
+        if self.errors:
+            raise TopologyError(self.errors)
+        namespaces = [core['namespace']] if core.get('namespace') else []
+        namespaces += [msp.namespace for msp in msps.values()] + [ca.namespace for ca in cas.values()]
+        return Topology(
+            name=core.get('cluster'), core_namespace=core.get('namespace'), cas=cas, msps=msps,
+            orderers=orderers, peers=peers, channels=channels,
+            genesis_secret=(self.opts.get('orderers') or {}).get('secret_genesis'),
+            namespaces=tuple(OrderedDict.fromkeys(namespaces)))
+
+
+# Validate the settings, and compile them into an immutable topology with precomputed names
+def compile_topology(opts):
+    return Compiler(opts).compile()
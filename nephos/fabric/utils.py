@@ -1,12 +1,13 @@
-from glob import glob
-from os import path
+from collections import OrderedDict
 import random
 from string import ascii_letters, digits
 
 from kubernetes.client.rest import ApiException
 
-from nephos.helpers.k8s import Executer, secret_create, secret_from_file, secret_read
-from nephos.helpers.misc import execute
+from nephos.fabric.settings import org_opts, peer_orgs
+from nephos.fabric.topology import compile_topology
+from nephos.helpers.k8s import Executer, ns_create, pod_resolve, secret_create, secret_read
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map, parallel_pipeline
 
 
 # TODO: Possibly hide this function?
@@ -14,7 +15,7 @@ def rand_string(length):
     return ''.join(random.choice(ascii_letters + digits) for _ in range(length))
 
 
-def credentials_secret(secret_name, namespace, username, password=None, verbose=False):
+def credentials_secret(secret_name, namespace, username, password=None, labels=None, verbose=False):
     try:
         secret_data = secret_read(secret_name, namespace, verbose=verbose)
         # Check that the ID stored is the same as Orderer name
@@ -29,27 +30,34 @@ def credentials_secret(secret_name, namespace, username, password=None, verbose=
             'CA_USERNAME': username,
             'CA_PASSWORD': password
         }
-        secret_create(secret_data, secret_name, namespace)
+        secret_create(secret_data, secret_name, namespace, labels=labels)
     return secret_data
 
 
-def crypto_secret(secret_name, namespace, file_path, key, verbose=False):
-    secret_files = glob(path.join(file_path, '*'))
-    if len(secret_files) != 1:
-        raise Exception('We should only find one file in this directory')
-    secret_from_file(secret=secret_name, namespace=namespace,
-                     key=key, filename=secret_files[0], verbose=verbose)
-
-
 def get_pod(namespace, release, app, verbose=False):
-    node_pod = execute(
-        ('kubectl get pods -n {ns} -l "app={app},release={release}" ' +
-         '-o jsonpath="{{.items[0].metadata.name}}"').format(
-            ns=namespace,
-            app=app,
-            release=release
-        ), verbose=verbose)
-    if not node_pod:
-        raise ValueError('"node_pod" should contain a value')
+    node_pod = pod_resolve(namespace, release, app, verbose=verbose)
     pod_ex = Executer(node_pod, namespace=namespace, verbose=verbose)
     return pod_ex
+
+
+# Create every namespace of the network up front, so later phases never race to create them
+def setup_namespaces(opts, verbose=False):
+    def namespace_create(namespace):
+        return ns_create(namespace, verbose=verbose)
+
+    namespaces = list(compile_topology(opts).namespaces)
+    parallel_map(namespace_create, namespaces, max_workers=opts['core'].get('max_parallel', MAX_PARALLEL))
+    return namespaces
+
+
+# Run each peer organisation (named by its MSP) through the stages, each stage taking the settings of one
+# organisation, so that organisations progress concurrently and independently of each other
+def org_pipeline(opts, stages):
+    orgs = OrderedDict((org['msp'], org_opts(opts, org)) for org in peer_orgs(opts))
+
+    def org_stage(stage):
+        return lambda msp: stage(orgs[msp])
+
+    parallel_pipeline([org_stage(stage) for stage in stages], list(orgs),
+                      max_workers=opts['core'].get('max_parallel', MAX_PARALLEL))
+    return list(orgs)
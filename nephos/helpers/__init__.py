@@ -1,3 +1,3 @@
-from . import helm, k8s, misc
+from . import artifacts, helm, k8s, misc, parallel, throttle
 
-__all__ = ['helm', 'k8s', 'misc']
+__all__ = ['artifacts', 'helm', 'k8s', 'misc', 'parallel', 'throttle']
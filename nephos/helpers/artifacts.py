@@ -0,0 +1,27 @@
+from __future__ import print_function
+
+import base64
+from os import path
+
+from nephos.helpers.k8s import secret_from_file
+
+# Largest file we can store as a secret (K8S caps the decoded data of a secret at 1 MiB)
+MAX_SECRET_BYTES = 1024 * 1024
+
+
+# Store a file in a secret, which the Helm charts mount directly
+def artifact_store(secret, namespace, key, filename, labels=None, max_bytes=MAX_SECRET_BYTES, verbose=False):
+    size = path.getsize(filename)
+    if size > max_bytes:
+        raise ValueError('{} is {} bytes, over the {} bytes a secret can hold, so secret {} cannot be created'.format(
+            key, size, max_bytes, secret))
+    secret_from_file(secret=secret, namespace=namespace, key=key, filename=filename, labels=labels, verbose=verbose)
+
+
+# Whether a secret (as listed from the cluster) holds the current content of a file saved with artifact_store
+def artifact_matches(secret, key, filename):
+    secret_data = secret.data or {}
+    if key not in secret_data:
+        return False
+    with open(filename, 'rb') as f:
+        return base64.b64decode(secret_data[key]) == f.read()
@@ -1,13 +1,15 @@
 from __future__ import print_function
 
 from collections import namedtuple
+import json
 from os import path
 from time import sleep
 
 from blessings import Terminal
 
-from nephos.helpers.k8s import secret_read
+from nephos.helpers.k8s import ingress_invalidate, pod_invalidate, secret_read
 from nephos.helpers.misc import execute
+from nephos.helpers.throttle import PROBE, throttle
 
 t = Terminal()
 
@@ -25,11 +27,14 @@ def helm_check(app, name, namespace, pod_num=None):
     first_pass = True
     while not running:
         # TODO: Best to generate a function that checks app state
+        # Readiness checks use the probe lane, so they are not starved by bulk writes
+        throttle('k8s', PROBE)
         states_list = execute(
             'kubectl get pods -n {ns} -l "app={app},release={name}" -o jsonpath="{{.items[*].status.phase}}"'.format(
                 app=app, name=name, ns=namespace
             ), show_command=first_pass).split()
         # Let us also check the number of pods we have
+        throttle('k8s', PROBE)
         pod_list = execute(
             'kubectl get pods -n {ns} -l "app={app},release={name}" -o jsonpath="{{.items[*].metadata.name}}"'.format(
                 app=app, name=name, ns=namespace
@@ -71,6 +76,28 @@ def helm_init():
                 sleep(15)
 
 
+# Every release known to Helm, page by page, in form {release: {'chart':..., 'namespace':..., 'status':...}}
+def helm_releases(page_size=256):
+    releases = {}
+    offset = None
+    while True:
+        throttle('helm')
+        command = 'helm list --all --output json --max {}'.format(page_size)
+        if offset:
+            command += ' --offset {}'.format(offset)
+        res = execute(command, show_command=offset is None)
+        if res is None:
+            raise ValueError('Could not list Helm releases')
+        # Helm prints nothing at all when there are no releases
+        page = json.loads(res) if res.strip() else {}
+        for release in page.get('Releases') or []:
+            releases[release['Name']] = {'chart': release['Chart'], 'namespace': release['Namespace'],
+                                         'status': release['Status']}
+        offset = page.get('Next')
+        if not offset:
+            return releases
+
+
 def helm_env_vars(namespace, env_vars, preserve=None, verbose=False):
     if not env_vars:
         env_vars = []
@@ -104,6 +131,7 @@ def helm_env_vars(namespace, env_vars, preserve=None, verbose=False):
 
 # General function to check if a release exists and install it
 def helm_install(repo, app, release, namespace, config_yaml=None, env_vars=None, verbose=False, pod_num=1):
+    throttle('helm')
     ls_res = execute('helm status {release}'.format(
         release=release
     ))
@@ -119,11 +147,15 @@ def helm_install(repo, app, release, namespace, config_yaml=None, env_vars=None,
             command += ' -f {}'.format(config_yaml)
         command += env_vars_string
         # Execute
+        throttle('helm')
         execute(command, verbose=verbose)
     helm_check(app, release, namespace, pod_num)
+    pod_invalidate(namespace, release)
+    ingress_invalidate(namespace, release)
 
 
 def helm_upgrade(repo, app, release, namespace, config_yaml=None, env_vars=None, preserve=None, verbose=False, pod_num=1):
+    throttle('helm')
     ls_res = execute('helm status {release}'.format(
         release=release
     ))
@@ -139,7 +171,11 @@ def helm_upgrade(repo, app, release, namespace, config_yaml=None, env_vars=None,
             command += ' -f {}'.format(config_yaml)
         command += env_vars_string
         # Execute
+        throttle('helm')
         execute(command, verbose=verbose)
     else:
         raise Exception('Cannot update a Helm release that is not running')
     helm_check(app, release, namespace, pod_num)
+    # Pods (and possibly ingresses) of the release are replaced by the upgrade
+    pod_invalidate(namespace, release)
+    ingress_invalidate(namespace, release)
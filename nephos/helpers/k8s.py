@@ -1,21 +1,55 @@
 from __future__ import print_function
 
 import base64
+from collections import namedtuple
+from concurrent.futures import Future
+import copy
+import hashlib
 import json
+from os import path
+import re
+from subprocess import PIPE, Popen
+import tarfile
+from threading import Lock, Thread
+import uuid
 
 from blessings import Terminal
-from kubernetes import client, config
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
 
 from nephos.helpers.misc import execute, input_files, pretty_print
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map
+from nephos.helpers.throttle import ThrottledApi, throttle
 
 TERM = Terminal()
 
+# Outcome of each command run by Executer.batch
+BatchResult = namedtuple('BatchResult', ('command', 'exit_code', 'output'))
+
+
+# Reads ingresses from networking.k8s.io/v1, for clients that predate it (e.g. kubernetes==8.0.0)
+class NetworkingIngressApi:
+    def __init__(self, api_client=None):
+        self.api_client = api_client or client.ApiClient()
+
+    # Returns the ingress as a dict, since the client has no model for v1 backends
+    def read_namespaced_ingress(self, name, namespace):
+        return self.api_client.call_api(
+            '/apis/networking.k8s.io/v1/namespaces/{namespace}/ingresses/{name}', 'GET',
+            path_params={'name': name, 'namespace': namespace}, header_params={'Accept': 'application/json'},
+            response_type='object', auth_settings=['BearerToken'], _return_http_data_only=True)
+
 
 # Configs can be set in Configuration class directly or using helper utility
 config.load_kube_config()
-api = client.CoreV1Api()
-api_ext = client.ExtensionsV1beta1Api()
+api = ThrottledApi(client.CoreV1Api())
+# Ingresses moved from extensions/v1beta1 to networking.k8s.io/v1, and newer clients lack the former
+api_ext = ThrottledApi(client.ExtensionsV1beta1Api()) if hasattr(client, 'ExtensionsV1beta1Api') else None
+if hasattr(getattr(client, 'NetworkingV1Api', None), 'read_namespaced_ingress'):
+    api_net = ThrottledApi(client.NetworkingV1Api())
+else:
+    api_net = ThrottledApi(NetworkingIngressApi())
 
 
 # Class to execute K8S commands
@@ -25,6 +59,8 @@ class Executer:
         if container:
             extra += "--container {} ".format(container)
         self.pod = pod
+        self.namespace = namespace
+        self.container = container
         self.prefix_exec = "kubectl exec {pod} -n {namespace} {extra}-- ".format(
             pod=pod, namespace=namespace, extra=extra)
         self.prefix_logs = "kubectl logs {pod} -n {namespace} {extra}".format(
@@ -33,13 +69,93 @@ class Executer:
 
     # TODO: api.connect_get_namespaced_pod_exec (to do exec using Python API programmatically)
     def execute(self, command):
+        throttle('exec')
         result = execute(
             self.prefix_exec + command,
             verbose=self.verbose
         )
         return result
 
+    # Arguments to run a command in the pod without a shell, so that we can stream its input/output
+    def exec_args(self, command, stdin=False):
+        args = ['kubectl', 'exec'] + (['-i'] if stdin else []) + [self.pod, '-n', self.namespace]
+        if self.container:
+            args += ['--container', self.container]
+        return args + ['--'] + command
+
+    # Copy a remote file or folder into a local folder, streamed as a tar archive over a single exec
+    def download(self, remote_path, local_dir):
+        throttle('exec')
+        remote_dir, remote_name = path.split(remote_path.rstrip('/'))
+        process = Popen(self.exec_args(['tar', 'cf', '-', '-C', remote_dir or '/', remote_name]),
+                        stdout=PIPE, stderr=PIPE)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+                # Only regular files and folders, and nothing outside local_dir
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(local_dir, filter='data')
+                else:
+                    archive.extractall(local_dir)
+        except tarfile.ReadError:
+            # An unreadable archive usually means the remote command failed, which wait reports
+            self.wait(process, 'download {}'.format(remote_path))
+            raise
+        self.wait(process, 'download {}'.format(remote_path))
+        return path.join(local_dir, remote_name)
+
+    # Copy a local file or folder into a remote folder, streamed as a tar archive over a single exec
+    def upload(self, local_path, remote_dir):
+        throttle('exec')
+        process = Popen(self.exec_args(['tar', 'xf', '-', '-C', remote_dir], stdin=True),
+                        stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        try:
+            with tarfile.open(fileobj=process.stdin, mode='w|') as archive:
+                archive.add(local_path, arcname=path.basename(local_path.rstrip('/')))
+            process.stdin.close()
+        except BrokenPipeError:
+            # The remote command exited early, which wait reports
+            pass
+        self.wait(process, 'upload {}'.format(local_path))
+        return path.join(remote_dir, path.basename(local_path.rstrip('/')))
+
+    def wait(self, process, action):
+        error = process.stderr.read()
+        if process.wait() != 0:
+            raise ValueError('Could not {} in pod {}: {}'.format(action, self.pod, error.decode('utf-8', 'ignore')))
+        if self.verbose:
+            print('Completed {} in pod {}'.format(action, self.pod))
+
+    # Run a sequence of commands in a single exec session, returning a BatchResult for each command run
+    # (with stop_on_error, the commands after the first failing one are not run)
+    def batch(self, commands, stop_on_error=True):
+        throttle('exec')
+        # The marker separates the output of each command from its exit code
+        marker = 'nephos-batch-{}'.format(uuid.uuid4().hex)
+        script = ''
+        for command in commands:
+            # Each command runs in its own subshell, and cannot consume the rest of the script from stdin
+            script += '( {} ) < /dev/null 2>&1; status=$?; printf "\\n{} %s\\n" $status\n'.format(command, marker)
+            if stop_on_error:
+                script += '[ $status -eq 0 ] || exit 0\n'
+        print(TERM.magenta(self.prefix_exec + 'sh -s <<\n' + '\n'.join('  ' + command for command in commands)))
+        process = Popen(self.exec_args(['sh', '-s'], stdin=True), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate(script.encode('utf-8'))
+        # Output is in form [output, exit_code, output, exit_code, ..., trailing]
+        parts = re.split('\n{} (\\d+)\n'.format(marker), stdout.decode('utf-8', 'replace'))
+        results = [BatchResult(command, int(exit_code), output)
+                   for command, output, exit_code in zip(commands, parts[0::2], parts[1::2])]
+        if not results and process.returncode != 0:
+            raise ValueError('Could not run batch in pod {}: {}'.format(self.pod, stderr.decode('utf-8', 'ignore')))
+        for result in results:
+            if result.exit_code != 0:
+                print(TERM.red('Command "{}" failed with exit code {}:'.format(result.command, result.exit_code)))
+                print(result.output)
+            elif self.verbose:
+                print(result.output)
+        return results
+
     def logs(self, tail=-1):
+        throttle('exec')
         result = execute(
             self.prefix_logs + '--tail={}'.format(tail),
             verbose=self.verbose
@@ -47,6 +163,30 @@ class Executer:
         return result
 
 
+# Reads currently in flight, in form {(kind, namespace, name): Future}
+IN_FLIGHT = {}
+IN_FLIGHT_LOCK = Lock()
+
+
+# Concurrent callers reading the same object share a single request (and its result or error)
+def coalesce(kind, namespace, name, read):
+    key = (kind, namespace, name)
+    with IN_FLIGHT_LOCK:
+        future = IN_FLIGHT.get(key)
+        leader = future is None
+        if leader:
+            future = IN_FLIGHT[key] = Future()
+    if leader:
+        try:
+            future.set_result(read())
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with IN_FLIGHT_LOCK:
+                del IN_FLIGHT[key]
+    return future.result()
+
+
 # Config
 def context_get(verbose=False):
     contexts, active_context = config.list_kube_config_contexts()
@@ -57,52 +197,225 @@ def context_get(verbose=False):
 
 # Namespaces
 def ns_create(namespace, verbose=False):
+    ns = client.V1Namespace()
+    ns.metadata = client.V1ObjectMeta(name=namespace)
     try:
-        ns_read(namespace, verbose=verbose)
-    except ApiException:
-        ns = client.V1Namespace()
-        ns.metadata = client.V1ObjectMeta(name=namespace)
         api.create_namespace(ns)
-        if verbose:
-            print(TERM.green('Created namespace "{}"'.format(namespace)))
-            pretty_print(json.dumps(ns.metadata, default=str))
+    except ApiException as error:
+        # A conflict means the namespace already exists (possibly created concurrently)
+        if error.status == 409:
+            return False
+        # Users scoped to their namespaces may not create namespaces, yet can read the ones they use
+        if error.status == 403:
+            try:
+                ns_read(namespace)
+            except ApiException:
+                raise error
+            return False
+        raise
+    if verbose:
+        print(TERM.green('Created namespace "{}"'.format(namespace)))
+        pretty_print(json.dumps(ns.metadata, default=str))
+    return True
 
 
 def ns_read(namespace, verbose=False):
-    ns = api.read_namespace(name=namespace)
+    # Callers get their own copy of the shared result
+    ns = copy.deepcopy(coalesce('namespace', None, namespace, lambda: api.read_namespace(name=namespace)))
     if verbose:
         pretty_print(json.dumps(ns.metadata, default=str))
     return ns
 
 
+# Pods
+# Names of resolved pods, in form {(namespace, app, release): pod_name}
+POD_CACHE = {}
+POD_CACHE_LOCK = Lock()
+
+
+def pod_ready(pod):
+    if pod.metadata.deletion_timestamp or pod.status.phase != 'Running':
+        return False
+    return any(condition.type == 'Ready' and condition.status == 'True'
+               for condition in pod.status.conditions or [])
+
+
+# Find the pod of a release, preferring pods that are Ready and not terminating
+def pod_resolve(namespace, release, app, verbose=False):
+    key = (namespace, app, release)
+    with POD_CACHE_LOCK:
+        if key in POD_CACHE:
+            return POD_CACHE[key]
+    pods = api.list_namespaced_pod(namespace=namespace,
+                                   label_selector=label_selector({'app': app, 'release': release})).items
+    live_pods = [pod for pod in pods if not pod.metadata.deletion_timestamp]
+    ready_pods = [pod for pod in live_pods if pod_ready(pod)]
+    if not live_pods:
+        raise ValueError('No pod found for release "{}" of app "{}" in namespace "{}"'.format(
+            release, app, namespace))
+    pod_name = (ready_pods or live_pods)[0].metadata.name
+    if verbose:
+        print('Resolved pod {} for release {}'.format(pod_name, release))
+    # Only Ready pods are cached, so we look again for pods that are still starting
+    if ready_pods:
+        with POD_CACHE_LOCK:
+            POD_CACHE[key] = pod_name
+    return pod_name
+
+
+# Forget resolved pods, e.g. after a release is installed or upgraded
+def pod_invalidate(namespace=None, release=None):
+    with POD_CACHE_LOCK:
+        for key in list(POD_CACHE):
+            if namespace in (None, key[0]) and release in (None, key[2]):
+                del POD_CACHE[key]
+
+
+# Live pods of a namespace, grouped by the Helm release that created them, in form {release: [pod]}
+def release_pods(namespace):
+    releases = {}
+    for pod in objects_index(api.list_namespaced_pod, namespace, {}).values():
+        release = (pod.metadata.labels or {}).get('release')
+        if release and not pod.metadata.deletion_timestamp:
+            releases.setdefault(release, []).append(pod)
+    return releases
+
+
+# Releases of an app with pods in a namespace, including pods that are still starting
+def app_releases(namespace, app):
+    pods = objects_index(api.list_namespaced_pod, namespace, {'app': app})
+    return set(pod.metadata.labels['release'] for pod in pods.values()
+               if not pod.metadata.deletion_timestamp and 'release' in (pod.metadata.labels or {}))
+
+
 # Ingress
-def ingress_read(name, namespace='default', verbose=False):
-    ingress = api_ext.read_namespaced_ingress(name=name, namespace=namespace)
-    hosts = [item.host for item in ingress.spec.rules]
+# Hosts of ingresses, in form {(namespace, name): hosts}
+INGRESS_CACHE = {}
+INGRESS_CACHE_LOCK = Lock()
+
+
+# APIs able to serve an ingress method, starting with extensions/v1beta1 for older clusters
+def ingress_apis(method):
+    apis = [ingress_api for ingress_api in (api_ext, api_net) if hasattr(ingress_api, method)]
+    if not apis:
+        raise NotImplementedError('Kubernetes client does not provide {} for ingresses'.format(method))
+    return apis
+
+
+def ingress_call(method, **kwargs):
+    apis = ingress_apis(method)
+    for ingress_api in apis[:-1]:
+        try:
+            return getattr(ingress_api, method)(**kwargs)
+        except ApiException as error:
+            # A 404 may mean the cluster does not serve this API group, so we try the next one
+            if error.status != 404:
+                raise
+    return getattr(apis[-1], method)(**kwargs)
+
+
+def ingress_hosts(ingress):
+    if isinstance(ingress, dict):
+        # Read by NetworkingIngressApi
+        return [item['host'] for item in ingress['spec']['rules']]
+    return [item.host for item in ingress.spec.rules]
+
+
+def ingress_read(name, namespace='default', refresh=False, verbose=False):
+    key = (namespace, name)
+    with INGRESS_CACHE_LOCK:
+        hosts = None if refresh else INGRESS_CACHE.get(key)
+    if hosts is None:
+        hosts = coalesce('ingress', namespace, name, lambda: ingress_hosts(
+            ingress_call('read_namespaced_ingress', name=name, namespace=namespace)))
+        with INGRESS_CACHE_LOCK:
+            INGRESS_CACHE[key] = hosts
     if verbose:
         pretty_print(json.dumps(hosts))
-    return hosts
+    return list(hosts)
+
+
+# Forget cached ingresses, e.g. after a release is installed or upgraded
+def ingress_invalidate(namespace=None, release=None):
+    with INGRESS_CACHE_LOCK:
+        for key in list(INGRESS_CACHE):
+            if namespace in (None, key[0]) and (release is None or key[1].startswith(release)):
+                del INGRESS_CACHE[key]
+
+
+# Call on_event(event_type, object) for every change to the objects of a list function in a namespace,
+# watching again whenever the stream times out or fails, until stop is set
+def objects_watch(list_function, namespace, on_event, stop, timeout_seconds=300, retry_delay=5):
+    def watch_loop():
+        while not stop.is_set():
+            try:
+                for event in watch.Watch().stream(list_function, namespace=namespace,
+                                                  timeout_seconds=timeout_seconds):
+                    on_event(event['type'], event['object'])
+                    if stop.is_set():
+                        return
+            except ApiException as error:
+                print('Watch in namespace {} failed, retrying: {}'.format(namespace, error.reason))
+                stop.wait(retry_delay)
+            except HTTPError as error:
+                # Dropped connections and unreachable API servers surface as urllib3 errors
+                print('Watch in namespace {} lost its connection, retrying: {}'.format(namespace, error))
+                stop.wait(retry_delay)
+
+    thread = Thread(target=watch_loop, daemon=True)
+    thread.start()
+    return thread
 
 
 # Configmaps and secrets
-# TODO: Refactor these so we have the same API as with secrets
-def cm_create(namespace, name, cm_data):
-    # TODO: We should check that CM exists before we create it
-    # TODO: We should add verbose option
-    cm = client.V1ConfigMap()
-    cm.metadata = client.V1ObjectMeta(name=name)
-    cm.data = cm_data
-    api.create_namespaced_config_map(namespace=namespace, body=cm)
+# Annotation holding a hash of the object data, so we can skip writing unchanged objects
+HASH_ANNOTATION = 'nephos/content-hash'
+# Labels identifying objects created by nephos, so we can list them in bulk
+MANAGED_LABELS = {'app.kubernetes.io/managed-by': 'nephos'}
+# Page size when listing objects
+LIST_LIMIT = 250
 
 
-def cm_read(name, namespace, verbose=False):
-    cm = api.read_namespaced_config_map(name=name, namespace=namespace)
-    if verbose:
-        pretty_print(json.dumps(cm.data))
-    return cm.data
+def label_selector(labels):
+    return ','.join('{}={}'.format(key, value) for key, value in sorted(labels.items()))
+
+
+# Labels describing what a nephos object is (e.g. msp="PeerMSP", node="peer0", type="idcert")
+def nephos_labels(**labels):
+    return {'nephos/' + key: value for key, value in labels.items() if value}
+
+
+# List objects by label, page by page, indexing them by name
+def objects_index(list_function, namespace, labels=MANAGED_LABELS, limit=LIST_LIMIT):
+    index = {}
+    continue_token = None
+    while True:
+        kwargs = {'_continue': continue_token} if continue_token else {}
+        objects = list_function(namespace=namespace, label_selector=label_selector(labels), limit=limit, **kwargs)
+        for item in objects.items:
+            index[item.metadata.name] = item
+        continue_token = objects.metadata._continue
+        if not continue_token:
+            return index
+
+
+def content_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def object_meta(name, data, labels=None):
+    return client.V1ObjectMeta(name=name, labels=dict(MANAGED_LABELS, **(labels or {})),
+                               annotations={HASH_ANNOTATION: content_hash(data)})
 
 
-def secret_create(secret_data, name, namespace, verbose=False):
+def cm_body(cm_data, name, labels=None):
+    cm = client.V1ConfigMap()
+    cm.metadata = object_meta(name, cm_data, labels)
+    cm.data = cm_data
+    return cm
+
+
+def secret_body(secret_data, name, labels=None):
     # Encode the data in a copy of the input dictionary
     secret_data = secret_data.copy()
     for key, value in secret_data.items():
@@ -110,36 +423,131 @@ def secret_create(secret_data, name, namespace, verbose=False):
             value = value.encode('ascii')
         secret_data[key] = base64.b64encode(value).decode('utf-8')
     secret = client.V1Secret()
-    secret.metadata = client.V1ObjectMeta(name=name)
+    secret.metadata = object_meta(name, secret_data, labels)
     secret.type = "Opaque"
     secret.data = secret_data
-    api.create_namespaced_secret(namespace=namespace, body=secret)
+    return secret
+
+
+# Create object, or replace it if it exists and its content has changed
+def upsert(create, read, replace, body, namespace, verbose=False):
+    name = body.metadata.name
+    try:
+        create(namespace=namespace, body=body)
+        return 'created'
+    except ApiException as error:
+        if error.status != 409:
+            raise
+    current = read(name=name, namespace=namespace)
+    annotations = current.metadata.annotations or {}
+    if annotations.get(HASH_ANNOTATION) == body.metadata.annotations[HASH_ANNOTATION]:
+        if verbose:
+            print('{} in namespace {} is unchanged'.format(name, namespace))
+        return 'unchanged'
+    body.metadata.resource_version = current.metadata.resource_version
+    replace(name=name, namespace=namespace, body=body)
+    return 'updated'
+
+
+def cm_upsert(cm_data, name, namespace, labels=None, verbose=False):
+    result = upsert(api.create_namespaced_config_map, api.read_namespaced_config_map,
+                    api.replace_namespaced_config_map,
+                    cm_body(cm_data, name, labels), namespace, verbose=verbose)
+    if verbose and result != 'unchanged':
+        print('{} configmap {} in namespace {}'.format(result.capitalize(), name, namespace))
+    return result
+
+
+def cm_list(namespace, labels=MANAGED_LABELS):
+    return objects_index(api.list_namespaced_config_map, namespace, labels)
+
+
+def cm_read(name, namespace, verbose=False):
+    cm = api.read_namespaced_config_map(name=name, namespace=namespace)
+    if verbose:
+        pretty_print(json.dumps(cm.data))
+    return cm.data
+
+
+def secret_create(secret_data, name, namespace, labels=None, verbose=False):
+    api.create_namespaced_secret(namespace=namespace, body=secret_body(secret_data, name, labels))
     if verbose:
         print('Created secret {} in namespace {}'.format(name, namespace))
 
 
+def secret_upsert(secret_data, name, namespace, labels=None, verbose=False):
+    result = upsert(api.create_namespaced_secret, api.read_namespaced_secret, api.replace_namespaced_secret,
+                    secret_body(secret_data, name, labels), namespace, verbose=verbose)
+    if verbose and result != 'unchanged':
+        print('{} secret {} in namespace {}'.format(result.capitalize(), name, namespace))
+    return result
+
+
+def secret_list(namespace, labels=MANAGED_LABELS):
+    return objects_index(api.list_namespaced_secret, namespace, labels)
+
+
+# Write only the secrets (in form {name: data}) whose content differs from what is in the cluster
+def secret_sync(secrets, namespace, labels=None, max_workers=MAX_PARALLEL, verbose=False):
+    # Labels are optionally provided per secret, in form {name: labels}
+    labels = labels or {}
+    existing = secret_list(namespace)
+    results = {}
+    bodies = {}
+    for name, secret_data in secrets.items():
+        body = secret_body(secret_data, name, labels.get(name))
+        current = existing.get(name)
+        if current is None:
+            bodies[name] = body
+        elif (current.metadata.annotations or {}).get(HASH_ANNOTATION) == body.metadata.annotations[HASH_ANNOTATION]:
+            results[name] = 'unchanged'
+        else:
+            body.metadata.resource_version = current.metadata.resource_version
+            bodies[name] = body
+
+    def write(name):
+        body = bodies[name]
+        if body.metadata.resource_version is None:
+            # Missing, or created before nephos labelled its secrets
+            result = upsert(api.create_namespaced_secret, api.read_namespaced_secret, api.replace_namespaced_secret,
+                            body, namespace)
+        else:
+            api.replace_namespaced_secret(name=name, namespace=namespace, body=body)
+            result = 'updated'
+        if verbose and result != 'unchanged':
+            print('{} secret {} in namespace {}'.format(result.capitalize(), name, namespace))
+        results[name] = result
+
+    # Writes are independent of each other, so we submit them concurrently;
+    # failures are raised together in a ParallelError, once all writes are done
+    parallel_map(write, list(bodies), max_workers=max_workers)
+    return {name: results[name] for name in secrets}
+
+
 def secret_read(name, namespace='default', verbose=False):
-    secret = api.read_namespaced_secret(name=name, namespace=namespace)
-    for key, value in secret.data.items():
-        if value:
-            secret.data[key] = base64.b64decode(value).decode('utf-8', 'ignore')
+    secret = coalesce('secret', namespace, name, lambda: api.read_namespaced_secret(name=name, namespace=namespace))
+    # Decode into a new dictionary, leaving the shared result untouched
+    secret_data = {key: base64.b64decode(value).decode('utf-8', 'ignore') if value else value
+                   for key, value in secret.data.items()}
     if verbose:
-        pretty_print(json.dumps(secret.data))
-    return secret.data
+        pretty_print(json.dumps(secret_data))
+    return secret_data
 
 
-def secret_from_file(secret, namespace, key=None, filename=None, verbose=False):
-    try:
-        secret_read(secret, namespace, verbose=verbose)
-    except ApiException:
-        # Get relevant variables
-        if not filename:
+def secret_from_file(secret, namespace, key=None, filename=None, labels=None, verbose=False):
+    if not filename:
+        # Only ask the user for files if the secret does not yet exist
+        try:
+            secret_read(secret, namespace, verbose=verbose)
+        except ApiException:
             secret_data = input_files([key], secret, clean_key=True)
-        else:
-            with open(filename, 'rb') as f:
-                data = f.read()
-                secret_data = {key: data}
-        secret_create(secret_data, secret, namespace, verbose=verbose)
+            secret_create(secret_data, secret, namespace, labels=labels, verbose=verbose)
+    else:
+        with open(filename, 'rb') as f:
+            data = f.read()
+            secret_data = {key: data}
+        # Keep the secret in sync with the file
+        secret_upsert(secret_data, secret, namespace, labels=labels, verbose=verbose)
 
 
 def get_app_info(namespace, ingress, secret, secret_key='API_KEY', verbose=False):
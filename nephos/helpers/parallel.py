@@ -0,0 +1,56 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Default number of tasks (e.g. Helm releases) we allow in flight at once
+MAX_PARALLEL = 4
+
+
+class ParallelError(Exception):
+    def __init__(self, errors):
+        # Errors are held as a list of (item, exception) tuples
+        self.errors = errors
+        message = '{} parallel task(s) failed: {}'.format(
+            len(errors), '; '.join('{}: {!r}'.format(item, error) for item, error in errors))
+        super(ParallelError, self).__init__(message)
+
+
+# Run each item through a sequence of stages, where the next stage of an item
+# is scheduled as soon as its previous stage is done (independently of other items)
+def parallel_pipeline(stages, items, max_workers=MAX_PARALLEL):
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    if not items:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        pending = {executor.submit(stages[0], item): (index, 0) for index, item in enumerate(items)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, stage = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except Exception as error:
+                    # A failed stage stops the pipeline of that item only
+                    errors.append((items[index], error))
+                    continue
+                if stage + 1 < len(stages):
+                    pending[executor.submit(stages[stage + 1], items[index])] = (index, stage + 1)
+    if errors:
+        raise ParallelError(errors)
+    return results
+
+
+def parallel_map(func, items, max_workers=MAX_PARALLEL):
+    return parallel_pipeline([func], items, max_workers=max_workers)
+
+
+# Run items in successive waves of at most max_unavailable items, so that a
+# failed wave stops the rollout before any further items are touched
+def rolling_pipeline(stages, items, max_unavailable=1):
+    items = list(items)
+    max_unavailable = max(1, max_unavailable)
+    results = []
+    for start in range(0, len(items), max_unavailable):
+        wave = items[start:start + max_unavailable]
+        results += parallel_pipeline(stages, wave, max_workers=len(wave))
+    return results
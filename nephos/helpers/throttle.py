@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+from functools import wraps
+from threading import Condition, Lock
+import time
+
+# Priority lanes: lower values are served first
+PROBE = 0
+DEFAULT = 1
+BULK = 2
+LANES = ('probe', 'default', 'bulk')
+
+# Default limits per backend, in form {backend: (qps, burst)}; a qps of 0 disables the limiter
+DEFAULT_LIMITS = {
+    'k8s': (50, 100),
+    'exec': (20, 40),
+    'helm': (10, 20),
+    'ca': (20, 40)
+}
+
+
+# Token bucket, where higher priority callers take tokens before lower priority ones
+class RateLimiter:
+    def __init__(self, name, qps, burst):
+        self.name = name
+        self.qps = qps
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.waiting = [0] * len(LANES)
+        self.requests = [0] * len(LANES)
+        self.throttled = [0.0] * len(LANES)
+        self.condition = Condition()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+        self.updated = now
+
+    # Block until we may send a request, returning the time spent waiting
+    def acquire(self, priority=DEFAULT):
+        start = time.monotonic()
+        with self.condition:
+            if self.qps:
+                self.waiting[priority] += 1
+                try:
+                    while True:
+                        self.refill()
+                        if self.tokens >= 1 and not any(self.waiting[:priority]):
+                            self.tokens -= 1
+                            break
+                        self.condition.wait(max((1 - self.tokens) / self.qps, 0.001))
+                finally:
+                    self.waiting[priority] -= 1
+                    self.condition.notify_all()
+            waited = time.monotonic() - start
+            self.requests[priority] += 1
+            self.throttled[priority] += waited
+        return waited
+
+    def metrics(self):
+        with self.condition:
+            return {lane: {'requests': self.requests[index], 'throttled': round(self.throttled[index], 3)}
+                    for index, lane in enumerate(LANES) if self.requests[index]}
+
+
+LIMITS = dict(DEFAULT_LIMITS)
+LIMITERS = {}
+LIMITERS_LOCK = Lock()
+
+
+# Set limits from the settings, in form {backend: {'qps': qps, 'burst': burst}}
+def configure_limiters(rate_limits=None):
+    with LIMITERS_LOCK:
+        LIMITS.clear()
+        LIMITS.update(DEFAULT_LIMITS)
+        for backend, values in (rate_limits or {}).items():
+            qps, burst = LIMITS.get(backend, DEFAULT_LIMITS['k8s'])
+            LIMITS[backend] = (values.get('qps', qps), values.get('burst', burst))
+        LIMITERS.clear()
+
+
+# Limiter of a backend; each CA gets its own, named "ca:<host>" and limited by the "ca" settings
+def get_limiter(name):
+    with LIMITERS_LOCK:
+        if name not in LIMITERS:
+            backend = name.split(':')[0]
+            qps, burst = LIMITS.get(name, LIMITS.get(backend, DEFAULT_LIMITS['k8s']))
+            LIMITERS[name] = RateLimiter(name, qps, burst)
+        return LIMITERS[name]
+
+
+def throttle(name, priority=DEFAULT):
+    return get_limiter(name).acquire(priority)
+
+
+# Proxy for a Kubernetes API object, throttling each call (writes go in the bulk lane)
+class ThrottledApi:
+    WRITES = ('create', 'replace', 'patch', 'delete')
+
+    def __init__(self, api, name='k8s'):
+        self.api = api
+        self.name = name
+
+    def __getattr__(self, attribute):
+        method = getattr(self.api, attribute)
+        if not callable(method):
+            return method
+        priority = BULK if attribute.startswith(self.WRITES) else DEFAULT
+
+        @wraps(method)
+        def throttled_method(*args, **kwargs):
+            throttle(self.name, priority)
+            return method(*args, **kwargs)
+        return throttled_method
+
+
+def throttle_metrics():
+    with LIMITERS_LOCK:
+        limiters = list(LIMITERS.values())
+    return {limiter.name: limiter.metrics() for limiter in limiters if limiter.metrics()}
+
+
+def print_throttle_metrics():
+    for name, lanes in sorted(throttle_metrics().items()):
+        print('{}: {}'.format(name, ', '.join(
+            '{} {} requests ({}s throttled)'.format(lane, values['requests'], values['throttled'])
+            for lane, values in lanes.items())))
@@ -1,17 +1,22 @@
 #! /usr/bin/env python
 
 from collections import namedtuple
+from glob import glob
+import json
 import os
+from tempfile import TemporaryDirectory
+from threading import Lock
 
 import click
 from kubernetes.client.rest import ApiException
 
-from nephos.fabric.settings import get_namespace, load_config
+from nephos.fabric.settings import get_namespace, load_config, org_opts, peer_orgs
 from nephos.fabric.utils import get_pod
 from nephos.fabric.ord import check_ord
 from nephos.fabric.peer import check_peer
 from nephos.helpers.helm import helm_upgrade
-from nephos.helpers.k8s import ns_create, secret_read, secret_create
+from nephos.helpers.k8s import nephos_labels, ns_create, secret_read, secret_create
+from nephos.helpers.parallel import MAX_PARALLEL, parallel_map, rolling_pipeline
 
 PWD = os.getcwd()
 CryptoInfo = namedtuple('CryptoInfo', ('secret_type', 'subfolder', 'key', 'required'))
@@ -19,11 +24,58 @@ CryptoInfo = namedtuple('CryptoInfo', ('secret_type', 'subfolder', 'key', 'requi
 NODE_MAPPER = {'orderer': 'hlf-ord', 'peer': 'hlf-peer'}
 
 
-def extract_credentials(opts, node_type, verbose=False):
+# Steps completed for each node, saved after every step so that an interrupted migration can resume
+class Checkpoint:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = Lock()
+        self.steps = {}
+        if filename and os.path.isfile(filename):
+            with open(filename) as f:
+                self.steps = json.load(f)
+
+    @staticmethod
+    def node_key(node_type, release):
+        return '{}/{}'.format(node_type, release)
+
+    def done(self, step, node_type, release):
+        with self.lock:
+            return step in self.steps.get(self.node_key(node_type, release), [])
+
+    def mark(self, step, node_type, release):
+        with self.lock:
+            node_steps = self.steps.setdefault(self.node_key(node_type, release), [])
+            if step not in node_steps:
+                node_steps.append(step)
+            if self.filename:
+                # Write to a temporary file first, so an interruption never leaves a truncated checkpoint
+                temp_filename = self.filename + '.tmp'
+                with open(temp_filename, 'w') as f:
+                    json.dump(self.steps, f, indent=2, sort_keys=True)
+                os.replace(temp_filename, self.filename)
+
+
+# Run the step for each node not yet done, concurrently, recording each success in the checkpoint
+def run_step(step, func, opts, node_type, checkpoint=None, verbose=False):
+    checkpoint = checkpoint or Checkpoint()
+    nodes = opts[node_type + 's']
+
+    def node_step(release):
+        if checkpoint.done(step, node_type, release):
+            if verbose:
+                print('Skipping {} of {}, already done'.format(step, release))
+            return
+        func(release)
+        checkpoint.mark(step, node_type, release)
+
+    parallel_map(node_step, nodes['names'], max_workers=nodes.get('max_parallel', MAX_PARALLEL))
+
+
+def extract_credentials(opts, node_type, checkpoint=None, verbose=False):
     chart = NODE_MAPPER[node_type]
     node_namespace = get_namespace(opts, opts[node_type + 's']['msp'])
-    # Loop over the nodes
-    for release in opts[node_type + 's']['names']:
+
+    def node_credentials(release):
         secret_name = 'hlf--{}-cred'.format(release)
         try:
             secret_read(secret_name, node_namespace)
@@ -37,15 +89,19 @@ def extract_credentials(opts, node_type, verbose=False):
                 'CA_USERNAME': original_data['CA_USERNAME'],
                 'CA_PASSWORD': original_data['CA_PASSWORD']
             }
-            secret_create(secret_data, secret_name, node_namespace, verbose=verbose)
+            secret_create(secret_data, secret_name, node_namespace,
+                          labels=nephos_labels(msp=opts[node_type + 's']['msp'], node=release, type='cred'),
+                          verbose=verbose)
+
+    run_step('credentials', node_credentials, opts, node_type, checkpoint=checkpoint, verbose=verbose)
 
 
-def extract_crypto(opts, node_type, verbose=False):
+def extract_crypto(opts, node_type, checkpoint=None, verbose=False):
     # Get chart type
     chart = NODE_MAPPER[node_type]
     node_namespace = get_namespace(opts, opts[node_type + 's']['msp'])
-    for release in opts[node_type + 's']['names']:
-        pod_ex = get_pod(node_namespace, release, chart)
+
+    def node_crypto(release):
         # Secrets
         crypto_info = [
             CryptoInfo('idcert', 'signcerts', 'cert.pem', True),
@@ -53,6 +109,7 @@ def extract_crypto(opts, node_type, verbose=False):
             CryptoInfo('cacert', 'cacerts', 'cacert.pem', True),
             CryptoInfo('caintcert', 'intermediatecerts', 'intermediatecacert.pem', False)
         ]
+        missing = []
         for item in crypto_info:
             secret_name = 'hlf--{}-{}'.format(release, item.secret_type)
             try:
@@ -60,27 +117,41 @@ def extract_crypto(opts, node_type, verbose=False):
                 if verbose:
                     print('{} secret already exists'.format(secret_name))
             except ApiException:
-                command = "bash -c 'ls /var/hyperledger/msp/{}' | wc -l".format(item.subfolder)
-                file_num = pod_ex.execute(command)
-                if file_num.strip() != '1':
+                missing.append((item, secret_name))
+        if not missing:
+            return
+        pod_ex = get_pod(node_namespace, release, chart)
+        # Copy the whole MSP from the pod at once
+        with TemporaryDirectory() as local_dir:
+            msp_path = pod_ex.download('/var/hyperledger/msp', local_dir)
+            for item, secret_name in missing:
+                files = glob(os.path.join(msp_path, item.subfolder, '*'))
+                if len(files) != 1:
                     if item.required:
                         raise ValueError('We should only have 1 file in each of these folders')
                     else:
                         print('Wrong number of files in {} directory'.format(item.subfolder))
                 else:
-                    command = "bash -c 'cat /var/hyperledger/msp/{}/*'".format(item.subfolder)
-                    content = pod_ex.execute(command)
-                    secret_data = {
-                        item.key: content
-                    }
-                    secret_create(secret_data, secret_name, node_namespace, verbose=verbose)
+                    with open(files[0], 'rb') as f:
+                        secret_data = {
+                            item.key: f.read()
+                        }
+                    secret_create(secret_data, secret_name, node_namespace,
+                                  labels=nephos_labels(msp=opts[node_type + 's']['msp'], node=release,
+                                                       type=item.secret_type),
+                                  verbose=verbose)
 
+    run_step('crypto', node_crypto, opts, node_type, checkpoint=checkpoint, verbose=verbose)
 
-def upgrade_charts(opts, node_type, verbose=False):
+
+def upgrade_charts(opts, node_type, checkpoint=None, verbose=False):
+    checkpoint = checkpoint or Checkpoint()
     # Get chart type
     chart = NODE_MAPPER[node_type]
-    node_namespace = get_namespace(opts, opts[node_type + 's']['msp'])
-    for release in opts[node_type + 's']['names']:
+    nodes = opts[node_type + 's']
+    node_namespace = get_namespace(opts, nodes['msp'])
+
+    def node_chart(release):
         pod_ex = get_pod(node_namespace, release, chart)
         res = pod_ex.execute('ls /var/hyperledger/msp_old')
         if not res:
@@ -92,23 +163,44 @@ def upgrade_charts(opts, node_type, verbose=False):
         helm_upgrade(opts['core']['chart_repo'], chart, release, node_namespace,
                      config_yaml=config_yaml,
                      verbose=verbose)
+
+    def node_check(release):
         if node_type == 'orderer':
             check_ord(node_namespace, release, verbose=verbose)
         elif node_type == 'peer':
             check_peer(node_namespace, release, verbose=verbose)
+        # Only a node that is back up counts as upgraded
+        checkpoint.mark('upgrade', node_type, release)
+
+    # Nodes upgraded by an earlier run are neither upgraded nor checked again
+    pending = []
+    for release in nodes['names']:
+        if not checkpoint.done('upgrade', node_type, release):
+            pending.append(release)
+        elif verbose:
+            print('Skipping upgrade of {}, already done'.format(release))
+    # Rolling upgrade, so that at most "max_unavailable" nodes are down at once
+    rolling_pipeline([node_chart, node_check], pending, max_unavailable=nodes.get('max_unavailable', 1))
 
 
 @click.command()
 @click.option('--settings_file', '-f', required=True, help='YAML file containing HLF options')
+@click.option('--checkpoint_file', '-c', default=None,
+              help='JSON file recording the progress of the upgrade (by default in the config directory)')
 @click.option('--verbose/--quiet', '-v/-q', default=False)
-def main(settings_file, verbose=False):  # pragma: no cover
+def main(settings_file, checkpoint_file=None, verbose=False):  # pragma: no cover
     opts = load_config(settings_file)
-    extract_credentials(opts, 'orderer', verbose=verbose)
-    extract_credentials(opts, 'peer', verbose=verbose)
-    extract_crypto(opts, 'orderer', verbose=verbose)
-    extract_crypto(opts, 'peer', verbose=verbose)
-    upgrade_charts(opts, 'orderer', verbose=verbose)
-    upgrade_charts(opts, 'peer', verbose=verbose)
+    if checkpoint_file is None:
+        checkpoint_file = os.path.join(opts['core']['dir_config'], 'upgrade_v11x.json')
+    checkpoint = Checkpoint(checkpoint_file)
+    # Orderers, then each peer organisation
+    steps = [(opts, 'orderer')] + [(org_opts(opts, org), 'peer') for org in peer_orgs(opts)]
+    # Extraction only reads from the nodes, so all nodes of a type are processed concurrently
+    for step_opts, node_type in steps:
+        extract_credentials(step_opts, node_type, checkpoint=checkpoint, verbose=verbose)
+        extract_crypto(step_opts, node_type, checkpoint=checkpoint, verbose=verbose)
+    for step_opts, node_type in steps:
+        upgrade_charts(step_opts, node_type, checkpoint=checkpoint, verbose=verbose)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -27,7 +27,7 @@ VERSION = '0.1.5'
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    'blessings', 'click', 'kubernetes', 'pygments'
+    'blessings', 'click', 'cryptography', 'kubernetes', 'pygments', 'requests'
 ]
 
 # What packages are optional?
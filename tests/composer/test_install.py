@@ -1,10 +1,10 @@
 from unittest import mock
 from unittest.mock import call
 
-from kubernetes.client.rest import ApiException
 import pytest
 
 from nephos.composer.install import get_composer_data, composer_connection, deploy_composer, setup_admin, install_network
+from nephos.helpers.k8s import BatchResult
 
 
 class TestGetComposerData:
@@ -44,28 +44,32 @@ class TestComposerConnection:
 
     @mock.patch('nephos.composer.install.json_ct')
     @mock.patch('nephos.composer.install.ingress_read')
-    @mock.patch('nephos.composer.install.cm_read')
-    @mock.patch('nephos.composer.install.cm_create')
-    def test_composer_connection(self, mock_cm_create, mock_cm_read, mock_ingress_read, mock_json_ct):
-        mock_cm_read.side_effect = [ApiException]
+    @mock.patch('nephos.composer.install.cm_upsert')
+    def test_composer_connection(self, mock_cm_upsert, mock_ingress_read, mock_json_ct):
+        mock_ingress_read.side_effect = [['an-ingress']]
         mock_json_ct.side_effect = ['cm-data']
         composer_connection(self.OPTS)
         mock_ingress_read.assert_called_once_with('peer-ca-hlf-ca', namespace='peer-namespace', verbose=False)
-        mock_cm_read.assert_called_once_with('connection-secret', 'peer-namespace', verbose=False)
-        mock_json_ct.assert_called_once()
-        mock_cm_create.assert_called_once_with('peer-namespace', 'connection-secret', {'connection.json': 'cm-data'})
+        mock_json_ct.assert_called_once_with(
+            ['peer0', 'peer1'], ['ord0', 'ord1'],
+            ['peer0-hlf-peer.peer-namespace.svc.cluster.local', 'peer1-hlf-peer.peer-namespace.svc.cluster.local'],
+            ['ord0-hlf-ord.ord-namespace.svc.cluster.local', 'ord1-hlf-ord.ord-namespace.svc.cluster.local'],
+            'peer-ca', 'an-ingress', 'AidTech', None, 'peer-msp', 'a-channel')
+        mock_cm_upsert.assert_called_once_with(
+            {'connection.json': 'cm-data'}, 'connection-secret', 'peer-namespace',
+            labels={'nephos/msp': 'peer_MSP', 'nephos/type': 'connection'}, verbose=False)
 
     @mock.patch('nephos.composer.install.json_ct')
     @mock.patch('nephos.composer.install.ingress_read')
-    @mock.patch('nephos.composer.install.cm_read')
-    @mock.patch('nephos.composer.install.cm_create')
-    def test_composer_connection_again(self, mock_cm_create, mock_cm_read, mock_ingress_read, mock_json_ct):
-        mock_cm_read.side_effect = [{'connection.json': 'cm-data'}]
+    @mock.patch('nephos.composer.install.cm_upsert')
+    def test_composer_connection_verbose(self, mock_cm_upsert, mock_ingress_read, mock_json_ct):
+        mock_ingress_read.side_effect = [['an-ingress']]
+        mock_json_ct.side_effect = ['cm-data']
         composer_connection(self.OPTS, verbose=True)
         mock_ingress_read.assert_called_once_with('peer-ca-hlf-ca', namespace='peer-namespace', verbose=True)
-        mock_cm_read.assert_called_once_with('connection-secret', 'peer-namespace', verbose=True)
-        mock_json_ct.assert_not_called()
-        mock_cm_create.assert_not_called()
+        mock_cm_upsert.assert_called_once_with(
+            {'connection.json': 'cm-data'}, 'connection-secret', 'peer-namespace',
+            labels={'nephos/msp': 'peer_MSP', 'nephos/type': 'connection'}, verbose=True)
 
 
 class TestDeployComposer:
@@ -83,7 +87,9 @@ class TestDeployComposer:
     def test_deploy_composer(self, mock_composer_connection, mock_helm_install,
                              mock_helm_upgrade, mock_secret_from_file):
         deploy_composer(self.OPTS)
-        mock_secret_from_file.assert_called_once_with(secret='bna-secret', namespace='peer-namespace', verbose=False)
+        mock_secret_from_file.assert_called_once_with(secret='bna-secret', namespace='peer-namespace',
+                                                      labels={'nephos/msp': 'peer_MSP', 'nephos/type': 'bna'},
+                                                      verbose=False)
         mock_composer_connection.assert_called_once_with(self.OPTS, verbose=False)
         mock_helm_install.assert_called_once_with(
             'a-repo', 'hl-composer', 'hlc', 'peer-namespace',
@@ -98,7 +104,9 @@ class TestDeployComposer:
     def test_deploy_composer_upgrade(self, mock_composer_connection, mock_helm_install,
                                      mock_helm_upgrade, mock_secret_from_file):
         deploy_composer(self.OPTS, upgrade=True, verbose=True)
-        mock_secret_from_file.assert_called_once_with(secret='bna-secret', namespace='peer-namespace', verbose=True)
+        mock_secret_from_file.assert_called_once_with(secret='bna-secret', namespace='peer-namespace',
+                                                      labels={'nephos/msp': 'peer_MSP', 'nephos/type': 'bna'},
+                                                      verbose=True)
         mock_composer_connection.assert_called_once_with(self.OPTS, verbose=True)
         mock_helm_install.assert_not_called()
         mock_helm_upgrade.assert_not_called()
@@ -118,24 +126,34 @@ class TestSetupAdmin:
         mock_pod = mock.Mock()
         mock_pod.execute.side_effect = [
             None,  # composer card list admin
-            None,  # composer card create
-            None,  # composer card import admin
-            'a-network_a-version.bna',  # ls BNA
         ]
+        # The card file exists from an interrupted run, which does not prevent importing it
+        mock_pod.batch.side_effect = [[BatchResult('composer card create', 1, 'Card file exists'),
+                                       BatchResult('composer card import', 0, 'Card imported')]]
         mock_get_pod.side_effect = [mock_pod]
         setup_admin(self.OPTS)
         mock_get_pod.assert_called_once_with('peer-namespace', 'hlc', 'hl-composer', verbose=False)
-        mock_pod.execute.assert_has_calls([
-            call('composer card list --card PeerAdmin@hlfv1'),
-            call('composer card create ' +
-                 '-p /hl_config/hlc-connection/connection.json ' +
-                 '-u PeerAdmin -c /hl_config/admin/signcerts/cert.pem ' +
-                 '-k /hl_config/admin/keystore/key.pem ' +
-                 ' -r PeerAdmin -r ChannelAdmin ' +
-                 '--file /home/composer/PeerAdmin@hlfv1'),
-            call('composer card import ' +
-                 '--file /home/composer/PeerAdmin@hlfv1.card')
-        ])
+        mock_pod.execute.assert_called_once_with('composer card list --card PeerAdmin@hlfv1')
+        mock_pod.batch.assert_called_once_with([
+            'composer card create ' +
+            '-p /hl_config/hlc-connection/connection.json ' +
+            '-u PeerAdmin -c /hl_config/admin/signcerts/cert.pem ' +
+            '-k /hl_config/admin/keystore/key.pem ' +
+            ' -r PeerAdmin -r ChannelAdmin ' +
+            '--file /home/composer/PeerAdmin@hlfv1',
+            'composer card import ' +
+            '--file /home/composer/PeerAdmin@hlfv1.card'
+        ], stop_on_error=False)
+
+    @mock.patch('nephos.composer.install.get_pod')
+    def test_setup_admin_failed(self, mock_get_pod):
+        mock_pod = mock.Mock()
+        mock_pod.execute.side_effect = [None]
+        mock_pod.batch.side_effect = [[BatchResult('composer card create', 1, 'No certificate'),
+                                       BatchResult('composer card import', 1, 'No card file')]]
+        mock_get_pod.side_effect = [mock_pod]
+        with pytest.raises(ValueError):
+            setup_admin(self.OPTS)
 
     @mock.patch('nephos.composer.install.get_pod')
     def test_setup_admin_again(self, mock_get_pod):
@@ -149,6 +167,7 @@ class TestSetupAdmin:
         mock_pod.execute.assert_has_calls([
             call('composer card list --card PeerAdmin@hlfv1')
         ])
+        mock_pod.batch.assert_not_called()
 
 
 # TODO: Simplify function and test (too complicated)
@@ -166,26 +185,29 @@ class TestInstallNetwork:
         mock_pod = mock.Mock()
         mock_pod.execute.side_effect = [
             'a-network_a-version.bna',  # ls BNA
-            None,  # composer card list network-admin
-            None,  # composer network install
-            None,  # composer network start
-            None,  # composer card import network-admin
-            None  # composer network ping
+        ]
+        mock_pod.batch.side_effect = [
+            [BatchResult('composer card list --card an-admin@a-network', 1, 'Card not found')],
+            [BatchResult('composer network install', 1, 'Network already installed'),
+             BatchResult('composer network start', 0, 'Network started'),
+             BatchResult('composer card import', 0, 'Card imported'),
+             BatchResult('composer network ping --card an-admin@a-network', 0, 'pong')]
         ]
         mock_get_pod.side_effect = [mock_pod]
         install_network(self.OPTS)
         mock_get_pod.assert_called_once_with('peer-namespace', 'hlc', 'hl-composer', verbose=False)
-        mock_pod.execute.assert_has_calls([
-            call('ls /hl_config/blockchain_network'),
-            call('composer card list --card an-admin@a-network'),
-            call('composer network install --card PeerAdmin@hlfv1 ' +
-                 '--archiveFile /hl_config/blockchain_network/a-network_a-version.bna'),
-            call('composer network start ' +
-                 '--card PeerAdmin@hlfv1 ' +
-                 '--networkName a-network --networkVersion a-version ' +
-                 '--networkAdmin an-admin --networkAdminEnrollSecret a-password'),
-            call('composer card import --file an-admin@a-network.card'),
-            call('composer network ping --card an-admin@a-network')
+        mock_pod.execute.assert_called_once_with('ls /hl_config/blockchain_network')
+        mock_pod.batch.assert_has_calls([
+            call(['composer card list --card an-admin@a-network',
+                  'composer network ping --card an-admin@a-network']),
+            call(['composer network install --card PeerAdmin@hlfv1 ' +
+                  '--archiveFile /hl_config/blockchain_network/a-network_a-version.bna',
+                  'composer network start ' +
+                  '--card PeerAdmin@hlfv1 ' +
+                  '--networkName a-network --networkVersion a-version ' +
+                  '--networkAdmin an-admin --networkAdminEnrollSecret a-password',
+                  'composer card import --file an-admin@a-network.card',
+                  'composer network ping --card an-admin@a-network'], stop_on_error=False)
         ])
         mock_ca_creds.assert_called_once_with(self.OPTS['cas']['peer-ca'], 'peer-namespace', verbose=False)
 
@@ -196,15 +218,31 @@ class TestInstallNetwork:
         mock_pod = mock.Mock()
         mock_pod.execute.side_effect = [
             'a-network_a-version.bna',  # ls BNA
-            'a-network.card',  # composer card list network-admin
-            None  # composer network ping
         ]
+        mock_pod.batch.side_effect = [[
+            BatchResult('composer card list --card an-admin@a-network', 0, 'a-network.card'),
+            BatchResult('composer network ping --card an-admin@a-network', 0, 'pong')
+        ]]
         mock_get_pod.side_effect = [mock_pod]
         install_network(self.OPTS, verbose=True)
         mock_get_pod.assert_called_once_with('peer-namespace', 'hlc', 'hl-composer', verbose=True)
-        mock_pod.execute.assert_has_calls([
-            call('ls /hl_config/blockchain_network'),
-            call('composer card list --card an-admin@a-network'),
-            call('composer network ping --card an-admin@a-network')
+        mock_pod.execute.assert_called_once_with('ls /hl_config/blockchain_network')
+        mock_pod.batch.assert_called_once_with([
+            'composer card list --card an-admin@a-network',
+            'composer network ping --card an-admin@a-network'
         ])
         mock_ca_creds.assert_called_once_with(self.OPTS['cas']['peer-ca'], 'peer-namespace', verbose=True)
+
+    @mock.patch('nephos.composer.install.get_pod')
+    @mock.patch('nephos.composer.install.admin_creds')
+    def test_install_network_unreachable(self, mock_ca_creds, mock_get_pod):
+        mock_pod = mock.Mock()
+        mock_pod.execute.side_effect = ['a-network_a-version.bna']
+        mock_pod.batch.side_effect = [[
+            BatchResult('composer card list --card an-admin@a-network', 0, 'a-network.card'),
+            BatchResult('composer network ping --card an-admin@a-network', 1, 'Error: connection refused')
+        ]]
+        mock_get_pod.side_effect = [mock_pod]
+        with pytest.raises(ValueError) as error:
+            install_network(self.OPTS)
+        assert str(error.value) == 'Composer network a-network does not answer to ping'
@@ -2,8 +2,10 @@ from unittest import mock
 from unittest.mock import call
 
 from kubernetes.client.rest import ApiException
-from nephos.fabric.ca import (ca_chart,
-                              ca_enroll, check_ca, setup_ca)
+import pytest
+
+from nephos.fabric.ca import ca_chart, ca_secret, check_ca, ca_ingress, setup_ca
+from nephos.helpers.parallel import ParallelError
 
 
 class TestCaChart:
@@ -33,10 +35,11 @@ class TestCaChart:
     @mock.patch('nephos.fabric.ca.helm_upgrade')
     @mock.patch('nephos.fabric.ca.helm_install')
     def test_ca_chart_upgrade(self, mock_helm_install, mock_helm_upgrade, mock_secret_read):
-        mock_secret_read.side_effect = [{'postgresql-password': 'a_password'}]
+        mock_secret_read.side_effect = [{'postgresql-password': 'a_password'}, ApiException, {'CA_ADMIN': 'an-admin'}]
         env_vars = [('externalDatabase.password', 'a_password')]
-        preserve = (('a-release-hlf-ca', 'CA_ADMIN', 'adminUsername'),
-                    ('a-release-hlf-ca', 'CA_PASSWORD', 'adminPassword'))
+        # The CA was installed by an older chart
+        preserve = (('a-release-hlf-ca--ca', 'CA_ADMIN', 'adminUsername'),
+                    ('a-release-hlf-ca--ca', 'CA_PASSWORD', 'adminPassword'))
         ca_chart(self.OPTS, 'a-release', upgrade=True)
         mock_helm_install.assert_called_once_with(
             'stable', 'postgresql', 'a-release-pg', 'ca-namespace',
@@ -46,8 +49,11 @@ class TestCaChart:
             config_yaml='./some_dir/hlf-ca/a-release.yaml',
             env_vars=env_vars, preserve=preserve, verbose=False
         )
-        mock_secret_read.assert_called_once_with(
-            'a-release-pg-postgresql', 'ca-namespace', verbose=False)
+        mock_secret_read.assert_has_calls([
+            call('a-release-pg-postgresql', 'ca-namespace', verbose=False),
+            call('a-release-hlf-ca', 'ca-namespace', verbose=False),
+            call('a-release-hlf-ca--ca', 'ca-namespace', verbose=False)
+        ])
 
     @mock.patch('nephos.fabric.ca.secret_read')
     @mock.patch('nephos.fabric.ca.helm_upgrade')
@@ -67,51 +73,49 @@ class TestCaChart:
             'a-release-pg-postgresql', 'ca-namespace', verbose=True)
 
 
-class TestCaEnroll:
-    @mock.patch('nephos.fabric.ca.sleep')
-    def test_ca_enroll(self, mock_sleep):
-        mock_pod_exec = mock.Mock()
-        mock_pod_exec.execute.side_effect = [
-            None,  # Get CA cert
-            'enrollment'
-        ]
-        mock_pod_exec.logs.side_effect = [
-            'Not yet running',
-            'Not yet running\nListening on localhost:7050'
-        ]
-        ca_enroll(mock_pod_exec)
-        mock_pod_exec.execute.assert_has_calls([
-            call('cat /var/hyperledger/fabric-ca/msp/signcerts/cert.pem'),
-            call("bash -c 'fabric-ca-client enroll -d -u http://$CA_ADMIN:$CA_PASSWORD@$SERVICE_DNS:7054'")
+class TestCaSecret:
+    @mock.patch('nephos.fabric.ca.secret_read')
+    def test_ca_secret(self, mock_secret_read):
+        mock_secret_read.side_effect = [{'CA_ADMIN': 'an-admin'}]
+        assert ca_secret('a-ca', 'ca-namespace') == ('a-ca-hlf-ca', {'CA_ADMIN': 'an-admin'})
+        mock_secret_read.assert_called_once_with('a-ca-hlf-ca', 'ca-namespace', verbose=False)
+
+    @mock.patch('nephos.fabric.ca.secret_read')
+    def test_ca_secret_old(self, mock_secret_read):
+        mock_secret_read.side_effect = [ApiException, {'CA_ADMIN': 'an-admin'}]
+        assert ca_secret('a-ca', 'ca-namespace', verbose=True) == ('a-ca-hlf-ca--ca', {'CA_ADMIN': 'an-admin'})
+        mock_secret_read.assert_has_calls([
+            call('a-ca-hlf-ca', 'ca-namespace', verbose=True),
+            call('a-ca-hlf-ca--ca', 'ca-namespace', verbose=True)
         ])
-        assert mock_pod_exec.logs.call_count == 2
-        mock_sleep.assert_called_once_with(15)
-
-    @mock.patch('nephos.fabric.ca.sleep')
-    def test_ca_enroll_again(self, mock_sleep):
-        mock_pod_exec = mock.Mock()
-        mock_pod_exec.execute.side_effect = [
-            'ca-cert',  # Get CA cert
-        ]
-        mock_pod_exec.logs.side_effect = [
-            'Not yet running\nListening on localhost:7050'
-        ]
-        ca_enroll(mock_pod_exec)
-        mock_pod_exec.execute.assert_called_once_with('cat /var/hyperledger/fabric-ca/msp/signcerts/cert.pem')
-        assert mock_pod_exec.logs.call_count == 1
-        mock_sleep.assert_not_called()
-
-
-class CheckCa:
-    @mock.patch('nephos.fabric.ca.execute_until_success')
-    def test_check_ca(self, mock_execute_until_success):
+
+
+class TestCheckCa:
+    @mock.patch('nephos.fabric.ca.get_ca_client')
+    def test_check_ca(self, mock_get_ca_client):
         check_ca('an-ingress', verbose=False)
-        mock_execute_until_success.assert_called_once_with('curl https://an-ingress/cainfo', verbose=False)
+        mock_get_ca_client.assert_called_once_with('an-ingress', tls_cert=None)
+        mock_get_ca_client.return_value.wait_until_ready.assert_called_once_with(deadline=600, verbose=False)
+
+    @mock.patch('nephos.fabric.ca.get_ca_client')
+    def test_check_ca_verbose(self, mock_get_ca_client):
+        check_ca('an-ingress', tls_cert='./a_cert.pem', deadline=60, verbose=True)
+        mock_get_ca_client.assert_called_once_with('an-ingress', tls_cert='./a_cert.pem')
+        mock_get_ca_client.return_value.wait_until_ready.assert_called_once_with(deadline=60, verbose=True)
+
+
+class TestCaIngress:
+    @mock.patch('nephos.fabric.ca.ingress_read')
+    def test_ca_ingress(self, mock_ingress_read):
+        mock_ingress_read.side_effect = [['an-ingress']]
+        assert ca_ingress('a-ca', 'ca-namespace') == ['an-ingress']
+        mock_ingress_read.assert_called_once_with('a-ca-hlf-ca', namespace='ca-namespace', verbose=False)
 
-    @mock.patch('nephos.fabric.ca.execute_until_success')
-    def test_check_ca_verbose(self, mock_execute_until_success):
-        check_ca('an-ingress', verbose=True)
-        mock_execute_until_success.assert_called_once_with('curl https://an-ingress/cainfo', verbose=True)
+    @mock.patch('nephos.fabric.ca.ingress_read')
+    def test_ca_ingress_missing(self, mock_ingress_read):
+        mock_ingress_read.side_effect = [ApiException]
+        assert ca_ingress('a-ca', 'ca-namespace', verbose=True) is None
+        mock_ingress_read.assert_called_once_with('a-ca-hlf-ca', namespace='ca-namespace', verbose=True)
 
 
 class TestSetupCa:
@@ -122,64 +126,60 @@ class TestSetupCa:
             'int-ca': {'namespace': 'int-namespace'}}
     }
 
-    root_executer = mock.Mock()
-    root_executer.pod = 'root-pod'
-    int_executer = mock.Mock()
-    int_executer.pod = 'int-pod'
+    @staticmethod
+    def ingress_read(name, namespace, verbose=False):
+        # Root CA has no ingress, Intermediate CA ingress is available
+        if name == 'root-ca-hlf-ca':
+            raise ApiException
+        return ['an-ingress']
 
+    @mock.patch('nephos.fabric.ca.print')
     @mock.patch('nephos.fabric.ca.ingress_read')
-    @mock.patch('nephos.fabric.ca.get_pod')
     @mock.patch('nephos.fabric.ca.check_ca')
-    @mock.patch('nephos.fabric.ca.ca_enroll')
     @mock.patch('nephos.fabric.ca.ca_chart')
-    def test_setup_ca(self, mock_ca_chart, mock_ca_enroll,
-                mock_check_ca, mock_get_pod, mock_ingress_read):
-        mock_get_pod.side_effect = [self.root_executer, self.int_executer]
-        mock_ingress_read.side_effect = [ApiException, ['an-ingress']]
-
+    def test_setup_ca(self, mock_ca_chart, mock_check_ca, mock_ingress_read, mock_print):
+        mock_ingress_read.side_effect = self.ingress_read
         setup_ca(self.OPTS)
         mock_ca_chart.assert_has_calls([
             call(opts=self.OPTS, release='root-ca', upgrade=False, verbose=False),
             call(opts=self.OPTS, release='int-ca', upgrade=False, verbose=False),
-        ])
-        mock_get_pod.assert_has_calls([
-            call(namespace='root-namespace', release='root-ca', app='hlf-ca', verbose=False),
-            call(namespace='int-namespace', release='int-ca', app='hlf-ca', verbose=False)
-        ])
-        mock_ca_enroll.assert_has_calls([
-            call(self.root_executer),
-            call(self.int_executer),
-            ])
+        ], any_order=True)
+        # Missing ingress is read again after the chart is installed
         mock_ingress_read.assert_has_calls([
+            call('root-ca-hlf-ca', namespace='root-namespace', verbose=False),
             call('root-ca-hlf-ca', namespace='root-namespace', verbose=False),
             call('int-ca-hlf-ca', namespace='int-namespace', verbose=False)
-        ])
-        mock_check_ca.assert_called_once_with(ingress_host='an-ingress', verbose=False)
+        ], any_order=True)
+        assert mock_ingress_read.call_count == 3
+        mock_print.assert_called_once_with('No ingress found for CA')
+        mock_check_ca.assert_called_once_with(ingress_host='an-ingress', tls_cert=None, verbose=False)
 
+    @mock.patch('nephos.fabric.ca.print')
     @mock.patch('nephos.fabric.ca.ingress_read')
-    @mock.patch('nephos.fabric.ca.get_pod')
     @mock.patch('nephos.fabric.ca.check_ca')
-    @mock.patch('nephos.fabric.ca.ca_enroll')
     @mock.patch('nephos.fabric.ca.ca_chart')
-    def test_setup_ca_upgrade(self, mock_ca_chart, mock_ca_enroll,
-                        mock_check_ca, mock_get_pod, mock_ingress_read):
-        mock_get_pod.side_effect = [self.root_executer, self.int_executer]
-        mock_ingress_read.side_effect =[ApiException, ['an-ingress']]
+    def test_setup_ca_upgrade(self, mock_ca_chart, mock_check_ca, mock_ingress_read, mock_print):
+        mock_ingress_read.side_effect = self.ingress_read
         setup_ca(self.OPTS, upgrade=True, verbose=True)
         mock_ca_chart.assert_has_calls([
             call(opts=self.OPTS, release='root-ca', upgrade=True, verbose=True),
             call(opts=self.OPTS, release='int-ca', upgrade=True, verbose=True),
-        ])
-        mock_get_pod.assert_has_calls([
-            call(namespace='root-namespace', release='root-ca', app='hlf-ca', verbose=True),
-            call(namespace='int-namespace', release='int-ca', app='hlf-ca', verbose=True)
-        ])
-        mock_ca_enroll.assert_has_calls([
-            call(self.root_executer),
-            call(self.int_executer)
-        ])
+        ], any_order=True)
         mock_ingress_read.assert_has_calls([
             call('root-ca-hlf-ca', namespace='root-namespace', verbose=True),
             call('int-ca-hlf-ca', namespace='int-namespace', verbose=True)
-        ])
-        mock_check_ca.assert_called_once_with(ingress_host='an-ingress', verbose=True)
+        ], any_order=True)
+        mock_check_ca.assert_called_once_with(ingress_host='an-ingress', tls_cert=None, verbose=True)
+
+    @mock.patch('nephos.fabric.ca.print')
+    @mock.patch('nephos.fabric.ca.ingress_read')
+    @mock.patch('nephos.fabric.ca.check_ca')
+    @mock.patch('nephos.fabric.ca.ca_chart')
+    def test_setup_ca_fail(self, mock_ca_chart, mock_check_ca, mock_ingress_read, mock_print):
+        mock_ca_chart.side_effect = Exception('Chart failed')
+        mock_ingress_read.side_effect = self.ingress_read
+        # Failures of every CA are reported together
+        with pytest.raises(ParallelError) as error:
+            setup_ca(self.OPTS)
+        assert sorted(item for item, _ in error.value.errors) == ['int-ca', 'root-ca']
+        mock_check_ca.assert_not_called()
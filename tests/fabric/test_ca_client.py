@@ -0,0 +1,201 @@
+import base64
+import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from os import listdir, path
+from threading import Thread
+from unittest import mock
+from unittest.mock import call
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.x509.oid import NameOID
+import pytest
+import requests
+
+from nephos.fabric.ca_client import (CaClient, Identity, PinnedAdapter, get_ca_client, split_pem,
+                                     CLIENTS, P256_ORDER)
+
+
+class TestSplitPem:
+    def test_split_pem(self):
+        pem_data = b'-----BEGIN CERTIFICATE-----\nA\n-----END CERTIFICATE-----\n' + \
+                   b'-----BEGIN CERTIFICATE-----\nB\n-----END CERTIFICATE-----\n'
+        assert split_pem(pem_data) == [
+            b'-----BEGIN CERTIFICATE-----\nA\n-----END CERTIFICATE-----\n',
+            b'-----BEGIN CERTIFICATE-----\nB\n-----END CERTIFICATE-----\n'
+        ]
+
+
+class TestCaClient:
+    def test_ca_client_init(self):
+        ca_client = CaClient('a-host')
+        assert ca_client.url == 'https://a-host'
+        assert ca_client.session.verify is True
+        assert not isinstance(ca_client.session.get_adapter('https://a-host'), PinnedAdapter)
+
+    @mock.patch('nephos.fabric.ca_client.PinnedAdapter')
+    def test_ca_client_init_pinned(self, mock_PinnedAdapter):
+        ca_client = CaClient('a-host', tls_cert='./a_cert.pem')
+        assert ca_client.session.verify == './a_cert.pem'
+        mock_PinnedAdapter.assert_called_once_with('./a_cert.pem')
+
+    def test_ca_client_cainfo(self):
+        ca_client = CaClient('a-host')
+        ca_client.session = mock.Mock()
+        ca_client.session.request.return_value.json.return_value = {'result': {'CAName': 'a-ca'}}
+        assert ca_client.cainfo() == {'CAName': 'a-ca'}
+        ca_client.session.request.assert_called_once_with('GET', 'https://a-host/cainfo', timeout=10)
+        ca_client.session.request.return_value.raise_for_status.assert_called_once_with()
+
+    @mock.patch('nephos.fabric.ca_client.print')
+    @mock.patch('nephos.fabric.ca_client.time')
+    def test_ca_client_wait_until_ready(self, mock_time, mock_print):
+        mock_time.monotonic.return_value = 0
+        ca_client = CaClient('a-host')
+        ca_client.cainfo = mock.Mock(side_effect=[
+            requests.ConnectionError, requests.HTTPError, requests.ConnectionError, {'CAName': 'a-ca'}])
+        assert ca_client.wait_until_ready() == {'CAName': 'a-ca'}
+        # Retries back off exponentially
+        mock_time.sleep.assert_has_calls([call(0.5), call(1), call(2)])
+        assert mock_print.call_count == 3
+
+    @mock.patch('nephos.fabric.ca_client.print')
+    @mock.patch('nephos.fabric.ca_client.time')
+    def test_ca_client_wait_until_ready_deadline(self, mock_time, mock_print):
+        mock_time.monotonic.side_effect = [0, 0, 1, 3, 7]
+        ca_client = CaClient('a-host')
+        ca_client.cainfo = mock.Mock(side_effect=requests.ConnectionError)
+        with pytest.raises(TimeoutError):
+            ca_client.wait_until_ready(deadline=10, verbose=True)
+        mock_time.sleep.assert_has_calls([call(0.5), call(1), call(2)])
+        assert ca_client.cainfo.call_count == 4
+
+
+class TestGetCaClient:
+    @mock.patch('nephos.fabric.ca_client.PinnedAdapter')
+    def test_get_ca_client(self, mock_PinnedAdapter):
+        CLIENTS.clear()
+        ca_client = get_ca_client('a-host')
+        assert get_ca_client('a-host') is ca_client
+        tls_client = get_ca_client('a-host', tls_cert='./a_cert.pem')
+        assert tls_client is not ca_client
+        assert get_ca_client('a-host', tls_cert=path.abspath('a_cert.pem')) is tls_client
+        assert tls_client.tls_cert == path.abspath('a_cert.pem')
+        CLIENTS.clear()
+
+
+# Local stand-in for a Fabric CA server
+class CaServer:
+    def __init__(self):
+        self.key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'a-root-ca')])
+        self.cert = self.sign(name, name, self.key.public_key())
+        self.users = {'admin': {'secret': 'adminpw', 'type': 'client'}}
+        self.tokens = []
+        ca_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, result):
+                body = json.dumps({'success': status == 200, 'result': result}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/cainfo':
+                    self.reply(200, {'CAName': 'a-root-ca'})
+                elif self.path.startswith('/api/v1/identities/'):
+                    ca_server.verify(self.headers['Authorization'], b'')
+                    username = self.path.split('/')[-1]
+                    if username in ca_server.users:
+                        self.reply(200, dict(id=username, **ca_server.users[username]))
+                    else:
+                        self.reply(404, None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                data = json.loads(body.decode('utf-8'))
+                if self.path == '/api/v1/register':
+                    ca_server.verify(self.headers['Authorization'], body)
+                    ca_server.users[data['id']] = {'secret': data['secret'], 'type': data['type']}
+                    self.reply(201, {'secret': data['secret']})
+                elif self.path == '/api/v1/enroll':
+                    username, password = base64.b64decode(
+                        self.headers['Authorization'].split()[1]).decode('utf-8').split(':')
+                    if ca_server.users.get(username, {}).get('secret') != password:
+                        self.reply(401, None)
+                        return
+                    csr = x509.load_pem_x509_csr(data['certificate_request'].encode('utf-8'), default_backend())
+                    cert = ca_server.sign(csr.subject, ca_server.cert.subject, csr.public_key())
+                    self.reply(201, {
+                        'Cert': base64.b64encode(cert.public_bytes(serialization.Encoding.PEM)).decode('utf-8'),
+                        'ServerInfo': {'CAName': 'a-root-ca', 'CAChain': base64.b64encode(
+                            ca_server.cert.public_bytes(serialization.Encoding.PEM)).decode('utf-8')}
+                    })
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.host = '127.0.0.1:{}'.format(self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def sign(self, subject, issuer, public_key):
+        now = datetime.datetime.utcnow()
+        return x509.CertificateBuilder().subject_name(subject).issuer_name(issuer).public_key(
+            public_key).serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(
+            now + datetime.timedelta(days=1)).sign(self.key, hashes.SHA256(), default_backend())
+
+    def verify(self, token, body):
+        b64cert, b64sig = token.split('.')
+        cert = x509.load_pem_x509_certificate(base64.b64decode(b64cert), default_backend())
+        signature = base64.b64decode(b64sig)
+        _, s = decode_dss_signature(signature)
+        assert s <= P256_ORDER // 2
+        message = (base64.b64encode(body).decode('utf-8') + '.' + b64cert).encode('utf-8')
+        cert.public_key().verify(signature, message, ec.ECDSA(hashes.SHA256()))
+        self.tokens.append(token)
+
+
+@pytest.fixture
+def ca_server():
+    server = CaServer()
+    yield server
+    server.server.shutdown()
+
+
+class TestCaClientRest:
+    def test_enroll(self, ca_server, tmpdir):
+        ca_client = CaClient(ca_server.host, scheme='http')
+        msp_path = str(tmpdir.join('admin_MSP'))
+        identity = ca_client.enroll('admin', 'adminpw', msp_path)
+        assert sorted(listdir(msp_path)) == ['cacerts', 'keystore', 'signcerts']
+        assert listdir(path.join(msp_path, 'cacerts')) == ['127-0-0-1-{}.pem'.format(ca_server.server.server_port)]
+        assert listdir(path.join(msp_path, 'keystore'))[0].endswith('_sk')
+        cert = x509.load_pem_x509_certificate(identity.cert, default_backend())
+        assert cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == 'admin'
+        # The MSP can be loaded back as a signing identity
+        assert Identity.from_msp(msp_path).cert == identity.cert
+
+    def test_enroll_fail(self, ca_server, tmpdir):
+        ca_client = CaClient(ca_server.host, scheme='http')
+        with pytest.raises(requests.HTTPError):
+            ca_client.enroll('admin', 'wrong-password', str(tmpdir.join('admin_MSP')))
+
+    def test_register(self, ca_server, tmpdir):
+        ca_client = CaClient(ca_server.host, scheme='http')
+        registrar = ca_client.enroll('admin', 'adminpw', str(tmpdir.join('admin_MSP')))
+        assert ca_client.identity(registrar, 'a-peer') is None
+        ca_client.register(registrar, 'a-peer', 'a-password', node_type='peer')
+        assert ca_client.identity(registrar, 'a-peer')['type'] == 'peer'
+        assert len(ca_server.tokens) == 3
+        # Registered identities can then enroll
+        ca_client.enroll('a-peer', 'a-password', str(tmpdir.join('a-peer_MSP')))
+        assert listdir(str(tmpdir.join('a-peer_MSP', 'signcerts'))) == ['cert.pem']
+        # The session is reused across requests
+        assert ca_client.session.adapters['http://'].poolmanager.pools
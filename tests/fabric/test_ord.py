@@ -2,7 +2,10 @@ from copy import deepcopy
 from unittest import mock
 from unittest.mock import call
 
+import pytest
+
 from nephos.fabric.ord import check_ord, setup_ord
+from nephos.helpers.parallel import ParallelError
 
 
 class TestCheckOrd:
@@ -51,12 +54,12 @@ class TestSetupOrd:
                  config_yaml='./a_dir/hlf-ord/ord0.yaml', verbose=False),
             call('a-repo', 'hlf-ord', 'ord1', 'ord-namespace',
                  config_yaml='./a_dir/hlf-ord/ord1.yaml', verbose=False),
-        ])
+        ], any_order=True)
         mock_helm_upgrade.assert_not_called()
         mock_check_ord.assert_has_calls([
             call('ord-namespace', 'ord0', verbose=False),
             call('ord-namespace', 'ord1', verbose=False)
-        ])
+        ], any_order=True)
 
     @mock.patch('nephos.fabric.ord.helm_upgrade')
     @mock.patch('nephos.fabric.ord.helm_install')
@@ -85,3 +88,24 @@ class TestSetupOrd:
             config_yaml='./a_dir/hlf-ord/ord0.yaml', verbose=False
         )
         mock_check_ord.assert_called_once_with('ord-namespace', 'ord0', verbose=False)
+
+    @mock.patch('nephos.fabric.ord.helm_upgrade')
+    @mock.patch('nephos.fabric.ord.helm_install')
+    @mock.patch('nephos.fabric.ord.check_ord')
+    def test_ord_upgrade_rolling(self, mock_check_ord, mock_helm_install, mock_helm_upgrade):
+        OPTS = deepcopy(self.OPTS)
+        OPTS['orderers']['names'] = ['ord0', 'ord1', 'ord2']
+        OPTS['orderers']['max_unavailable'] = 2
+        # The second wave (ord2) is never started if the first wave fails
+        mock_check_ord.side_effect = [None, ValueError('Orderer failed')]
+        with pytest.raises(ParallelError):
+            setup_ord(OPTS, upgrade=True)
+        mock_helm_install.assert_not_called()
+        mock_helm_upgrade.assert_has_calls([
+            call('a-repo', 'hlf-ord', 'ord0', 'ord-namespace',
+                 config_yaml='./a_dir/hlf-ord/ord0.yaml', verbose=False),
+            call('a-repo', 'hlf-ord', 'ord1', 'ord-namespace',
+                 config_yaml='./a_dir/hlf-ord/ord1.yaml', verbose=False)
+        ], any_order=True)
+        assert mock_helm_upgrade.call_count == 2
+        assert mock_check_ord.call_count == 2
@@ -2,7 +2,11 @@ from copy import deepcopy
 from unittest import mock
 from unittest.mock import call
 
+import pytest
+
 from nephos.fabric.peer import check_ord_tls, check_peer, setup_peer, setup_channel
+from nephos.helpers.k8s import BatchResult
+from nephos.helpers.parallel import ParallelError
 
 
 class TestCheckOrdTls:
@@ -89,12 +93,51 @@ class TestSetupPeer:
                  config_yaml='./a_dir/hlf-couchdb/cdb-peer1.yaml', verbose=False),
             call('a-repo', 'hlf-peer', 'peer1', 'peer-namespace',
                  config_yaml='./a_dir/hlf-peer/peer1.yaml', verbose=False),
-        ])
+        ], any_order=True)
+        assert mock_helm_install.call_count == 4
         mock_helm_upgrade.assert_not_called()
         mock_check_peer.assert_has_calls([
             call('peer-namespace', 'peer0', verbose=False),
             call('peer-namespace', 'peer1', verbose=False)
+        ], any_order=True)
+
+    @mock.patch('nephos.fabric.peer.helm_upgrade')
+    @mock.patch('nephos.fabric.peer.helm_install')
+    @mock.patch('nephos.fabric.peer.check_peer')
+    def test_peer_pipeline(self, mock_check_peer, mock_helm_install, mock_helm_upgrade):
+        OPTS = deepcopy(self.OPTS)
+        OPTS['peers']['max_parallel'] = 1
+        # With a single worker, every CouchDB is scheduled before any peer
+        setup_peer(OPTS)
+        mock_helm_install.assert_has_calls([
+            call('a-repo', 'hlf-couchdb', 'cdb-peer0', 'peer-namespace',
+                 config_yaml='./a_dir/hlf-couchdb/cdb-peer0.yaml', verbose=False),
+            call('a-repo', 'hlf-couchdb', 'cdb-peer1', 'peer-namespace',
+                 config_yaml='./a_dir/hlf-couchdb/cdb-peer1.yaml', verbose=False),
+            call('a-repo', 'hlf-peer', 'peer0', 'peer-namespace',
+                 config_yaml='./a_dir/hlf-peer/peer0.yaml', verbose=False),
+            call('a-repo', 'hlf-peer', 'peer1', 'peer-namespace',
+                 config_yaml='./a_dir/hlf-peer/peer1.yaml', verbose=False),
         ])
+        mock_helm_upgrade.assert_not_called()
+        assert mock_check_peer.call_count == 2
+
+    @mock.patch('nephos.fabric.peer.helm_upgrade')
+    @mock.patch('nephos.fabric.peer.helm_install')
+    @mock.patch('nephos.fabric.peer.check_peer')
+    def test_peer_fail(self, mock_check_peer, mock_helm_install, mock_helm_upgrade):
+        OPTS = deepcopy(self.OPTS)
+
+        def helm_install(repo, app, release, namespace, **kwargs):
+            if release == 'cdb-peer0':
+                raise ValueError('CouchDB failed')
+        mock_helm_install.side_effect = helm_install
+        with pytest.raises(ParallelError):
+            setup_peer(OPTS)
+        # The failed CouchDB stops its own peer, but not the others
+        mock_helm_install.assert_any_call('a-repo', 'hlf-peer', 'peer1', 'peer-namespace',
+                                          config_yaml='./a_dir/hlf-peer/peer1.yaml', verbose=False)
+        mock_check_peer.assert_called_once_with('peer-namespace', 'peer1', verbose=False)
 
     @mock.patch('nephos.fabric.peer.helm_upgrade')
     @mock.patch('nephos.fabric.peer.helm_install')
@@ -110,6 +153,23 @@ class TestSetupPeer:
         )
         mock_check_peer.assert_called_once_with('peer-namespace', 'peer0', verbose=False)
 
+    @mock.patch('nephos.fabric.peer.helm_upgrade')
+    @mock.patch('nephos.fabric.peer.helm_install')
+    @mock.patch('nephos.fabric.peer.check_peer')
+    def test_peer_upgrade_rolling(self, mock_check_peer, mock_helm_install, mock_helm_upgrade):
+        OPTS = deepcopy(self.OPTS)
+        OPTS['peers']['names'] = ['peer0', 'peer1', 'peer2']
+        # The second wave (peer1) is never started if the first wave fails
+        mock_check_peer.side_effect = [ValueError('Peer failed')]
+        with pytest.raises(ParallelError):
+            setup_peer(OPTS, upgrade=True)
+        mock_helm_install.assert_not_called()
+        mock_helm_upgrade.assert_called_once_with(
+            'a-repo', 'hlf-peer', 'peer0', 'peer-namespace',
+            config_yaml='./a_dir/hlf-peer/peer0.yaml', verbose=False
+        )
+        mock_check_peer.assert_called_once_with('peer-namespace', 'peer0', verbose=False)
+
 
 # TODO: Tests too complex, simplify channel creation, etc.
 class TestSetupChannel:
@@ -121,28 +181,31 @@ class TestSetupChannel:
     }
     CMD_SUFFIX = '--tls --ordererTLSHostnameOverride ord0-hlf-ord --cafile $(ls ${ORD_TLS_PATH}/*.pem)'
 
+    @staticmethod
+    def results(*exit_codes_outputs):
+        return [BatchResult('a-command', exit_code, output) for exit_code, output in exit_codes_outputs]
+
+    def new_channel_pods(self):
+        # Neither peer has the block at first, and the first peer also creates the channel
+        mock_pod0_ex = mock.Mock()
+        mock_pod0_ex.batch.side_effect = [
+            self.results((2, 'No such file'), (0, 'Channels peers has joined: ')),  # Get block, list channels
+            self.results((1, 'Error'), (1, 'Error'), (2, 'No such file')),  # Create, fetch, get block
+            self.results((1, 'Error'), (0, ''), (0, 'a-channel.block'))  # Create, fetch, get block
+        ]
+        mock_pod1_ex = mock.Mock()
+        mock_pod1_ex.batch.side_effect = [
+            self.results((2, 'No such file'), (0, 'Channels peers has joined: ')),  # Get block, list channels
+            self.results((0, ''), (0, 'a-channel.block'))  # Fetch, get block
+        ]
+        return mock_pod0_ex, mock_pod1_ex
+
     @mock.patch('nephos.fabric.peer.random')
     @mock.patch('nephos.fabric.peer.get_pod')
     @mock.patch('nephos.fabric.peer.check_ord_tls')
     def test_channel(self, mock_check_ord_tls, mock_get_pod, mock_random):
         mock_random.choice.side_effect = ['ord0']
-        mock_pod0_ex = mock.Mock()
-        mock_pod0_ex.execute.side_effect = [
-            None,  # Get block
-            None,  # Create channel
-            None,  # Fetch channel
-            'a-channel.block',  # Get block
-            'Channels peers has joined: ',  # List channels
-            None   # Join channel
-        ]
-        mock_pod1_ex = mock.Mock()
-        mock_pod1_ex.execute.side_effect = [
-            None,  # Get block
-            None,  # Fetch channel
-            'a-channel.block',  # Get block
-            'Channels peers has joined: ',  # List channels
-            None   # Join channel
-        ]
+        mock_pod0_ex, mock_pod1_ex = self.new_channel_pods()
         mock_get_pod.side_effect = [mock_pod0_ex, mock_pod1_ex]
         mock_check_ord_tls.side_effect = ['a-tls']
         setup_channel(self.OPTS)
@@ -152,26 +215,25 @@ class TestSetupChannel:
             call('peer-namespace', 'peer0', 'hlf-peer', verbose=False),
             call('peer-namespace', 'peer1', 'hlf-peer', verbose=False),
         ])
-        mock_pod0_ex.execute.assert_has_calls([
-            call('ls /var/hyperledger/a-channel.block'),
-            call("bash -c 'peer channel create -o ord0-hlf-ord.ord-namespace.svc.cluster.local:7050 " +
-                 "-c a-channel -f /hl_config/channel/a-channel.tx " + self.CMD_SUFFIX + "'"),
-            call("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
-                 "-c a-channel -o ord0-hlf-ord.ord-namespace.svc.cluster.local:7050 " + self.CMD_SUFFIX + "'"),
-            call('ls /var/hyperledger/a-channel.block'),
-            call('peer channel list'),
-            call("bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
-                 "peer channel join -b /var/hyperledger/a-channel.block " + self.CMD_SUFFIX + "'")
+        create = ("bash -c 'peer channel create -o ord0-hlf-ord.ord-namespace.svc.cluster.local:7050 " +
+                  "-c a-channel -f /hl_config/channel/a-channel.tx " + self.CMD_SUFFIX + "'")
+        fetch = ("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
+                 "-c a-channel -o ord0-hlf-ord.ord-namespace.svc.cluster.local:7050 " + self.CMD_SUFFIX + "'")
+        mock_pod0_ex.batch.assert_has_calls([
+            call(['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False),
+            call([create, fetch, 'ls /var/hyperledger/a-channel.block'], stop_on_error=False),
+            call([create, fetch, 'ls /var/hyperledger/a-channel.block'], stop_on_error=False)
         ])
-        mock_pod1_ex.execute.assert_has_calls([
-            call('ls /var/hyperledger/a-channel.block'),
-            call("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
-                 "-c a-channel -o ord0-hlf-ord.ord-namespace.svc.cluster.local:7050 " + self.CMD_SUFFIX + "'"),
-            call('ls /var/hyperledger/a-channel.block'),
-            call('peer channel list'),
-            call("bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
-                 "peer channel join -b /var/hyperledger/a-channel.block " + self.CMD_SUFFIX + "'")
+        mock_pod0_ex.execute.assert_called_once_with(
+            "bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
+            "peer channel join -b /var/hyperledger/a-channel.block " + self.CMD_SUFFIX + "'")
+        mock_pod1_ex.batch.assert_has_calls([
+            call(['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False),
+            call([fetch, 'ls /var/hyperledger/a-channel.block'], stop_on_error=False)
         ])
+        mock_pod1_ex.execute.assert_called_once_with(
+            "bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
+            "peer channel join -b /var/hyperledger/a-channel.block " + self.CMD_SUFFIX + "'")
 
     @mock.patch('nephos.fabric.peer.random')
     @mock.patch('nephos.fabric.peer.get_pod')
@@ -179,14 +241,12 @@ class TestSetupChannel:
     def test_channel_again(self, mock_check_ord_tls, mock_get_pod, mock_random):
         mock_random.choice.side_effect = ['ord0']
         mock_pod0_ex = mock.Mock()
-        mock_pod0_ex.execute.side_effect = [
-            'a-channel.block',  # Get block
-            'Channels peers has joined: a-channel',  # List channels
+        mock_pod0_ex.batch.side_effect = [
+            self.results((0, 'a-channel.block'), (0, 'Channels peers has joined: a-channel'))
         ]
         mock_pod1_ex = mock.Mock()
-        mock_pod1_ex.execute.side_effect = [
-            'a-channel.block',  # Get block
-            'Channels peers has joined: a-channel',  # List channels
+        mock_pod1_ex.batch.side_effect = [
+            self.results((0, 'a-channel.block'), (0, 'Channels peers has joined: a-channel'))
         ]
         mock_get_pod.side_effect = [mock_pod0_ex, mock_pod1_ex]
         mock_check_ord_tls.side_effect = ['a-tls']
@@ -197,37 +257,47 @@ class TestSetupChannel:
             call('peer-namespace', 'peer0', 'hlf-peer', verbose=False),
             call('peer-namespace', 'peer1', 'hlf-peer', verbose=False),
         ])
-        mock_pod0_ex.execute.assert_has_calls([
-            call('ls /var/hyperledger/a-channel.block'),
-            call('peer channel list')
-        ])
-        mock_pod1_ex.execute.assert_has_calls([
-            call('ls /var/hyperledger/a-channel.block'),
-            call('peer channel list')
-        ])
+        # A single exec session for each peer
+        mock_pod0_ex.batch.assert_called_once_with(
+            ['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False)
+        mock_pod0_ex.execute.assert_not_called()
+        mock_pod1_ex.batch.assert_called_once_with(
+            ['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False)
+        mock_pod1_ex.execute.assert_not_called()
+
+    @mock.patch('nephos.fabric.peer.random')
+    @mock.patch('nephos.fabric.peer.get_pod')
+    @mock.patch('nephos.fabric.peer.check_ord_tls')
+    def test_channel_existing(self, mock_check_ord_tls, mock_get_pod, mock_random):
+        mock_random.choice.side_effect = ['ord0']
+        pods = {}
+        for release in ('peer0', 'peer1'):
+            pods[release] = mock.Mock()
+            pods[release].batch.side_effect = [
+                self.results((2, 'No such file'), (0, 'Channels peers has joined: ')),  # Get block, list channels
+                self.results((0, ''), (0, 'a-channel.block'))  # Fetch, get block
+            ]
+        mock_get_pod.side_effect = lambda namespace, release, app, verbose: pods[release]
+        mock_check_ord_tls.side_effect = ['a-tls']
+        setup_channel(self.OPTS, create=False)
+        fetch = ("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
+                 "-c a-channel -o ord0-hlf-ord.ord-namespace.svc.cluster.local:7050 " + self.CMD_SUFFIX + "'")
+        # No peer tries to create the channel again
+        for pod_ex in pods.values():
+            pod_ex.batch.assert_has_calls([
+                call(['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False),
+                call([fetch, 'ls /var/hyperledger/a-channel.block'], stop_on_error=False)
+            ])
+            pod_ex.execute.assert_called_once_with(
+                "bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
+                "peer channel join -b /var/hyperledger/a-channel.block " + self.CMD_SUFFIX + "'")
 
     @mock.patch('nephos.fabric.peer.random')
     @mock.patch('nephos.fabric.peer.get_pod')
     @mock.patch('nephos.fabric.peer.check_ord_tls')
     def test_channel_notls(self, mock_check_ord_tls, mock_get_pod, mock_random):
         mock_random.choice.side_effect = ['ord1']
-        mock_pod0_ex = mock.Mock()
-        mock_pod0_ex.execute.side_effect = [
-            None,  # Get block
-            None,  # Create channel
-            None,  # Fetch channel
-            'a-channel.block',  # Get block
-            'Channels peers has joined: ',  # List channels
-            None   # Join channel
-        ]
-        mock_pod1_ex = mock.Mock()
-        mock_pod1_ex.execute.side_effect = [
-            None,  # Get block
-            None,  # Fetch channel
-            'a-channel.block',  # Get block
-            'Channels peers has joined: ',  # List channels
-            None   # Join channel
-        ]
+        mock_pod0_ex, mock_pod1_ex = self.new_channel_pods()
         mock_get_pod.side_effect = [mock_pod0_ex, mock_pod1_ex]
         mock_check_ord_tls.side_effect = [None]
         setup_channel(self.OPTS, verbose=True)
@@ -237,23 +307,21 @@ class TestSetupChannel:
             call('peer-namespace', 'peer0', 'hlf-peer', verbose=True),
             call('peer-namespace', 'peer1', 'hlf-peer', verbose=True),
         ])
-        mock_pod0_ex.execute.assert_has_calls([
-            call('ls /var/hyperledger/a-channel.block'),
-            call("bash -c 'peer channel create -o ord1-hlf-ord.ord-namespace.svc.cluster.local:7050 " +
-                 "-c a-channel -f /hl_config/channel/a-channel.tx '"),
-            call("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
-                 "-c a-channel -o ord1-hlf-ord.ord-namespace.svc.cluster.local:7050 '"),
-            call('ls /var/hyperledger/a-channel.block'),
-            call('peer channel list'),
-            call("bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
-                 "peer channel join -b /var/hyperledger/a-channel.block '")
+        create = ("bash -c 'peer channel create -o ord1-hlf-ord.ord-namespace.svc.cluster.local:7050 " +
+                  "-c a-channel -f /hl_config/channel/a-channel.tx '")
+        fetch = ("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
+                 "-c a-channel -o ord1-hlf-ord.ord-namespace.svc.cluster.local:7050 '")
+        mock_pod0_ex.batch.assert_has_calls([
+            call(['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False),
+            call([create, fetch, 'ls /var/hyperledger/a-channel.block'], stop_on_error=False)
         ])
-        mock_pod1_ex.execute.assert_has_calls([
-            call('ls /var/hyperledger/a-channel.block'),
-            call("bash -c 'peer channel fetch 0 /var/hyperledger/a-channel.block " +
-                 "-c a-channel -o ord1-hlf-ord.ord-namespace.svc.cluster.local:7050 '"),
-            call('ls /var/hyperledger/a-channel.block'),
-            call('peer channel list'),
-            call("bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
-                 "peer channel join -b /var/hyperledger/a-channel.block '")
+        mock_pod0_ex.execute.assert_called_once_with(
+            "bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
+            "peer channel join -b /var/hyperledger/a-channel.block '")
+        mock_pod1_ex.batch.assert_has_calls([
+            call(['ls /var/hyperledger/a-channel.block', 'peer channel list'], stop_on_error=False),
+            call([fetch, 'ls /var/hyperledger/a-channel.block'], stop_on_error=False)
         ])
+        mock_pod1_ex.execute.assert_called_once_with(
+            "bash -c 'CORE_PEER_MSPCONFIGPATH=$ADMIN_MSP_PATH " +
+            "peer channel join -b /var/hyperledger/a-channel.block '")
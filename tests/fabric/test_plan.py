@@ -0,0 +1,241 @@
+from collections import namedtuple
+import base64
+from unittest import mock
+from unittest.mock import call
+
+from nephos.fabric.plan import (Action, ClusterState, apply_plan, gather_state, peer_channels, plan_actions,
+                                plan_read, plan_write, planned, print_plan)
+from nephos.fabric.scale import STATE_CM
+from nephos.fabric.topology import compile_topology
+from nephos.helpers.k8s import secret_body
+
+# NamedTuples for mocking
+ConfigMap = namedtuple('ConfigMap', ('data',))
+Metadata = namedtuple('Metadata', ('annotations',))
+Secret = namedtuple('Secret', ('data', 'metadata'))
+
+SECRETS = ('cred', 'idcert', 'idkey')
+
+
+def make_opts(dir_config):
+    return {
+        'core': {'chart_repo': 'a-repo', 'dir_config': dir_config, 'dir_values': './a_dir',
+                 'namespace': 'a-namespace'},
+        'cas': {'a-ca': {}},
+        'msps': {
+            'ord_MSP': {'ca': 'a-ca', 'org_admin': 'an-ord-admin'},
+            'peer_MSP': {'ca': 'a-ca', 'org_admin': 'a-peer-admin'}
+        },
+        'orderers': {'msp': 'ord_MSP', 'names': ['ord0'], 'secret_genesis': 'a-genesis-secret'},
+        'peers': {'msp': 'peer_MSP', 'names': ['peer0', 'peer1'], 'channel_name': 'a-channel',
+                  'channel_profile': 'AChannel', 'secret_channel': 'a-channel-secret'}
+    }
+
+
+# Cluster where everything in the settings is already deployed
+def deployed_state(tmpdir):
+    for msp in ('ord_MSP', 'peer_MSP'):
+        tmpdir.join(msp, 'keystore', 'key.pem').write('a-key', ensure=True)
+    tmpdir.join('genesis.block').write('a-block')
+    tmpdir.join('a-channel.tx').write('a-tx')
+    secrets = {'hlf--{}-{}'.format(node, secret_type): Secret({}, Metadata(None))
+               for node in ('ord0', 'peer0', 'peer1') for secret_type in SECRETS}
+    secrets.update({name: Secret({}, Metadata(None))
+                    for name in ('hlf--an-ord-admin-admincred', 'hlf--an-ord-admin-idcert',
+                                 'hlf--a-peer-admin-admincred', 'hlf--a-peer-admin-idcert')})
+    secrets['a-genesis-secret'] = Secret({'genesis.block': base64.b64encode(b'a-block').decode('utf-8')}, None)
+    secrets['a-channel-secret'] = Secret({'a-channel.tx': base64.b64encode(b'a-tx').decode('utf-8')}, None)
+    applied = ConfigMap({'ord_MSP.orderers': '["ord0"]', 'peer_MSP.peers': '["peer0", "peer1"]'})
+    return ClusterState(
+        releases={release: {'chart': 'a-chart', 'namespace': 'a-namespace', 'status': 'DEPLOYED'}
+                  for release in ('a-ca', 'ord0', 'cdb-peer0', 'peer0', 'cdb-peer1', 'peer1')},
+        secrets={'a-namespace': secrets},
+        configmaps={'a-namespace': {STATE_CM: applied}},
+        pods={('a-namespace', 'hlf-ca'): {'a-ca'}, ('a-namespace', 'hlf-ord'): {'ord0'},
+              ('a-namespace', 'hlf-couchdb'): {'cdb-peer0', 'cdb-peer1'},
+              ('a-namespace', 'hlf-peer'): {'peer0', 'peer1'}},
+        channels={('a-namespace', 'peer0'): {'a-channel'}, ('a-namespace', 'peer1'): {'a-channel'}})
+
+
+# Local MSP of a node, and the secrets made from it
+def node_msp(tmpdir, node):
+    tmpdir.join('{}_MSP'.format(node), 'signcerts', 'cert.pem').write('a-cert', ensure=True)
+    tmpdir.join('{}_MSP'.format(node), 'keystore', 'a_sk').write('a-key', ensure=True)
+    secrets = {}
+    for name, key, value in (('hlf--{}-idcert'.format(node), 'cert.pem', b'a-cert'),
+                             ('hlf--{}-idkey'.format(node), 'key.pem', b'a-key')):
+        body = secret_body({key: value}, name)
+        secrets[name] = Secret(body.data, Metadata(body.metadata.annotations))
+    return secrets
+
+
+class TestPeerChannels:
+    @mock.patch('nephos.fabric.plan.get_pod')
+    def test_peer_channels(self, mock_get_pod):
+        mock_get_pod.return_value.execute.side_effect = [
+            '2019-01-01 00:00:00 UTC [channelCmd] InitCmdFactory -> INFO 001 Endorser and orderer connections\n'
+            'Channels peers has joined: \na-channel\nanother-channel\n']
+        assert peer_channels('a-namespace', 'peer0') == {'a-channel', 'another-channel'}
+        mock_get_pod.assert_called_once_with('a-namespace', 'peer0', 'hlf-peer', verbose=False)
+
+    @mock.patch('nephos.fabric.plan.get_pod')
+    def test_peer_channels_error(self, mock_get_pod):
+        mock_get_pod.return_value.execute.side_effect = [None]
+        assert peer_channels('a-namespace', 'peer0') == set()
+
+
+class TestGatherState:
+    @mock.patch('nephos.fabric.plan.peer_channels')
+    @mock.patch('nephos.fabric.plan.app_releases')
+    @mock.patch('nephos.fabric.plan.cm_list')
+    @mock.patch('nephos.fabric.plan.secret_list')
+    @mock.patch('nephos.fabric.plan.helm_releases')
+    def test_gather_state(self, mock_helm_releases, mock_secret_list, mock_cm_list, mock_app_releases,
+                          mock_peer_channels, tmpdir):
+        opts = make_opts(str(tmpdir))
+        mock_helm_releases.side_effect = [{'peer0': {'status': 'DEPLOYED'}, 'peer1': {'status': 'FAILED'}}]
+        mock_secret_list.side_effect = [{'a-secret': 'a-secret-object'}]
+        mock_cm_list.side_effect = [{STATE_CM: 'a-configmap-object'}]
+        mock_app_releases.side_effect = lambda namespace, app: {'peer0', 'peer1'} if app == 'hlf-peer' else set()
+        mock_peer_channels.side_effect = [{'a-channel'}]
+        state = gather_state(opts, compile_topology(opts))
+        assert state.secrets == {'a-namespace': {'a-secret': 'a-secret-object'}}
+        assert state.configmaps == {'a-namespace': {STATE_CM: 'a-configmap-object'}}
+        assert state.pods == {('a-namespace', 'hlf-ca'): set(), ('a-namespace', 'hlf-ord'): set(),
+                              ('a-namespace', 'hlf-couchdb'): set(), ('a-namespace', 'hlf-peer'): {'peer0', 'peer1'}}
+        # Only the channels of installed peers are read
+        assert state.channels == {('a-namespace', 'peer0'): {'a-channel'}}
+        mock_secret_list.assert_called_once_with('a-namespace', labels={})
+        mock_cm_list.assert_called_once_with('a-namespace')
+        mock_peer_channels.assert_called_once_with('a-namespace', 'peer0', verbose=False)
+
+
+class TestPlanActions:
+    def test_plan_actions_nothing(self, tmpdir):
+        opts = make_opts(str(tmpdir))
+        state = deployed_state(tmpdir)
+        state.secrets['a-namespace'].update(node_msp(tmpdir, 'peer0'))
+        assert plan_actions(opts, compile_topology(opts), state) == []
+
+    def test_plan_actions(self, tmpdir):
+        opts = make_opts(str(tmpdir))
+        state = deployed_state(tmpdir)
+        state.releases['peer1']['status'] = 'FAILED'
+        del state.releases['cdb-peer0']
+        del state.secrets['a-namespace']['hlf--peer1-idkey']
+        # The secrets of peer0 were written from an earlier enrollment
+        node_msp(tmpdir, 'peer0')
+        del state.configmaps['a-namespace'][STATE_CM].data['peer_MSP.peers']
+        del state.channels[('a-namespace', 'peer1')]
+        state.pods[('a-namespace', 'hlf-ord')].clear()
+        tmpdir.join('genesis.block').write('another-block')
+        tmpdir.join('a-channel.tx').remove()
+        assert plan_actions(opts, compile_topology(opts), state) == [
+            Action('store', 'genesis', 'a-genesis-secret', 'a-namespace', 'ord_MSP',
+                   'secret differs from genesis.block'),
+            Action('install', 'orderer', 'ord0', 'a-namespace', 'ord_MSP', 'no pods running'),
+            Action('generate', 'channel', 'a-channel-secret', 'a-namespace', 'peer_MSP', 'a-channel.tx is missing'),
+            Action('enroll', 'peer', 'peer0', 'a-namespace', 'peer_MSP',
+                   'secrets hlf--peer0-idcert, hlf--peer0-idkey differ from the local MSP'),
+            Action('install', 'couchdb', 'cdb-peer0', 'a-namespace', 'peer_MSP', 'not installed'),
+            Action('enroll', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'missing secrets hlf--peer1-idkey'),
+            Action('install', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'release is FAILED'),
+            Action('join', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'not in channel a-channel'),
+            Action('record', 'peer', STATE_CM, 'a-namespace', 'peer_MSP', 'peer0, peer1 not recorded as applied')
+        ]
+
+    def test_plan_actions_new(self, tmpdir):
+        opts = make_opts(str(tmpdir))
+        state = ClusterState(releases={}, secrets={}, configmaps={}, pods={}, channels={})
+        actions = plan_actions(opts, compile_topology(opts), state)
+        assert [(action.action, action.kind, action.name) for action in actions] == [
+            ('install', 'ca', 'a-ca'),
+            ('enroll', 'admin', 'ord_MSP'), ('enroll', 'admin', 'peer_MSP'),
+            ('generate', 'genesis', 'a-genesis-secret'),
+            ('enroll', 'orderer', 'ord0'), ('install', 'orderer', 'ord0'),
+            ('generate', 'channel', 'a-channel-secret'),
+            ('enroll', 'peer', 'peer0'), ('install', 'couchdb', 'cdb-peer0'), ('install', 'peer', 'peer0'),
+            ('enroll', 'peer', 'peer1'), ('install', 'couchdb', 'cdb-peer1'), ('install', 'peer', 'peer1'),
+            ('join', 'peer', 'peer0'), ('join', 'peer', 'peer1'),
+            ('record', 'orderer', STATE_CM), ('record', 'peer', STATE_CM)
+        ]
+
+
+class TestPrintPlan:
+    @mock.patch('nephos.fabric.plan.print')
+    def test_print_plan(self, mock_print):
+        print_plan([Action('install', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'not installed')])
+        mock_print.assert_has_calls([call('install peer peer1 in a-namespace: not installed'),
+                                     call('1 actions to apply')])
+
+    @mock.patch('nephos.fabric.plan.print')
+    def test_print_plan_empty(self, mock_print):
+        print_plan([])
+        mock_print.assert_called_once_with('Nothing to do, the cluster matches the settings')
+
+
+class TestPlanFile:
+    def test_plan_file(self, tmpdir):
+        actions = [Action('install', 'ca', 'a-ca', 'a-namespace', None, 'not installed'),
+                   Action('join', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'not in channel a-channel')]
+        plan_file = str(tmpdir.join('plan.json'))
+        plan_write(actions, plan_file)
+        assert plan_read(plan_file) == actions
+
+
+class TestPlanned:
+    def test_planned(self):
+        actions = [Action('install', 'peer', 'peer0', 'a-namespace', 'a_MSP', 'not installed'),
+                   Action('install', 'peer', 'peer1', 'a-namespace', 'another_MSP', 'not installed'),
+                   Action('join', 'peer', 'peer2', 'a-namespace', 'a_MSP', 'not in channel a-channel')]
+        assert planned(actions, ('install',), 'peer') == ['peer0', 'peer1']
+        assert planned(actions, ('install', 'join'), 'peer', 'a_MSP') == ['peer0', 'peer2']
+        assert planned(actions, ('install',), 'orderer') == []
+
+
+class TestApplyPlan:
+    @mock.patch('nephos.fabric.plan.record_applied')
+    @mock.patch('nephos.fabric.plan.setup_channel')
+    @mock.patch('nephos.fabric.plan.setup_peer')
+    @mock.patch('nephos.fabric.plan.channel_tx')
+    @mock.patch('nephos.fabric.plan.setup_ord')
+    @mock.patch('nephos.fabric.plan.setup_nodes')
+    @mock.patch('nephos.fabric.plan.genesis_block')
+    @mock.patch('nephos.fabric.plan.admin_msps')
+    @mock.patch('nephos.fabric.plan.setup_ca')
+    def test_apply_plan(self, mock_setup_ca, mock_admin_msps, mock_genesis_block, mock_setup_nodes,
+                        mock_setup_ord, mock_channel_tx, mock_setup_peer, mock_setup_channel, mock_record_applied):
+        opts = make_opts('./a_dir')
+        opts['cas']['another-ca'] = {}
+        actions = [Action('install', 'ca', 'another-ca', 'a-namespace', None, 'not installed'),
+                   Action('install', 'orderer', 'ord0', 'a-namespace', 'ord_MSP', 'no pods running'),
+                   Action('enroll', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'missing secrets hlf--peer1-idkey'),
+                   Action('install', 'couchdb', 'cdb-peer0', 'a-namespace', 'peer_MSP', 'not installed'),
+                   Action('join', 'peer', 'peer1', 'a-namespace', 'peer_MSP', 'not in channel a-channel'),
+                   Action('record', 'peer', STATE_CM, 'a-namespace', 'peer_MSP', 'peer1 not recorded as applied')]
+        apply_plan(opts, actions)
+        ca_view = mock_setup_ca.call_args[0][0]
+        assert list(ca_view['cas']) == ['another-ca']
+        mock_admin_msps.assert_not_called()
+        mock_genesis_block.assert_not_called()
+        mock_setup_ord.assert_called_once()
+        assert mock_setup_ord.call_args[0][0]['orderers']['names'] == ['ord0']
+        mock_channel_tx.assert_not_called()
+        mock_setup_nodes.assert_called_once()
+        assert mock_setup_nodes.call_args[0][0]['peers']['names'] == ['peer1']
+        assert mock_setup_nodes.call_args[1] == {'node_type': 'peer', 'verbose': False}
+        # A missing CouchDB is installed through its peer
+        mock_setup_peer.assert_called_once()
+        assert mock_setup_peer.call_args[0][0]['peers']['names'] == ['peer0']
+        assert mock_setup_channel.call_args[0][0]['peers']['names'] == ['peer1']
+        # peer0 is not joining, so the channel exists
+        assert mock_setup_channel.call_args[1] == {'create': False, 'verbose': False}
+        mock_record_applied.assert_called_once_with('a-namespace', 'peer_MSP', 'peer', ['peer0', 'peer1'],
+                                                    verbose=False)
+
+    @mock.patch('nephos.fabric.plan.org_pipeline')
+    @mock.patch('nephos.fabric.plan.setup_ca')
+    def test_apply_plan_empty(self, mock_setup_ca, mock_org_pipeline):
+        apply_plan(make_opts('./a_dir'), [])
+        mock_setup_ca.assert_not_called()
+        mock_org_pipeline.assert_not_called()
@@ -0,0 +1,149 @@
+from collections import namedtuple
+import time
+from unittest import mock
+from unittest.mock import call
+
+from nephos.fabric.plan import Action
+from nephos.fabric.reconcile import Reconciler
+from nephos.fabric.topology import compile_topology
+
+# NamedTuples for mocking
+Metadata = namedtuple('Metadata', ('name', 'namespace', 'labels', 'deletion_timestamp'))
+PodCondition = namedtuple('PodCondition', ('type', 'status'))
+PodStatus = namedtuple('PodStatus', ('phase', 'conditions'))
+Pod = namedtuple('Pod', ('metadata', 'status'))
+Secret = namedtuple('Secret', ('metadata',))
+
+OPTS = {
+    'core': {'chart_repo': 'a-repo', 'dir_config': './a_dir', 'dir_values': './another_dir',
+             'namespace': 'a-namespace'},
+    'cas': {'a-ca': {}},
+    'msps': {'peer_MSP': {'ca': 'a-ca', 'org_admin': 'a-peer-admin'}},
+    'peers': {'msp': 'peer_MSP', 'names': ['peer0'], 'channel_name': 'a-channel',
+              'channel_profile': 'AChannel', 'secret_channel': 'a-channel-secret'}
+}
+ACTIONS = [Action('install', 'peer', 'peer0', 'a-namespace', 'peer_MSP', 'release is FAILED')]
+
+
+def make_pod(release, ready):
+    return Pod(Metadata('a-pod', 'a-namespace', {'release': release}, None),
+               PodStatus('Running', [PodCondition('Ready', 'True' if ready else 'False')]))
+
+
+class TestReconcilerEvents:
+    def test_on_secret(self):
+        reconciler = Reconciler('a-settings.yaml')
+        reconciler.on_secret('MODIFIED', Secret(Metadata('a-secret', 'a-namespace', {}, None)))
+        assert not reconciler.changed.is_set()
+        reconciler.on_secret('DELETED', Secret(Metadata('a-secret', 'a-namespace', {}, None)))
+        assert reconciler.changed.is_set()
+        assert reconciler.reasons == ['secret a-secret was deleted']
+
+    @mock.patch('nephos.fabric.reconcile.pod_invalidate')
+    def test_on_pod(self, mock_pod_invalidate):
+        reconciler = Reconciler('a-settings.yaml')
+        reconciler.releases = {'peer0'}
+        reconciler.on_pod('MODIFIED', make_pod('peer0', True))
+        reconciler.on_pod('MODIFIED', make_pod('another-release', False))
+        assert not reconciler.changed.is_set()
+        mock_pod_invalidate.assert_not_called()
+        reconciler.on_pod('MODIFIED', make_pod('peer0', False))
+        reconciler.on_pod('DELETED', make_pod('peer0', True))
+        assert reconciler.reasons == ['pod a-pod of peer0 is not ready', 'pod a-pod of peer0 was deleted']
+        mock_pod_invalidate.assert_has_calls([call('a-namespace', 'peer0'), call('a-namespace', 'peer0')])
+
+
+class TestReconcilerReconcile:
+    @mock.patch('nephos.fabric.reconcile.ingress_invalidate')
+    @mock.patch('nephos.fabric.reconcile.objects_watch')
+    @mock.patch('nephos.fabric.reconcile.apply_plan')
+    @mock.patch('nephos.fabric.reconcile.print_plan')
+    @mock.patch('nephos.fabric.reconcile.plan_actions')
+    @mock.patch('nephos.fabric.reconcile.gather_state')
+    @mock.patch('nephos.fabric.reconcile.setup_namespaces')
+    @mock.patch('nephos.fabric.reconcile.parse_config')
+    @mock.patch('nephos.fabric.reconcile.load_config')
+    def test_reconcile(self, mock_load_config, mock_parse_config, mock_setup_namespaces, mock_gather_state,
+                       mock_plan_actions, mock_print_plan, mock_apply_plan, mock_objects_watch,
+                       mock_ingress_invalidate):
+        mock_load_config.return_value = OPTS
+        mock_parse_config.return_value = (OPTS, compile_topology(OPTS))
+        mock_plan_actions.side_effect = [ACTIONS, []]
+        reconciler = Reconciler('a-settings.yaml')
+        reconciler.watching = True
+        assert reconciler.reconcile() == ACTIONS
+        assert reconciler.releases == {'a-ca', 'peer0', 'cdb-peer0'}
+        mock_setup_namespaces.assert_called_once_with(OPTS, verbose=False)
+        assert mock_objects_watch.call_count == 2
+        mock_print_plan.assert_called_once_with(ACTIONS)
+        mock_apply_plan.assert_called_once_with(OPTS, ACTIONS, verbose=False)
+        # Namespaces are only set up and watched once
+        assert reconciler.reconcile() == []
+        mock_setup_namespaces.assert_called_once()
+        assert mock_objects_watch.call_count == 2
+        mock_apply_plan.assert_called_once()
+        # Cached ingress hosts are dropped on every pass
+        assert mock_ingress_invalidate.call_count == 2
+
+    @mock.patch('nephos.fabric.reconcile.objects_watch')
+    @mock.patch('nephos.fabric.reconcile.plan_actions')
+    @mock.patch('nephos.fabric.reconcile.gather_state')
+    @mock.patch('nephos.fabric.reconcile.setup_namespaces')
+    @mock.patch('nephos.fabric.reconcile.parse_config')
+    @mock.patch('nephos.fabric.reconcile.load_config')
+    def test_reconcile_once(self, mock_load_config, mock_parse_config, mock_setup_namespaces, mock_gather_state,
+                            mock_plan_actions, mock_objects_watch):
+        mock_load_config.return_value = OPTS
+        mock_parse_config.return_value = (OPTS, compile_topology(OPTS))
+        mock_plan_actions.side_effect = [[]]
+        assert Reconciler('a-settings.yaml').reconcile() == []
+        mock_objects_watch.assert_not_called()
+
+
+class TestReconcilerRun:
+    def test_next_reasons(self):
+        reconciler = Reconciler('a-settings.yaml', debounce=0)
+        reconciler.notify('secret a-secret was deleted')
+        assert reconciler.next_reasons() == ['secret a-secret was deleted']
+        assert not reconciler.changed.is_set()
+
+    def test_next_reasons_resync(self):
+        reconciler = Reconciler('a-settings.yaml', resync=0, debounce=0)
+        assert reconciler.next_reasons() == ['periodic resync']
+
+    @mock.patch('nephos.fabric.reconcile.print')
+    def test_run(self, mock_print, tmpdir):
+        settings_file = tmpdir.join('a-settings.yaml')
+        settings_file.write('a: b')
+        reconciler = Reconciler(str(settings_file), resync=0.01, debounce=0)
+        passes = []
+
+        def reconcile():
+            passes.append(len(passes))
+            if len(passes) == 1:
+                reconciler.notify('secret a-secret was deleted')
+            elif len(passes) == 2:
+                raise ValueError('bad')
+            else:
+                reconciler.shutdown()
+
+        reconciler.reconcile = reconcile
+        with mock.patch.object(reconciler, 'watch_settings'):
+            reconciler.run()
+            reconciler.watch_settings.assert_called_once_with()
+        assert passes == [0, 1, 2]
+        mock_print.assert_has_calls([call('Reconciling, since secret a-secret was deleted'),
+                                     call('Reconciliation failed: bad'),
+                                     call('Reconciling, since periodic resync')])
+
+    @mock.patch('nephos.fabric.reconcile.SETTINGS_POLL', 0.01)
+    def test_watch_settings(self, tmpdir):
+        settings_file = tmpdir.join('a-settings.yaml')
+        settings_file.write('a: b')
+        reconciler = Reconciler(str(settings_file))
+        thread = reconciler.watch_settings()
+        settings_file.setmtime(time.time() + 10)
+        assert reconciler.changed.wait(5)
+        reconciler.shutdown()
+        thread.join(5)
+        assert reconciler.reasons == ['settings file changed']
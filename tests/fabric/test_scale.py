@@ -0,0 +1,150 @@
+from unittest import mock
+from unittest.mock import call
+
+from kubernetes.client.rest import ApiException
+import pytest
+
+from nephos.fabric.scale import (STATE_CM, applied_nodes, diff_nodes, nodes_opts, record_applied, scale_orderers,
+                                 scale_peers, state_read)
+
+
+class TestStateRead:
+    @mock.patch('nephos.fabric.scale.cm_read')
+    def test_state_read(self, mock_cm_read):
+        mock_cm_read.side_effect = [{'a_MSP.peers': '["peer0"]'}]
+        assert state_read('a-namespace') == {'a_MSP.peers': '["peer0"]'}
+        mock_cm_read.assert_called_once_with(STATE_CM, 'a-namespace')
+
+    @mock.patch('nephos.fabric.scale.cm_read')
+    def test_state_read_missing(self, mock_cm_read):
+        mock_cm_read.side_effect = [ApiException(status=404)]
+        assert state_read('a-namespace') == {}
+
+    @mock.patch('nephos.fabric.scale.cm_read')
+    def test_state_read_error(self, mock_cm_read):
+        mock_cm_read.side_effect = [ApiException(status=403)]
+        with pytest.raises(ApiException):
+            state_read('a-namespace')
+
+
+class TestAppliedNodes:
+    @mock.patch('nephos.fabric.scale.state_read')
+    def test_applied_nodes(self, mock_state_read):
+        mock_state_read.side_effect = [{'a_MSP.peers': '["peer0", "peer1"]'}, {}]
+        assert applied_nodes('a-namespace', 'a_MSP', 'peer') == ['peer0', 'peer1']
+        assert applied_nodes('a-namespace', 'a_MSP', 'orderer') == []
+
+
+class TestRecordApplied:
+    @mock.patch('nephos.fabric.scale.state_read')
+    @mock.patch('nephos.fabric.scale.cm_upsert')
+    def test_record_applied(self, mock_cm_upsert, mock_state_read):
+        mock_state_read.side_effect = [{'another_MSP.peers': '["peer9"]'}]
+        record_applied('a-namespace', 'a_MSP', 'peer', ['peer0', 'peer1'])
+        mock_cm_upsert.assert_called_once_with(
+            {'another_MSP.peers': '["peer9"]', 'a_MSP.peers': '["peer0", "peer1"]'}, STATE_CM, 'a-namespace',
+            labels={'nephos/msp': 'a_MSP', 'nephos/type': 'state'}, verbose=False)
+
+
+class TestNodesOpts:
+    def test_nodes_opts(self):
+        opts = {'core': {}, 'orderers': {'msp': 'ord_MSP', 'names': ['ord0'], 'kafka': {'pod_num': 4}}}
+        view = nodes_opts(opts, 'orderer', ['ord1'])
+        assert view == {'core': {}, 'orderers': {'msp': 'ord_MSP', 'names': ['ord1']}}
+        # Settings are left unchanged
+        assert opts['orderers'] == {'msp': 'ord_MSP', 'names': ['ord0'], 'kafka': {'pod_num': 4}}
+
+
+class TestDiffNodes:
+    OPTS = {'msps': {'a_MSP': {'namespace': 'a-namespace'}},
+            'peers': {'msp': 'a_MSP', 'names': ['peer0', 'peer1', 'peer2']}}
+
+    @mock.patch('nephos.fabric.scale.print')
+    @mock.patch('nephos.fabric.scale.app_releases')
+    @mock.patch('nephos.fabric.scale.applied_nodes')
+    def test_diff_nodes(self, mock_applied_nodes, mock_app_releases, mock_print):
+        mock_applied_nodes.side_effect = [['peer0']]
+        mock_app_releases.side_effect = [{'peer0', 'peer1'}]
+        assert diff_nodes(self.OPTS, 'peer') == (['peer2'], ['peer0', 'peer1'])
+        mock_applied_nodes.assert_called_once_with('a-namespace', 'a_MSP', 'peer')
+        mock_app_releases.assert_called_once_with('a-namespace', 'hlf-peer')
+        mock_print.assert_not_called()
+
+    @mock.patch('nephos.fabric.scale.print')
+    @mock.patch('nephos.fabric.scale.app_releases')
+    @mock.patch('nephos.fabric.scale.applied_nodes')
+    def test_diff_nodes_removed(self, mock_applied_nodes, mock_app_releases, mock_print):
+        mock_applied_nodes.side_effect = [['peer0', 'peer1', 'peer2', 'peer3']]
+        mock_app_releases.side_effect = [set()]
+        assert diff_nodes(self.OPTS, 'peer', verbose=True) == ([], ['peer0', 'peer1', 'peer2'])
+        mock_print.assert_has_calls([
+            call('peer3 are no longer in the settings, and are left untouched'),
+            call('a_MSP peers: 0 added, 3 existing')
+        ])
+
+
+class TestScaleOrderers:
+    OPTS = {'msps': {'ord_MSP': {'namespace': 'ord-namespace'}},
+            'orderers': {'msp': 'ord_MSP', 'names': ['ord0', 'ord1'], 'kafka': {'pod_num': 4}}}
+
+    @mock.patch('nephos.fabric.scale.setup_ord')
+    @mock.patch('nephos.fabric.scale.setup_nodes')
+    @mock.patch('nephos.fabric.scale.record_applied')
+    @mock.patch('nephos.fabric.scale.diff_nodes')
+    def test_scale_orderers(self, mock_diff_nodes, mock_record_applied, mock_setup_nodes, mock_setup_ord):
+        mock_diff_nodes.side_effect = [(['ord1'], ['ord0'])]
+        assert scale_orderers(self.OPTS) == ['ord1']
+        view = {'msps': {'ord_MSP': {'namespace': 'ord-namespace'}},
+                'orderers': {'msp': 'ord_MSP', 'names': ['ord1']}}
+        mock_setup_nodes.assert_called_once_with(view, 'orderer', verbose=False)
+        mock_setup_ord.assert_called_once_with(view, verbose=False)
+        mock_record_applied.assert_called_once_with(
+            'ord-namespace', 'ord_MSP', 'orderer', ['ord0', 'ord1'], verbose=False)
+
+
+class TestScalePeers:
+    OPTS = {'msps': {'a_MSP': {'namespace': 'a-namespace'}},
+            'peers': {'msp': 'a_MSP', 'names': ['peer0', 'peer1']}}
+
+    @mock.patch('nephos.fabric.scale.setup_channel')
+    @mock.patch('nephos.fabric.scale.setup_peer')
+    @mock.patch('nephos.fabric.scale.setup_nodes')
+    @mock.patch('nephos.fabric.scale.record_applied')
+    @mock.patch('nephos.fabric.scale.diff_nodes')
+    def test_scale_peers(self, mock_diff_nodes, mock_record_applied, mock_setup_nodes, mock_setup_peer,
+                         mock_setup_channel):
+        mock_diff_nodes.side_effect = [(['peer1'], ['peer0'])]
+        assert scale_peers(self.OPTS, verbose=True) == ['peer1']
+        view = {'msps': {'a_MSP': {'namespace': 'a-namespace'}}, 'peers': {'msp': 'a_MSP', 'names': ['peer1']}}
+        mock_setup_nodes.assert_called_once_with(view, 'peer', verbose=True)
+        mock_setup_peer.assert_called_once_with(view, verbose=True)
+        # The channel exists already, as peer0 joined it
+        mock_setup_channel.assert_called_once_with(view, create=False, verbose=True)
+        mock_record_applied.assert_called_once_with('a-namespace', 'a_MSP', 'peer', ['peer0', 'peer1'], verbose=True)
+
+    @mock.patch('nephos.fabric.scale.setup_channel')
+    @mock.patch('nephos.fabric.scale.setup_peer')
+    @mock.patch('nephos.fabric.scale.setup_nodes')
+    @mock.patch('nephos.fabric.scale.record_applied')
+    @mock.patch('nephos.fabric.scale.diff_nodes')
+    def test_scale_peers_all(self, mock_diff_nodes, mock_record_applied, mock_setup_nodes, mock_setup_peer,
+                             mock_setup_channel):
+        mock_diff_nodes.side_effect = [(['peer0', 'peer1'], [])]
+        assert scale_peers(self.OPTS) == ['peer0', 'peer1']
+        mock_setup_channel.assert_called_once_with(self.OPTS, create=True, verbose=False)
+
+    @mock.patch('nephos.fabric.scale.print')
+    @mock.patch('nephos.fabric.scale.setup_channel')
+    @mock.patch('nephos.fabric.scale.setup_peer')
+    @mock.patch('nephos.fabric.scale.setup_nodes')
+    @mock.patch('nephos.fabric.scale.record_applied')
+    @mock.patch('nephos.fabric.scale.diff_nodes')
+    def test_scale_peers_none(self, mock_diff_nodes, mock_record_applied, mock_setup_nodes, mock_setup_peer,
+                              mock_setup_channel, mock_print):
+        mock_diff_nodes.side_effect = [([], ['peer0', 'peer1'])]
+        assert scale_peers(self.OPTS) == []
+        mock_setup_nodes.assert_not_called()
+        mock_setup_peer.assert_not_called()
+        mock_setup_channel.assert_not_called()
+        mock_print.assert_called_once_with('No new peers for a_MSP')
+        mock_record_applied.assert_called_once_with('a-namespace', 'a_MSP', 'peer', ['peer0', 'peer1'], verbose=False)
@@ -1,8 +1,15 @@
+from collections import OrderedDict
+from datetime import date
+import os
+import stat
 from unittest import mock
 
 import pytest
+import yaml
 
-from nephos.fabric.settings import check_cluster, get_namespace, load_config
+from nephos.fabric.settings import (CONFIG_CACHE, check_cluster, get_namespace, load_config,
+                                    org_opts, parse_config, peer_orgs, yaml_load)
+from nephos.fabric.topology import TopologyError
 
 
 class TestCheckCluster:
@@ -66,52 +73,167 @@ class TestGetNamespace:
             get_namespace(self.OPTS, ca='nonexistent-ca')
 
 
+class TestPeerOrgs:
+    def test_peer_orgs(self):
+        assert peer_orgs({'peers': {'msp': 'a_MSP'}}) == [{'msp': 'a_MSP'}]
+        assert peer_orgs({'peers': [{'msp': 'a_MSP'}, {'msp': 'another_MSP'}]}) == [
+            {'msp': 'a_MSP'}, {'msp': 'another_MSP'}]
+        assert peer_orgs({'core': {}}) == []
+
+
+class TestOrgOpts:
+    def test_org_opts(self):
+        opts = {'core': {'namespace': 'core-namespace'}, 'msps': {}, 'peers': [{'msp': 'a_MSP'}]}
+        result = org_opts(opts, opts['peers'][0])
+        assert result['peers'] == {'msp': 'a_MSP'}
+        assert opts['peers'] == [{'msp': 'a_MSP'}]
+        # Other settings are shared, so that e.g. generated passwords are seen by every organisation
+        assert result['msps'] is opts['msps']
+
+
+SETTINGS = """core:
+  chart_repo: a-repo
+  dir_config: ./a_dir
+  dir_values: ./another_dir
+msps:
+  b_MSP: {ca: a-ca, namespace: b-namespace, org_admin: an-admin}
+  a_MSP: {ca: a-ca, namespace: a-namespace, org_admin: an-admin}
+cas:
+  a-ca: {namespace: ca-namespace}
+"""
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    CONFIG_CACHE.clear()
+    with mock.patch('nephos.fabric.settings.CACHE_DIR', str(tmpdir.join('cache'))):
+        yield tmpdir.join('cache')
+    CONFIG_CACHE.clear()
+
+
+class TestYamlLoad:
+    def test_yaml_load(self):
+        data = yaml_load('b: 1\na: {d: 2, c: 3}\n')
+        assert isinstance(data, OrderedDict)
+        assert list(data.items()) == [('b', 1), ('a', OrderedDict([('d', 2), ('c', 3)]))]
+
+    def test_yaml_load_global(self):
+        # The yaml module itself is left untouched
+        assert type(yaml.safe_load('a: 1')) is dict
+
+
+class TestParseConfig:
+    def test_parse_config(self, tmpdir, cache_dir):
+        settings_file = tmpdir.join('settings.yaml')
+        settings_file.write(SETTINGS)
+        data, topology = parse_config(str(settings_file))
+        assert list(data['msps'].keys()) == ['b_MSP', 'a_MSP']
+        assert topology.namespaces == ('b-namespace', 'a-namespace', 'ca-namespace')
+        assert len(cache_dir.listdir()) == 1
+        # The cache holds passwords, so only the user may read it
+        assert stat.S_IMODE(os.stat(str(cache_dir)).st_mode) == 0o700
+        assert stat.S_IMODE(os.stat(str(cache_dir.listdir()[0])).st_mode) == 0o600
+
+    @mock.patch('nephos.fabric.settings.yaml_load')
+    def test_parse_config_cached(self, mock_yaml_load, tmpdir, cache_dir):
+        mock_yaml_load.side_effect = yaml_load
+        settings_file = tmpdir.join('settings.yaml')
+        settings_file.write(SETTINGS)
+        data, topology = parse_config(str(settings_file))
+        # Callers get their own copy of the settings
+        data['core']['chart_repo'] = 'another-repo'
+        data_again, topology_again = parse_config(str(settings_file))
+        assert data_again['core']['chart_repo'] == 'a-repo'
+        assert topology_again is topology
+        mock_yaml_load.assert_called_once()
+
+    @mock.patch('nephos.fabric.settings.yaml_load')
+    def test_parse_config_disk_cache(self, mock_yaml_load, tmpdir, cache_dir):
+        mock_yaml_load.side_effect = yaml_load
+        settings_file = tmpdir.join('settings.yaml')
+        settings_file.write(SETTINGS)
+        data, _ = parse_config(str(settings_file))
+        # A new process only has the disk cache
+        CONFIG_CACHE.clear()
+        data_again, _ = parse_config(str(settings_file))
+        assert data_again == data
+        assert list(data_again['msps'].keys()) == ['b_MSP', 'a_MSP']
+        mock_yaml_load.assert_called_once()
+
+    def test_parse_config_changed(self, tmpdir, cache_dir):
+        settings_file = tmpdir.join('settings.yaml')
+        settings_file.write(SETTINGS)
+        parse_config(str(settings_file))
+        settings_file.write(SETTINGS.replace('a-repo', 'another-repo') + '# A comment\n')
+        data, _ = parse_config(str(settings_file))
+        assert data['core']['chart_repo'] == 'another-repo'
+        assert len(cache_dir.listdir()) == 2
+
+    def test_parse_config_invalid(self, tmpdir, cache_dir):
+        settings_file = tmpdir.join('settings.yaml')
+        settings_file.write(SETTINGS + 'peers: {msp: nonexistent_MSP, names: [peer0]}\n')
+        with pytest.raises(TopologyError) as error:
+            parse_config(str(settings_file))
+        assert '"peers" uses MSP "nonexistent_MSP", which is not in "msps"' in error.value.errors
+
+    def test_parse_config_not_json(self, tmpdir, cache_dir):
+        settings_file = tmpdir.join('settings.yaml')
+        settings_file.write(SETTINGS + 'created: 2018-07-01\n')
+        data, _ = parse_config(str(settings_file))
+        assert data['created'] == date(2018, 7, 1)
+        assert not cache_dir.check()
+
+
 class TestLoadHlfConfig:
-    @mock.patch('nephos.fabric.settings.yaml')
+    @mock.patch('nephos.fabric.settings.configure_limiters')
     @mock.patch('nephos.fabric.settings.path')
-    @mock.patch('nephos.fabric.settings.open')
+    @mock.patch('nephos.fabric.settings.parse_config')
     @mock.patch('nephos.fabric.settings.check_cluster')
-    def test_load_config(self, mock_check_cluster, mock_open, mock_path, mock_yaml):
-        mock_yaml.load.side_effect = [
+    def test_load_config(self, mock_check_cluster, mock_parse_config, mock_path, mock_configure_limiters):
+        mock_parse_config.side_effect = [(
             {
                 'core': {
                     'chart_repo': 'a-repo',
                     'cluster': 'a-cluster',
                     'dir_config': './a_dir',
-                    'dir_values': './another_dir'
+                    'dir_values': './another_dir',
+                    'rate_limits': {'k8s': {'qps': 5}}
                 }
-             }
-        ]
+            },
+            'a-topology'
+        )]
         mock_path.isdir.side_effect = [False]
         mock_path.abspath.side_effect = ['/home/user/a_dir', '/home/user/another_dir']
-        load_config('./some_settings.yaml')
-        mock_open.assert_called_once_with('./some_settings.yaml')
-        mock_yaml.load.assert_called_once()
+        data = load_config('./some_settings.yaml')
+        mock_parse_config.assert_called_once_with('./some_settings.yaml')
         mock_check_cluster.assert_called_once_with('a-cluster')
         mock_path.isdir.assert_called_once_with('a-repo')
         assert mock_path.expanduser.call_count == 2
         assert mock_path.abspath.call_count == 2
+        assert data['core']['dir_config'] == '/home/user/a_dir'
+        mock_configure_limiters.assert_called_once_with({'k8s': {'qps': 5}})
 
-    @mock.patch('nephos.fabric.settings.yaml')
+    @mock.patch('nephos.fabric.settings.configure_limiters')
     @mock.patch('nephos.fabric.settings.path')
-    @mock.patch('nephos.fabric.settings.open')
+    @mock.patch('nephos.fabric.settings.parse_config')
     @mock.patch('nephos.fabric.settings.check_cluster')
-    def test_load_config_repodir(self, mock_check_cluster, mock_open, mock_path, mock_yaml):
-        mock_yaml.load.side_effect = [
+    def test_load_config_repodir(self, mock_check_cluster, mock_parse_config, mock_path, mock_configure_limiters):
+        mock_parse_config.side_effect = [(
             {
                 'core': {
                     'chart_repo': './a_repo_dir',
                     'dir_config': './a_dir',
                     'dir_values': './another_dir'
                 }
-            }
-        ]
+            },
+            'a-topology'
+        )]
         mock_path.isdir.side_effect = [True]
         mock_path.abspath.side_effect = ['/home/user/a_repo_dir', '/home/user/a_dir', '/home/user/another_dir']
         load_config('./some_settings.yaml')
-        mock_open.assert_called_once_with('./some_settings.yaml')
-        mock_yaml.load.assert_called_once()
+        mock_parse_config.assert_called_once_with('./some_settings.yaml')
         mock_check_cluster.assert_not_called()
         mock_path.isdir.assert_called_once_with('./a_repo_dir')
         assert mock_path.expanduser.call_count == 3
         assert mock_path.abspath.call_count == 3
+        mock_configure_limiters.assert_called_once_with(None)
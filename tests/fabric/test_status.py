@@ -0,0 +1,142 @@
+from collections import namedtuple
+import base64
+import datetime
+from unittest import mock
+from unittest.mock import call
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+import requests
+
+from nephos.fabric.status import (Release, ca_probe, cert_expiry, gather_status, network_releases, print_status,
+                                  secret_cert_expiry)
+from nephos.fabric.topology import compile_topology
+
+# NamedTuples for mocking
+Secret = namedtuple('Secret', ('data',))
+PodMetadata = namedtuple('PodMetadata', ('name', 'deletion_timestamp'))
+ContainerStatus = namedtuple('ContainerStatus', ('restart_count',))
+PodCondition = namedtuple('PodCondition', ('type', 'status'))
+PodStatus = namedtuple('PodStatus', ('phase', 'conditions', 'container_statuses'))
+Pod = namedtuple('Pod', ('metadata', 'status'))
+
+OPTS = {
+    'core': {'chart_repo': 'a-repo', 'dir_config': './a_dir', 'dir_values': './another_dir',
+             'namespace': 'a-namespace'},
+    'cas': {'a-ca': {}},
+    'msps': {'ord_MSP': {'ca': 'a-ca', 'org_admin': 'an-ord-admin'},
+             'peer_MSP': {'ca': 'a-ca', 'org_admin': 'a-peer-admin'}},
+    'orderers': {'msp': 'ord_MSP', 'names': ['ord0'], 'secret_genesis': 'a-genesis-secret'},
+    'peers': {'ca': 'a-ca', 'msp': 'peer_MSP', 'names': ['peer0'], 'channel_name': 'a-channel',
+              'channel_profile': 'AChannel', 'secret_channel': 'a-channel-secret'},
+    'composer': {'name': 'hlc', 'secret_bna': 'a-bna-secret', 'secret_connection': 'a-connection-secret'}
+}
+
+
+def make_cert(not_after):
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'a-name')])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()).serial_number(
+        1).not_valid_before(datetime.datetime(2019, 1, 1)).not_valid_after(not_after).sign(
+        key, hashes.SHA256(), default_backend())
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+
+def make_pod(ready, restarts):
+    conditions = [PodCondition('Ready', 'True' if ready else 'False')]
+    return Pod(PodMetadata('a-pod', None), PodStatus('Running', conditions, [ContainerStatus(restarts)]))
+
+
+class TestCertExpiry:
+    def test_cert_expiry(self):
+        assert cert_expiry(make_cert(datetime.datetime(2030, 6, 1))) == '2030-06-01'
+
+    def test_cert_expiry_chain(self):
+        chain = make_cert(datetime.datetime(2030, 6, 1)) + make_cert(datetime.datetime(2040, 1, 1))
+        assert cert_expiry(chain) == '2030-06-01'
+
+    def test_secret_cert_expiry(self):
+        cert = base64.b64encode(make_cert(datetime.datetime(2030, 6, 1))).decode('utf-8')
+        assert secret_cert_expiry(Secret({'cert.pem': cert})) == '2030-06-01'
+        assert secret_cert_expiry(Secret({})) is None
+        assert secret_cert_expiry(None) is None
+
+
+class TestCaProbe:
+    CA = compile_topology(OPTS).cas['a-ca']
+
+    @mock.patch('nephos.fabric.status.get_ca_client')
+    @mock.patch('nephos.fabric.status.ca_ingress')
+    def test_ca_probe(self, mock_ca_ingress, mock_get_ca_client):
+        mock_ca_ingress.side_effect = [['a-ca.a-domain.com']]
+        chain = base64.b64encode(make_cert(datetime.datetime(2030, 6, 1))).decode('utf-8')
+        mock_get_ca_client.return_value.cainfo.side_effect = [{'CAName': 'a-ca', 'CAChain': chain}]
+        assert ca_probe(self.CA) == ('reachable', '2030-06-01')
+        mock_ca_ingress.assert_called_once_with('a-ca', 'a-namespace')
+        mock_get_ca_client.assert_called_once_with('a-ca.a-domain.com', tls_cert=None)
+
+    @mock.patch('nephos.fabric.status.get_ca_client')
+    @mock.patch('nephos.fabric.status.ca_ingress')
+    def test_ca_probe_unreachable(self, mock_ca_ingress, mock_get_ca_client):
+        mock_ca_ingress.side_effect = [['a-ca.a-domain.com']]
+        mock_get_ca_client.return_value.cainfo.side_effect = [requests.ConnectionError('refused')]
+        assert ca_probe(self.CA) == ('unreachable', None)
+
+    @mock.patch('nephos.fabric.status.get_ca_client')
+    @mock.patch('nephos.fabric.status.ca_ingress')
+    def test_ca_probe_no_ingress(self, mock_ca_ingress, mock_get_ca_client):
+        mock_ca_ingress.side_effect = [None]
+        assert ca_probe(self.CA) == ('no ingress', None)
+        mock_get_ca_client.assert_not_called()
+
+
+class TestNetworkReleases:
+    def test_network_releases(self):
+        assert network_releases(OPTS, compile_topology(OPTS)) == [
+            Release('ca', 'a-ca', 'a-namespace'), Release('orderer', 'ord0', 'a-namespace'),
+            Release('couchdb', 'cdb-peer0', 'a-namespace'), Release('peer', 'peer0', 'a-namespace'),
+            Release('composer', 'hlc', 'a-namespace')]
+
+
+class TestGatherStatus:
+    @mock.patch('nephos.fabric.status.peer_channels')
+    @mock.patch('nephos.fabric.status.ca_probe')
+    @mock.patch('nephos.fabric.status.secret_list')
+    @mock.patch('nephos.fabric.status.release_pods')
+    @mock.patch('nephos.fabric.status.helm_releases')
+    def test_gather_status(self, mock_helm_releases, mock_release_pods, mock_secret_list, mock_ca_probe,
+                           mock_peer_channels):
+        mock_helm_releases.side_effect = [{
+            'a-ca': {'status': 'DEPLOYED'}, 'ord0': {'status': 'DEPLOYED'}, 'cdb-peer0': {'status': 'DEPLOYED'},
+            'peer0': {'status': 'DEPLOYED'}}]
+        mock_release_pods.side_effect = [{'a-ca': [make_pod(True, 0)], 'ord0': [make_pod(False, 3)],
+                                          'cdb-peer0': [make_pod(True, 0)], 'peer0': [make_pod(True, 1)]}]
+        cert = base64.b64encode(make_cert(datetime.datetime(2030, 6, 1))).decode('utf-8')
+        mock_secret_list.side_effect = [{'hlf--peer0-idcert': Secret({'cert.pem': cert})}]
+        mock_ca_probe.side_effect = [('reachable', '2029-01-01')]
+        mock_peer_channels.side_effect = [{'a-channel'}]
+        rows = gather_status(OPTS, compile_topology(OPTS))
+        assert [(row['release'], row['helm'], row['ready'], row['pods'], row['restarts']) for row in rows] == [
+            ('a-ca', 'DEPLOYED', 1, 1, 0), ('ord0', 'DEPLOYED', 0, 1, 3), ('cdb-peer0', 'DEPLOYED', 1, 1, 0),
+            ('peer0', 'DEPLOYED', 1, 1, 1), ('hlc', 'NOT INSTALLED', 0, 0, 0)]
+        assert (rows[0]['ca'], rows[0]['expires']) == ('reachable', '2029-01-01')
+        assert rows[1]['expires'] is None
+        assert (rows[3]['channels'], rows[3]['expires']) == (['a-channel'], '2030-06-01')
+        mock_release_pods.assert_called_once_with('a-namespace')
+        # Channels are only read from ready peers
+        mock_peer_channels.assert_called_once_with('a-namespace', 'peer0', verbose=False)
+
+
+class TestPrintStatus:
+    @mock.patch('nephos.fabric.status.print')
+    def test_print_status(self, mock_print):
+        print_status([{'release': 'peer0', 'kind': 'peer', 'namespace': 'a-namespace', 'helm': 'DEPLOYED',
+                       'pods': 1, 'ready': 1, 'restarts': 2, 'channels': ['a-channel', 'another-channel'],
+                       'ca': None, 'expires': '2030-06-01'}])
+        mock_print.assert_has_calls([
+            call('RELEASE  KIND  NAMESPACE    HELM      READY  RESTARTS  CHANNELS                   CA  CERT EXPIRES'),
+            call('peer0    peer  a-namespace  DEPLOYED  1/1    2         a-channel,another-channel  -   2030-06-01')
+        ])
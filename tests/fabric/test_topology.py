@@ -0,0 +1,134 @@
+from copy import deepcopy
+
+import pytest
+
+from nephos.fabric.topology import CA, Channel, MSP, Node, TopologyError, compile_topology
+
+
+class TestCompileTopology:
+    OPTS = {
+        'core': {'chart_repo': 'a-repo', 'dir_config': './a_dir', 'dir_values': './another_dir',
+                 'namespace': 'core-namespace'},
+        'cas': {'a-ca': {'namespace': 'ca-namespace', 'tls_cert': './a_cert.pem'}},
+        'msps': {
+            'ord_MSP': {'ca': 'a-ca', 'namespace': 'ord-namespace', 'org_admin': 'an-ord-admin'},
+            'peer_MSP': {'ca': 'a-ca', 'org_admin': 'a-peer-admin'}
+        },
+        'orderers': {'msp': 'ord_MSP', 'names': ['ord0', 'ord1'], 'secret_genesis': 'a-genesis-secret',
+                     'kafka': {'pod_num': 4}},
+        'peers': {'ca': 'a-ca', 'msp': 'peer_MSP', 'names': ['peer0'], 'channel_name': 'a-channel',
+                  'channel_profile': 'AChannel', 'secret_channel': 'a-channel-secret', 'max_parallel': 2},
+        'composer': {'name': 'hlc', 'secret_bna': 'a-bna-secret', 'secret_connection': 'a-connection-secret'}
+    }
+
+    def test_compile_topology(self):
+        topology = compile_topology(self.OPTS)
+        assert topology.cas['a-ca'] == CA(name='a-ca', namespace='ca-namespace', release='a-ca',
+                                          ingress='a-ca-hlf-ca', secret='a-ca-hlf-ca', tls_cert='./a_cert.pem')
+        assert topology.msps['peer_MSP'] == MSP(name='peer_MSP', ca='a-ca', namespace='core-namespace',
+                                                org_admin='a-peer-admin', admin_secret='hlf--a-peer-admin-admincred')
+        assert [node.name for node in topology.nodes] == ['ord0', 'ord1', 'peer0']
+        ord0 = topology.orderers[0]
+        assert (ord0.chart, ord0.namespace, ord0.depends_on) == ('hlf-ord', 'ord-namespace', ('a-ca', 'kafka-hlf'))
+        assert ord0.secrets['idcert'] == 'hlf--ord0-idcert'
+        assert topology.peers[0] == Node(
+            name='peer0', node_type='peer', chart='hlf-peer', msp='peer_MSP', namespace='core-namespace',
+            secrets=topology.peers[0].secrets, depends_on=('a-ca', 'cdb-peer0'))
+        assert topology.channels == (Channel(name='a-channel', profile='AChannel', secret='a-channel-secret',
+                                             peers=('peer0',)),)
+        assert topology.genesis_secret == 'a-genesis-secret'
+        assert topology.namespaces == ('core-namespace', 'ord-namespace', 'ca-namespace')
+
+    def test_compile_topology_immutable(self):
+        topology = compile_topology(self.OPTS)
+        with pytest.raises(AttributeError):
+            topology.peers = ()
+        with pytest.raises(AttributeError):
+            topology.peers[0].namespace = 'another-namespace'
+        with pytest.raises(TypeError):
+            topology.cas['another-ca'] = None
+        with pytest.raises(TypeError):
+            topology.peers[0].secrets['cred'] = 'another-secret'
+
+    def test_compile_topology_core(self):
+        topology = compile_topology({'core': self.OPTS['core']})
+        assert topology.nodes == ()
+        assert topology.channels == ()
+        assert topology.namespaces == ('core-namespace',)
+
+    def test_compile_topology_orgs(self):
+        opts = deepcopy(self.OPTS)
+        opts['msps']['another_MSP'] = {'ca': 'a-ca', 'namespace': 'another-namespace', 'org_admin': 'an-admin'}
+        opts['peers'] = [
+            opts['peers'],
+            {'msp': 'another_MSP', 'names': ['peer1', 'peer2'], 'channel_name': 'a-channel',
+             'channel_profile': 'AChannel', 'secret_channel': 'a-channel-secret'},
+            {'msp': 'ord_MSP', 'names': ['peer3'], 'channel_name': 'another-channel',
+             'channel_profile': 'AnotherChannel', 'secret_channel': 'another-channel-secret'}
+        ]
+        topology = compile_topology(opts)
+        assert [(peer.name, peer.namespace) for peer in topology.peers] == [
+            ('peer0', 'core-namespace'), ('peer1', 'another-namespace'), ('peer2', 'another-namespace'),
+            ('peer3', 'ord-namespace')]
+        # Organisations joining the same channel share it
+        assert [(channel.name, channel.peers) for channel in topology.channels] == [
+            ('a-channel', ('peer0', 'peer1', 'peer2')), ('another-channel', ('peer3',))]
+
+    def test_compile_topology_orgs_errors(self):
+        opts = deepcopy(self.OPTS)
+        opts['peers'] = [
+            dict(opts['peers'], ca='another-ca'),
+            {'msp': 'ord_MSP', 'names': ['ord0'], 'channel_name': 'a-channel'},
+            {'msp': 'ord_MSP', 'names': ['peer0'], 'channel_name': 'a-channel',
+             'channel_profile': 'AChannel', 'secret_channel': 'a-channel-secret'}
+        ]
+        with pytest.raises(TopologyError) as error:
+            compile_topology(opts)
+        assert sorted(error.value.errors) == sorted([
+            '"peers" lists organisation "ord_MSP" more than once',
+            'Release "ord0" is defined more than once, but Helm release names are cluster-wide',
+            # Release names clash across namespaces too, CouchDB releases included
+            'Release "peer0" is defined more than once, but Helm release names are cluster-wide',
+            'Release "cdb-peer0" is defined more than once, but Helm release names are cluster-wide',
+            '"peers[1]" is missing "channel_profile"',
+            '"peers[1]" is missing "secret_channel"',
+            '"peers[0]" uses CA "another-ca", which is not in "cas"'
+        ])
+
+    def test_compile_topology_release_clash(self):
+        opts = deepcopy(self.OPTS)
+        # The CA lives in another namespace, but Helm 2 release names are cluster-wide
+        opts['peers']['names'] = ['a-ca', 'cdb-peer0', 'peer0']
+        with pytest.raises(TopologyError) as error:
+            compile_topology(opts)
+        assert sorted(error.value.errors) == sorted([
+            'Release "a-ca" is defined more than once, but Helm release names are cluster-wide',
+            'Release "cdb-peer0" is defined more than once, but Helm release names are cluster-wide'
+        ])
+
+    def test_compile_topology_errors(self):
+        opts = deepcopy(self.OPTS)
+        del opts['core']['namespace']
+        del opts['core']['dir_values']
+        opts['msps']['ord_MSP']['ca'] = 'another-ca'
+        opts['orderers']['names'] = ['ord0', 'Ord_1', 'ord0']
+        opts['orderers']['max_unavailable'] = 0
+        opts['peers']['msp'] = 'ord_MSP'
+        opts['peers']['names'] = ['ord0']
+        del opts['peers']['channel_name']
+        del opts['peers']['ca']
+        with pytest.raises(TopologyError) as error:
+            compile_topology(opts)
+        # All problems are reported at once
+        assert sorted(error.value.errors) == sorted([
+            '"core" is missing "dir_values"',
+            '"msps.ord_MSP" uses CA "another-ca", which is not in "cas"',
+            '"msps.peer_MSP" has no namespace, and there is no core namespace',
+            '"orderers" has "max_unavailable" of 0, but it must be a positive integer',
+            '"orderers" lists node "ord0" more than once',
+            'Node release "Ord_1" must be a lowercase DNS label of at most 53 characters',
+            'Release "ord0" is defined more than once, but Helm release names are cluster-wide',
+            '"peers" is missing "channel_name"',
+            '"peers" is missing "ca", which Composer needs'
+        ])
+        assert isinstance(error.value, ValueError)
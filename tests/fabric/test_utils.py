@@ -4,7 +4,8 @@ from unittest import mock
 from kubernetes.client.rest import ApiException
 import pytest
 
-from nephos.fabric.utils import rand_string, credentials_secret, crypto_secret, get_pod
+from nephos.helpers.parallel import ParallelError
+from nephos.fabric.utils import rand_string, credentials_secret, get_pod, org_pipeline, setup_namespaces
 
 
 class TestRandString:
@@ -31,7 +32,7 @@ class TestCredentialsSecret:
         credentials_secret('a-secret', 'a-namespace', 'a-user')
         mock_secret_read.assert_called_once_with('a-secret', 'a-namespace', verbose=False)
         mock_rand_string.assert_called_once_with(24)
-        mock_secret_create.assert_called_once_with(self.SECRET_DATA, 'a-secret', 'a-namespace')
+        mock_secret_create.assert_called_once_with(self.SECRET_DATA, 'a-secret', 'a-namespace', labels=None)
 
     @mock.patch('nephos.fabric.utils.secret_read')
     @mock.patch('nephos.fabric.utils.secret_create')
@@ -66,44 +67,86 @@ class TestCredentialsSecret:
         mock_secret_create.assert_not_called()
 
 
-class TestCryptoSecret:
-    @mock.patch('nephos.fabric.utils.secret_from_file')
-    @mock.patch('nephos.fabric.utils.glob')
-    def test_crypto_secret(self, mock_glob, mock_secret_from_file):
-        mock_glob.side_effect = [['./a_path/a_file.txt']]
-        crypto_secret('a-secret', 'a-namespace', './a_dir', 'some_file.txt')
-        mock_glob.assert_called_once_with('./a_dir/*')
-        mock_secret_from_file.assert_called_once_with(
-            secret='a-secret', namespace='a-namespace', key='some_file.txt', filename='./a_path/a_file.txt', verbose=False)
-
-    @mock.patch('nephos.fabric.utils.secret_from_file')
-    @mock.patch('nephos.fabric.utils.glob')
-    def test_crypto_secret_fail(self, mock_glob, mock_secret_from_file):
-        mock_glob.side_effect = [[]]
-        with pytest.raises(Exception):
-            crypto_secret('a-secret', 'a-namespace', './a_dir', 'some_file.txt')
-        mock_glob.assert_called_once_with('./a_dir/*')
-        mock_secret_from_file.assert_not_called()
-
-
 class TestGetPod:
     @mock.patch('nephos.fabric.utils.Executer')
-    @mock.patch('nephos.fabric.utils.execute')
-    def test_get_pod(self, mock_execute, mock_Executer):
-        mock_execute.side_effect = ['a-pod']
+    @mock.patch('nephos.fabric.utils.pod_resolve')
+    def test_get_pod(self, mock_pod_resolve, mock_Executer):
+        mock_pod_resolve.side_effect = ['a-pod']
         get_pod('a-namespace', 'a-release', 'an-app')
-        mock_execute.assert_called_once_with(
-            'kubectl get pods -n a-namespace -l "app=an-app,release=a-release" ' +
-            '-o jsonpath="{.items[0].metadata.name}"', verbose=False)
+        mock_pod_resolve.assert_called_once_with('a-namespace', 'a-release', 'an-app', verbose=False)
         mock_Executer.assert_called_once_with('a-pod', namespace='a-namespace', verbose=False)
 
     @mock.patch('nephos.fabric.utils.Executer')
-    @mock.patch('nephos.fabric.utils.execute')
-    def test_get_pod_fail(self, mock_execute, mock_Executer):
-        mock_execute.side_effect = ['']
+    @mock.patch('nephos.fabric.utils.pod_resolve')
+    def test_get_pod_fail(self, mock_pod_resolve, mock_Executer):
+        mock_pod_resolve.side_effect = ValueError
         with pytest.raises(ValueError):
             get_pod('a-namespace', 'a-release', 'an-app', verbose=True)
-        mock_execute.assert_called_once_with(
-            'kubectl get pods -n a-namespace -l "app=an-app,release=a-release" ' +
-            '-o jsonpath="{.items[0].metadata.name}"', verbose=True)
+        mock_pod_resolve.assert_called_once_with('a-namespace', 'a-release', 'an-app', verbose=True)
         mock_Executer.assert_not_called()
+
+
+class TestSetupNamespaces:
+    OPTS = {
+        'core': {'namespace': 'core-namespace', 'chart_repo': 'a-repo', 'dir_config': './a_dir',
+                 'dir_values': './a_dir'},
+        'msps': {'ord_MSP': {'namespace': 'ord-namespace', 'ca': 'ord-ca', 'org_admin': 'an-admin'},
+                 'peer_MSP': {'namespace': 'peer-namespace', 'ca': 'peer-ca', 'org_admin': 'an-admin'}},
+        'cas': {'ord-ca': {'namespace': 'ord-namespace'}, 'peer-ca': {}}
+    }
+
+    @mock.patch('nephos.fabric.utils.ns_create')
+    def test_setup_namespaces(self, mock_ns_create):
+        result = setup_namespaces(self.OPTS)
+        assert result == ['core-namespace', 'ord-namespace', 'peer-namespace']
+        mock_ns_create.assert_has_calls([
+            mock.call('core-namespace', verbose=False),
+            mock.call('ord-namespace', verbose=False),
+            mock.call('peer-namespace', verbose=False)
+        ], any_order=True)
+        assert mock_ns_create.call_count == 3
+
+    @mock.patch('nephos.fabric.utils.ns_create')
+    def test_setup_namespaces_error(self, mock_ns_create):
+        mock_ns_create.side_effect = [True, ApiException(status=403), True]
+        with pytest.raises(ParallelError):
+            setup_namespaces(self.OPTS, verbose=True)
+        assert mock_ns_create.call_count == 3
+
+
+class TestOrgPipeline:
+    OPTS = {
+        'core': {'max_parallel': 4},
+        'peers': [{'msp': 'a_MSP', 'names': ['peer0']}, {'msp': 'another_MSP', 'names': ['peer1']}]
+    }
+
+    def test_org_pipeline(self):
+        calls = []
+        result = org_pipeline(self.OPTS, [lambda opts: calls.append(('first', opts['peers']['msp'])),
+                                          lambda opts: calls.append(('second', opts['peers']['names']))])
+        assert result == ['a_MSP', 'another_MSP']
+        assert sorted(calls) == [('first', 'a_MSP'), ('first', 'another_MSP'),
+                                 ('second', ['peer0']), ('second', ['peer1'])]
+        # Each stage runs after the previous stage of its organisation
+        assert calls.index(('first', 'a_MSP')) < calls.index(('second', ['peer0']))
+        assert calls.index(('first', 'another_MSP')) < calls.index(('second', ['peer1']))
+
+    def test_org_pipeline_single(self):
+        opts = {'core': {}, 'peers': {'msp': 'a_MSP', 'names': ['peer0']}}
+        stage = mock.Mock()
+        assert org_pipeline(opts, [stage]) == ['a_MSP']
+        stage.assert_called_once_with(opts)
+
+    def test_org_pipeline_error(self):
+        second_stage = mock.Mock()
+
+        def first_stage(opts):
+            if opts['peers']['msp'] == 'a_MSP':
+                raise ValueError('bad')
+
+        with pytest.raises(ParallelError) as error:
+            org_pipeline(self.OPTS, [first_stage, second_stage])
+        assert [item for item, _ in error.value.errors] == ['a_MSP']
+        # The other organisation carries on
+        second_stage.assert_called_once()
+        assert second_stage.call_args[0][0]['peers']['msp'] == 'another_MSP'
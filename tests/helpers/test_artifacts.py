@@ -0,0 +1,48 @@
+from collections import namedtuple
+import base64
+from unittest import mock
+
+import pytest
+
+from nephos.helpers.artifacts import artifact_matches, artifact_store
+
+# NamedTuples for mocking
+Secret = namedtuple('Secret', ('data',))
+
+
+def make_file(tmpdir, size):
+    content = b''.join(str(i * 7919 % 10007).encode('ascii') for i in range(size))[:size]
+    filename = str(tmpdir.join('an_artifact'))
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return filename, content
+
+
+class TestArtifactStore:
+    @mock.patch('nephos.helpers.artifacts.secret_from_file')
+    def test_artifact_store(self, mock_secret_from_file, tmpdir):
+        filename, _ = make_file(tmpdir, 100)
+        artifact_store('a-secret', 'a-namespace', 'a_key', filename, labels={'nephos/type': 'genesis'})
+        mock_secret_from_file.assert_called_once_with(secret='a-secret', namespace='a-namespace', key='a_key',
+                                                      filename=filename, labels={'nephos/type': 'genesis'},
+                                                      verbose=False)
+
+    @mock.patch('nephos.helpers.artifacts.secret_from_file')
+    def test_artifact_store_large(self, mock_secret_from_file, tmpdir):
+        filename, _ = make_file(tmpdir, 2000)
+        with pytest.raises(ValueError) as error:
+            artifact_store('a-secret', 'a-namespace', 'a_key', filename, max_bytes=1000)
+        assert str(error.value) == (
+            'a_key is 2000 bytes, over the 1000 bytes a secret can hold, so secret a-secret cannot be created')
+        mock_secret_from_file.assert_not_called()
+
+
+class TestArtifactMatches:
+    def test_artifact_matches(self, tmpdir):
+        filename, content = make_file(tmpdir, 100)
+        secret = Secret({'a.block': base64.b64encode(content).decode('utf-8')})
+        assert artifact_matches(secret, 'a.block', filename)
+        assert not artifact_matches(secret, 'another.block', filename)
+        assert not artifact_matches(Secret({'a.block': base64.b64encode(b'old').decode('utf-8')}),
+                                    'a.block', filename)
+        assert not artifact_matches(Secret(None), 'a.block', filename)
@@ -4,7 +4,7 @@ from unittest.mock import call
 
 import pytest
 
-from nephos.helpers.helm import helm_init, helm_check, helm_env_vars, helm_install, helm_upgrade
+from nephos.helpers.helm import helm_init, helm_check, helm_env_vars, helm_install, helm_releases, helm_upgrade
 
 # NamedTuples for mocking
 ConfigMap = namedtuple('ConfigMap', ('data',))
@@ -44,6 +44,36 @@ class TestHelmInit:
         mock_sleep.assert_not_called()
 
 
+class TestHelmReleases:
+    @mock.patch('nephos.helpers.helm.execute')
+    def test_helm_releases(self, mock_execute):
+        mock_execute.side_effect = [
+            '{"Next": "peer0", "Releases": [{"Name": "ca", "Chart": "hlf-ca-1.1.0", "Namespace": "cas", '
+            '"Status": "DEPLOYED"}]}',
+            '{"Next": "", "Releases": [{"Name": "peer0", "Chart": "hlf-peer-1.2.0", "Namespace": "peers", '
+            '"Status": "FAILED"}]}'
+        ]
+        assert helm_releases(page_size=1) == {
+            'ca': {'chart': 'hlf-ca-1.1.0', 'namespace': 'cas', 'status': 'DEPLOYED'},
+            'peer0': {'chart': 'hlf-peer-1.2.0', 'namespace': 'peers', 'status': 'FAILED'}
+        }
+        mock_execute.assert_has_calls([
+            call('helm list --all --output json --max 1', show_command=True),
+            call('helm list --all --output json --max 1 --offset peer0', show_command=False)
+        ])
+
+    @mock.patch('nephos.helpers.helm.execute')
+    def test_helm_releases_empty(self, mock_execute):
+        mock_execute.side_effect = ['\n']
+        assert helm_releases() == {}
+
+    @mock.patch('nephos.helpers.helm.execute')
+    def test_helm_releases_error(self, mock_execute):
+        mock_execute.side_effect = [None]
+        with pytest.raises(ValueError):
+            helm_releases()
+
+
 class TestHelmCheck:
     @mock.patch('nephos.helpers.helm.sleep')
     @mock.patch('nephos.helpers.helm.print')
@@ -109,10 +139,11 @@ class TestHelmEnvVars:
 
 
 class TestHelmInstall:
+    @mock.patch('nephos.helpers.helm.pod_invalidate')
     @mock.patch('nephos.helpers.helm.helm_env_vars')
     @mock.patch('nephos.helpers.helm.helm_check')
     @mock.patch('nephos.helpers.helm.execute')
-    def test_helm_install(self, mock_execute, mock_helm_check, mock_helm_env_vars):
+    def test_helm_install(self, mock_execute, mock_helm_check, mock_helm_env_vars, mock_pod_invalidate):
         mock_helm_env_vars.side_effect = ['']
         mock_execute.side_effect = [
             None,  # Helm list
@@ -125,6 +156,7 @@ class TestHelmInstall:
             call('helm install a_repo/an_app -n a-release --namespace a-namespace', verbose=False)
         ])
         mock_helm_check.assert_called_once_with('an_app', 'a-release', 'a-namespace', 1)
+        mock_pod_invalidate.assert_called_once_with('a-namespace', 'a-release')
 
     @mock.patch('nephos.helpers.helm.helm_env_vars')
     @mock.patch('nephos.helpers.helm.helm_check')
@@ -176,10 +208,11 @@ class TestHelmInstall:
 
 
 class TestHelmUpgrade:
+    @mock.patch('nephos.helpers.helm.pod_invalidate')
     @mock.patch('nephos.helpers.helm.helm_env_vars')
     @mock.patch('nephos.helpers.helm.helm_check')
     @mock.patch('nephos.helpers.helm.execute')
-    def test_helm_upgrade(self, mock_execute, mock_helm_check, mock_helm_env_vars):
+    def test_helm_upgrade(self, mock_execute, mock_helm_check, mock_helm_env_vars, mock_pod_invalidate):
         mock_helm_env_vars.side_effect = ['']
         mock_execute.side_effect = [
             'a-release',  # Helm list
@@ -192,6 +225,7 @@ class TestHelmUpgrade:
             call('helm upgrade a-release a_repo/an_app', verbose=False)
         ])
         mock_helm_check.assert_called_once_with('an_app', 'a-release', 'a-namespace', 1)
+        mock_pod_invalidate.assert_called_once_with('a-namespace', 'a-release')
 
     @mock.patch('nephos.helpers.helm.helm_env_vars')
     @mock.patch('nephos.helpers.helm.helm_check')
@@ -1,18 +1,41 @@
 from collections import namedtuple
+import io
+import os
+from subprocess import PIPE, Popen
+import tarfile
+from threading import Event, Thread
+import time
 from unittest import mock
+from unittest.mock import call
 
+from kubernetes.client import V1ListMeta
 from kubernetes.client.rest import ApiException
 import pytest
-
-from nephos.helpers.k8s import (Executer,
-                                context_get, ns_create, ns_read, ingress_read, cm_create, cm_read,
-                                get_app_info,
-                                secret_create, secret_read, secret_from_file)
+from urllib3.exceptions import ProtocolError
+
+from nephos.helpers.k8s import (BatchResult, Executer, HASH_ANNOTATION, IN_FLIGHT, NetworkingIngressApi,
+                                coalesce,
+                                context_get, ns_create, ns_read, objects_watch, ingress_read, cm_list, cm_read, cm_upsert,
+                                content_hash, get_app_info, label_selector, nephos_labels, objects_index, upsert,
+                                INGRESS_CACHE, ingress_invalidate,
+                                POD_CACHE, app_releases, pod_invalidate, pod_ready, pod_resolve, release_pods,
+                                secret_body, secret_create, secret_list, secret_read, secret_sync, secret_upsert,
+                                secret_from_file)
+from nephos.helpers.parallel import ParallelError
 
 # NamedTuples for mocking
 ConfigMap = namedtuple('ConfigMap', ('data',))
 Secret = namedtuple('Secret', ('data',))
 IngressHost = namedtuple('IngressHost', ('host',))
+Metadata = namedtuple('Metadata', ('name', 'annotations', 'resource_version'))
+Object = namedtuple('Object', ('metadata',))
+PodMetadata = namedtuple('PodMetadata', ('name', 'deletion_timestamp'))
+PodCondition = namedtuple('PodCondition', ('type', 'status'))
+PodStatus = namedtuple('PodStatus', ('phase', 'conditions'))
+Pod = namedtuple('Pod', ('metadata', 'status'))
+PodList = namedtuple('PodList', ('items',))
+LabelledMetadata = namedtuple('LabelledMetadata', ('name', 'labels', 'deletion_timestamp'))
+ObjectList = namedtuple('ObjectList', ('items', 'metadata'))
 
 
 class TestExecuter:
@@ -63,6 +86,117 @@ class TestExecuter:
             'kubectl logs a_pod -n a-namespace --container a_container --tail=10', verbose=True)
 
 
+    def test_executer_exec_args(self):
+        executer = Executer('a_pod', 'a-namespace', container='a_container')
+        assert executer.exec_args(['ls', '-l'], stdin=True) == [
+            'kubectl', 'exec', '-i', 'a_pod', '-n', 'a-namespace', '--container', 'a_container', '--', 'ls', '-l']
+
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_download(self, mock_popen, tmpdir):
+        # Remote tar archive of a folder with a file
+        remote = tmpdir.mkdir('remote')
+        remote.mkdir('msp').join('cert.pem').write_binary(b'\x00a-cert')
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(str(remote.join('msp')), arcname='msp')
+        archive.seek(0)
+        mock_popen.return_value.stdout = archive
+        mock_popen.return_value.stderr = io.BytesIO()
+        mock_popen.return_value.wait.return_value = 0
+        executer = Executer('a_pod', 'a-namespace', verbose=True)
+        local_dir = str(tmpdir.mkdir('local'))
+        with mock.patch('nephos.helpers.k8s.print') as mock_print:
+            assert executer.download('/var/msp/', local_dir) == os.path.join(local_dir, 'msp')
+        mock_popen.assert_called_once_with(
+            ['kubectl', 'exec', 'a_pod', '-n', 'a-namespace', '--', 'tar', 'cf', '-', '-C', '/var', 'msp'],
+            stdout=PIPE, stderr=PIPE)
+        with open(os.path.join(local_dir, 'msp', 'cert.pem'), 'rb') as f:
+            assert f.read() == b'\x00a-cert'
+        mock_print.assert_called_once_with('Completed download /var/msp/ in pod a_pod')
+
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_download_fail(self, mock_popen, tmpdir):
+        mock_popen.return_value.stdout = io.BytesIO()
+        mock_popen.return_value.stderr = io.BytesIO(b'No such file or directory')
+        mock_popen.return_value.wait.return_value = 2
+        executer = Executer('a_pod', 'a-namespace')
+        with pytest.raises(ValueError, match='No such file or directory'):
+            executer.download('/var/msp', str(tmpdir))
+
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_upload(self, mock_popen, tmpdir):
+        local = tmpdir.mkdir('channel')
+        local.join('channel.tx').write_binary(b'a-transaction')
+        stdin = io.BytesIO()
+        stdin.close = mock.Mock()
+        mock_popen.return_value.stdin = stdin
+        mock_popen.return_value.stderr = io.BytesIO()
+        mock_popen.return_value.wait.return_value = 0
+        executer = Executer('a_pod', 'a-namespace')
+        assert executer.upload(str(local), '/var') == '/var/channel'
+        mock_popen.assert_called_once_with(
+            ['kubectl', 'exec', '-i', 'a_pod', '-n', 'a-namespace', '--', 'tar', 'xf', '-', '-C', '/var'],
+            stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdin.seek(0)
+        with tarfile.open(fileobj=stdin, mode='r') as tar:
+            assert sorted(tar.getnames()) == ['channel', 'channel/channel.tx']
+            assert tar.extractfile('channel/channel.tx').read() == b'a-transaction'
+        stdin.close.assert_called_once_with()
+
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_upload_fail(self, mock_popen, tmpdir):
+        local = tmpdir.join('channel.tx')
+        local.write_binary(b'a-transaction')
+        mock_popen.return_value.stdin.write.side_effect = BrokenPipeError
+        mock_popen.return_value.stderr = io.BytesIO(b'Read-only file system')
+        mock_popen.return_value.wait.return_value = 2
+        executer = Executer('a_pod', 'a-namespace')
+        with pytest.raises(ValueError, match='Read-only file system'):
+            executer.upload(str(local), '/var')
+
+
+    @staticmethod
+    def local_shell(args, **kwargs):
+        # Run the batch script with a local shell instead of in a pod
+        assert args[:3] == ['kubectl', 'exec', '-i'] and args[-3:] == ['--', 'sh', '-s']
+        return Popen(['sh', '-s'], **kwargs)
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_batch(self, mock_popen, mock_print):
+        mock_popen.side_effect = self.local_shell
+        executer = Executer('a_pod', 'a-namespace')
+        results = executer.batch(['echo first', 'printf no-newline; exit 3', 'cat', 'echo last'])
+        mock_popen.assert_called_once()
+        assert results == [
+            BatchResult('echo first', 0, 'first\n'),
+            BatchResult('printf no-newline; exit 3', 3, 'no-newline')
+        ]
+        mock_print.assert_any_call('no-newline')
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_batch_continue(self, mock_popen, mock_print):
+        mock_popen.side_effect = self.local_shell
+        executer = Executer('a_pod', 'a-namespace', verbose=True)
+        results = executer.batch(['ls /non-existent-path', 'cat', 'echo "a b" >&2'], stop_on_error=False)
+        assert len(results) == 3
+        assert results[0].exit_code != 0
+        assert results[1].exit_code == results[2].exit_code == 0
+        # Commands do not read the rest of the script, and errors are part of the output
+        assert results[1].output == ''
+        assert results[2].output == 'a b\n'
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.Popen')
+    def test_executer_batch_fail(self, mock_popen, mock_print):
+        mock_popen.return_value.communicate.return_value = (b'', b'pods "a_pod" not found')
+        mock_popen.return_value.returncode = 1
+        executer = Executer('a_pod', 'a-namespace')
+        with pytest.raises(ValueError, match='not found'):
+            executer.batch(['echo first'])
+
+
 class TestContextGet:
     CONTEXTS = ({'all': 'contexts'}, {'active': 'context'})
 
@@ -85,38 +219,96 @@ class TestContextGet:
         assert context == self.CONTEXTS[1]
 
 
+class TestCoalesce:
+    def test_coalesce(self):
+        assert coalesce('secret', 'a-namespace', 'a-secret', lambda: 'a-result') == 'a-result'
+        assert IN_FLIGHT == {}
+
+    def test_coalesce_concurrent(self):
+        release = Event()
+        reads = []
+        results = []
+
+        def read():
+            reads.append(1)
+            release.wait(5)
+            return 'a-result'
+
+        threads = [Thread(target=lambda: results.append(coalesce('secret', 'a-namespace', 'a-secret', read)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # Give all callers time to join the request in flight
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert reads == [1]
+        assert results == ['a-result'] * 4
+        assert IN_FLIGHT == {}
+
+    def test_coalesce_error(self):
+        def read():
+            raise ApiException(status=404)
+
+        with pytest.raises(ApiException):
+            coalesce('secret', 'a-namespace', 'a-secret', read)
+        assert IN_FLIGHT == {}
+
+
 class TestNsCreate:
     @mock.patch('nephos.helpers.k8s.print')
     @mock.patch('nephos.helpers.k8s.api')
-    @mock.patch('nephos.helpers.k8s.ns_read')
-    def test_ns_create_new(self, mock_ns_read, mock_api, mock_print):
-        # TODO: We should ideally replicate the correct API exception
-        mock_ns_read.side_effect = ApiException()
-        ns_create('a-namespace')
-        mock_ns_read.assert_called_once_with('a-namespace', verbose=False)
+    def test_ns_create_new(self, mock_api, mock_print):
+        assert ns_create('a-namespace') is True
         mock_api.create_namespace.assert_called_once()
         mock_print.assert_not_called()
 
     @mock.patch('nephos.helpers.k8s.print')
     @mock.patch('nephos.helpers.k8s.api')
-    @mock.patch('nephos.helpers.k8s.ns_read')
-    def test_ns_create_new_verbose(self, mock_ns_read, mock_api, mock_print):
-        # TODO: We should ideally replicate the correct API exception
-        mock_ns_read.side_effect = ApiException()
-        ns_create('a-namespace', verbose=True)
-        mock_ns_read.assert_called_once_with('a-namespace', verbose=True)
+    def test_ns_create_new_verbose(self, mock_api, mock_print):
+        assert ns_create('a-namespace', verbose=True) is True
         mock_api.create_namespace.assert_called_once()
         mock_print.assert_called_once_with('Created namespace "a-namespace"')
 
     @mock.patch('nephos.helpers.k8s.print')
     @mock.patch('nephos.helpers.k8s.api')
+    def test_ns_create_old(self, mock_api, mock_print):
+        mock_api.create_namespace.side_effect = ApiException(status=409)
+        assert ns_create('a-namespace', verbose=True) is False
+        mock_api.create_namespace.assert_called_once()
+        mock_print.assert_not_called()
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.ns_read')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_ns_create_forbidden(self, mock_api, mock_ns_read, mock_print):
+        mock_api.create_namespace.side_effect = ApiException(status=403)
+        # The namespace exists, although we may not create namespaces
+        assert ns_create('a-namespace', verbose=True) is False
+        mock_ns_read.assert_called_once_with('a-namespace')
+        mock_print.assert_not_called()
+
+    @mock.patch('nephos.helpers.k8s.print')
     @mock.patch('nephos.helpers.k8s.ns_read')
-    def test_ns_create_old(self, mock_ns_read, mock_api, mock_print):
-        ns_create('a-namespace')
-        mock_ns_read.assert_called_once_with('a-namespace', verbose=False)
-        mock_api.create_namespace.assert_not_called()
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_ns_create_error(self, mock_api, mock_ns_read, mock_print):
+        mock_api.create_namespace.side_effect = ApiException(status=403)
+        mock_ns_read.side_effect = ApiException(status=404)
+        with pytest.raises(ApiException) as error:
+            ns_create('a-namespace')
+        # The error of the create call is the one reported
+        assert error.value.status == 403
         mock_print.assert_not_called()
 
+    @mock.patch('nephos.helpers.k8s.ns_read')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_ns_create_error_other(self, mock_api, mock_ns_read):
+        mock_api.create_namespace.side_effect = ApiException(status=500)
+        with pytest.raises(ApiException):
+            ns_create('a-namespace')
+        mock_ns_read.assert_not_called()
+
 
 class TestNsRead:
     @mock.patch('nephos.helpers.k8s.pretty_print')
@@ -134,34 +326,429 @@ class TestNsRead:
         mock_pretty_print.assert_called_once()
 
 
+def make_pod(name, phase='Running', ready=True, terminating=False):
+    return Pod(PodMetadata(name, 'a-timestamp' if terminating else None),
+               PodStatus(phase, [PodCondition('Ready', 'True' if ready else 'False')]))
+
+
+class TestPodReady:
+    def test_pod_ready(self):
+        assert pod_ready(make_pod('a-pod')) is True
+
+    def test_pod_ready_not_ready(self):
+        assert pod_ready(make_pod('a-pod', ready=False)) is False
+        assert pod_ready(make_pod('a-pod', phase='Pending')) is False
+        assert pod_ready(make_pod('a-pod', terminating=True)) is False
+
+
+class TestPodResolve:
+    def setup_method(self):
+        POD_CACHE.clear()
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_pod_resolve(self, mock_api, mock_print):
+        mock_api.list_namespaced_pod.side_effect = [PodList([
+            make_pod('old-pod', terminating=True), make_pod('new-pod', ready=False), make_pod('ready-pod')])]
+        assert pod_resolve('a-namespace', 'a-release', 'an-app', verbose=True) == 'ready-pod'
+        # Second time around, the pod is cached
+        assert pod_resolve('a-namespace', 'a-release', 'an-app') == 'ready-pod'
+        mock_api.list_namespaced_pod.assert_called_once_with(
+            namespace='a-namespace', label_selector='app=an-app,release=a-release')
+        mock_print.assert_called_once_with('Resolved pod ready-pod for release a-release')
+
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_pod_resolve_not_ready(self, mock_api):
+        mock_api.list_namespaced_pod.side_effect = [PodList([make_pod('new-pod', ready=False)]),
+                                                    PodList([make_pod('new-pod')])]
+        assert pod_resolve('a-namespace', 'a-release', 'an-app') == 'new-pod'
+        assert pod_resolve('a-namespace', 'a-release', 'an-app') == 'new-pod'
+        # Pods that are not Ready are not cached
+        assert mock_api.list_namespaced_pod.call_count == 2
+
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_pod_resolve_missing(self, mock_api):
+        mock_api.list_namespaced_pod.side_effect = [PodList([make_pod('old-pod', terminating=True)])]
+        with pytest.raises(ValueError):
+            pod_resolve('a-namespace', 'a-release', 'an-app')
+
+
+class TestPodInvalidate:
+    def test_pod_invalidate(self):
+        POD_CACHE.clear()
+        POD_CACHE.update({('a-namespace', 'an-app', 'a-release'): 'a-pod',
+                          ('a-namespace', 'an-app', 'another-release'): 'another-pod'})
+        pod_invalidate('a-namespace', 'a-release')
+        assert POD_CACHE == {('a-namespace', 'an-app', 'another-release'): 'another-pod'}
+        pod_invalidate()
+        assert POD_CACHE == {}
+
+
+class TestReleasePods:
+    @mock.patch('nephos.helpers.k8s.objects_index')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_release_pods(self, mock_api, mock_objects_index):
+        peer0 = Object(LabelledMetadata('peer0-pod', {'app': 'hlf-peer', 'release': 'peer0'}, None))
+        cdb0 = Object(LabelledMetadata('cdb-peer0-pod', {'app': 'hlf-couchdb', 'release': 'cdb-peer0'}, None))
+        peer0_old = Object(LabelledMetadata('peer0-old-pod', {'app': 'hlf-peer', 'release': 'peer0'}, 'a-time'))
+        other = Object(LabelledMetadata('other-pod', None, None))
+        mock_objects_index.side_effect = [
+            {'peer0-pod': peer0, 'cdb-peer0-pod': cdb0, 'peer0-old-pod': peer0_old, 'other-pod': other}]
+        assert release_pods('a-namespace') == {'peer0': [peer0], 'cdb-peer0': [cdb0]}
+        mock_objects_index.assert_called_once_with(mock_api.list_namespaced_pod, 'a-namespace', {})
+
+
+class TestAppReleases:
+    @mock.patch('nephos.helpers.k8s.objects_index')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_app_releases(self, mock_api, mock_objects_index):
+        mock_objects_index.side_effect = [{
+            'peer0-pod': Object(LabelledMetadata('peer0-pod', {'app': 'hlf-peer', 'release': 'peer0'}, None)),
+            'peer1-pod': Object(LabelledMetadata('peer1-pod', {'app': 'hlf-peer', 'release': 'peer1'}, None)),
+            'peer2-pod': Object(LabelledMetadata('peer2-pod', {'app': 'hlf-peer', 'release': 'peer2'}, 'a-time')),
+            'other-pod': Object(LabelledMetadata('other-pod', None, None))
+        }]
+        assert app_releases('a-namespace', 'hlf-peer') == {'peer0', 'peer1'}
+        mock_objects_index.assert_called_once_with(
+            mock_api.list_namespaced_pod, 'a-namespace', {'app': 'hlf-peer'})
+
+
+class TestNetworkingIngressApi:
+    def test_read_namespaced_ingress(self):
+        mock_api_client = mock.Mock()
+        mock_api_client.call_api.side_effect = ['an-ingress']
+        ingress_api = NetworkingIngressApi(mock_api_client)
+        assert ingress_api.read_namespaced_ingress(name='an_ingress', namespace='a-namespace') == 'an-ingress'
+        mock_api_client.call_api.assert_called_once_with(
+            '/apis/networking.k8s.io/v1/namespaces/{namespace}/ingresses/{name}', 'GET',
+            path_params={'name': 'an_ingress', 'namespace': 'a-namespace'},
+            header_params={'Accept': 'application/json'}, response_type='object',
+            auth_settings=['BearerToken'], _return_http_data_only=True)
+
+
 class TestIngressRead:
+    def setup_method(self):
+        INGRESS_CACHE.clear()
+
     @mock.patch('nephos.helpers.k8s.pretty_print')
+    @mock.patch('nephos.helpers.k8s.api_net')
     @mock.patch('nephos.helpers.k8s.api_ext')
-    def ingress_read(self, mock_api_ext, mock_pretty_print):
+    def test_ingress_read(self, mock_api_ext, mock_api_net, mock_pretty_print):
         mock_ingress = mock.Mock()
-        mock_ingress.spec.rules.side_effect = [IngressHost('a-url'), IngressHost('another-url')]
+        mock_ingress.spec.rules = [IngressHost('a-url'), IngressHost('another-url')]
         mock_api_ext.read_namespaced_ingress.side_effect = [mock_ingress]
-        ingress_read('an_ingress', 'a-namespace')
-        mock_api_ext.read_namespaced_ingress.assert_called_once_with(
-            name='an_ingress', namespace='a-namespace', verbose=False)
+        assert ingress_read('an_ingress', 'a-namespace', verbose=True) == ['a-url', 'another-url']
+        # Second time around, the hosts are cached
+        assert ingress_read('an_ingress', 'a-namespace') == ['a-url', 'another-url']
+        mock_api_ext.read_namespaced_ingress.assert_called_once_with(name='an_ingress', namespace='a-namespace')
+        mock_api_net.read_namespaced_ingress.assert_not_called()
         mock_pretty_print.assert_called_once_with('["a-url", "another-url"]')
 
     @mock.patch('nephos.helpers.k8s.pretty_print')
+    @mock.patch('nephos.helpers.k8s.api_net')
+    @mock.patch('nephos.helpers.k8s.api_ext')
+    def test_ingress_read_refresh(self, mock_api_ext, mock_api_net, mock_pretty_print):
+        mock_ingress = mock.Mock()
+        mock_ingress.spec.rules = [IngressHost('a-url')]
+        mock_api_ext.read_namespaced_ingress.side_effect = [mock_ingress, mock_ingress]
+        ingress_read('an_ingress', 'a-namespace')
+        ingress_read('an_ingress', 'a-namespace', refresh=True)
+        assert mock_api_ext.read_namespaced_ingress.call_count == 2
+
+    @mock.patch('nephos.helpers.k8s.pretty_print')
+    @mock.patch('nephos.helpers.k8s.api_net')
+    @mock.patch('nephos.helpers.k8s.api_ext')
+    def test_ingress_read_networking(self, mock_api_ext, mock_api_net, mock_pretty_print):
+        mock_ingress = mock.Mock()
+        mock_ingress.spec.rules = [IngressHost('a-url')]
+        mock_api_ext.read_namespaced_ingress.side_effect = [ApiException(status=404)]
+        mock_api_net.read_namespaced_ingress.side_effect = [mock_ingress]
+        assert ingress_read('an_ingress', 'a-namespace') == ['a-url']
+        mock_api_net.read_namespaced_ingress.assert_called_once_with(name='an_ingress', namespace='a-namespace')
+
+    @mock.patch('nephos.helpers.k8s.pretty_print')
+    @mock.patch('nephos.helpers.k8s.api_net')
+    @mock.patch('nephos.helpers.k8s.api_ext')
+    def test_ingress_read_networking_dict(self, mock_api_ext, mock_api_net, mock_pretty_print):
+        mock_api_ext.read_namespaced_ingress.side_effect = [ApiException(status=404)]
+        # Older clients read networking.k8s.io/v1 ingresses as plain dicts
+        mock_api_net.read_namespaced_ingress.side_effect = [{'spec': {'rules': [
+            {'host': 'a-url', 'http': {'paths': [{'backend': {'service': {'name': 'a-service'}}}]}}]}}]
+        assert ingress_read('another_ingress', 'a-namespace') == ['a-url']
+
+    @mock.patch('nephos.helpers.k8s.pretty_print')
+    @mock.patch('nephos.helpers.k8s.api_net')
     @mock.patch('nephos.helpers.k8s.api_ext')
-    def ingress_read_fail(self, mock_api_ext, mock_pretty_print):
-        mock_api_ext.read_namespaced_ingress.side_effect = [ApiException]
+    def test_ingress_read_fail(self, mock_api_ext, mock_api_net, mock_pretty_print):
+        mock_api_ext.read_namespaced_ingress.side_effect = [ApiException(status=404)]
+        mock_api_net.read_namespaced_ingress.side_effect = [ApiException(status=404)]
         with pytest.raises(ApiException):
             ingress_read('an_ingress', 'a-namespace', verbose=True)
-        mock_api_ext.read_namespaced_ingress.assert_called_once_with(
-            name='an_ingress', namespace='a-namespace', verbose=True)
         mock_pretty_print.assert_not_called()
+        # Failures are not cached
+        assert INGRESS_CACHE == {}
+
+    @mock.patch('nephos.helpers.k8s.api_net', None)
+    @mock.patch('nephos.helpers.k8s.api_ext')
+    def test_ingress_read_error(self, mock_api_ext):
+        mock_api_ext.read_namespaced_ingress.side_effect = [ApiException(status=403)]
+        with pytest.raises(ApiException):
+            ingress_read('an_ingress', 'a-namespace')
+
+    @mock.patch('nephos.helpers.k8s.api_net', None)
+    @mock.patch('nephos.helpers.k8s.api_ext', None)
+    def test_ingress_read_noapi(self):
+        with pytest.raises(NotImplementedError):
+            ingress_read('an_ingress', 'a-namespace')
+
+
+class TestIngressInvalidate:
+    def test_ingress_invalidate(self):
+        INGRESS_CACHE.clear()
+        INGRESS_CACHE.update({('a-namespace', 'a-release-hlf-ca'): ['a-url'],
+                              ('a-namespace', 'another-release-hlf-ca'): ['another-url']})
+        ingress_invalidate('a-namespace', 'a-release')
+        assert INGRESS_CACHE == {('a-namespace', 'another-release-hlf-ca'): ['another-url']}
+
+
+class TestObjectsWatch:
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.watch')
+    def test_objects_watch(self, mock_watch, mock_print):
+        stop = Event()
+        events = []
+        mock_list = mock.Mock()
+        mock_watch.Watch.return_value.stream.side_effect = [
+            ApiException(reason='Gone'),
+            [{'type': 'ADDED', 'object': 'a-secret'}],
+            [{'type': 'DELETED', 'object': 'a-secret'}, {'type': 'ADDED', 'object': 'another-secret'}]
+        ]
+
+        def on_event(event_type, item):
+            events.append((event_type, item))
+            if event_type == 'DELETED':
+                stop.set()
+
+        thread = objects_watch(mock_list, 'a-namespace', on_event, stop, timeout_seconds=5, retry_delay=0)
+        thread.join(5)
+        assert not thread.is_alive()
+        assert events == [('ADDED', 'a-secret'), ('DELETED', 'a-secret')]
+        mock_watch.Watch.return_value.stream.assert_called_with(mock_list, namespace='a-namespace', timeout_seconds=5)
+        mock_print.assert_called_once_with('Watch in namespace a-namespace failed, retrying: Gone')
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.watch')
+    def test_objects_watch_connection(self, mock_watch, mock_print):
+        stop = Event()
+        events = []
+        mock_watch.Watch.return_value.stream.side_effect = [
+            ProtocolError('Connection broken'),
+            [{'type': 'DELETED', 'object': 'a-secret'}]
+        ]
+
+        def on_event(event_type, item):
+            events.append((event_type, item))
+            stop.set()
+
+        thread = objects_watch(mock.Mock(), 'a-namespace', on_event, stop, retry_delay=0)
+        thread.join(5)
+        assert not thread.is_alive()
+        # The watch survives losing its connection to the API server
+        assert events == [('DELETED', 'a-secret')]
+        mock_print.assert_called_once_with(
+            'Watch in namespace a-namespace lost its connection, retrying: Connection broken')
+
+
+class TestContentHash:
+    def test_content_hash(self):
+        assert content_hash({'a': '1', 'b': '2'}) == content_hash({'b': '2', 'a': '1'})
+        assert content_hash({'a': '1'}) != content_hash({'a': '2'})
+
+
+class TestSecretBody:
+    def test_secret_body(self):
+        secret = secret_body({'a_key': 'a_value'}, 'a_secret')
+        assert secret.metadata.name == 'a_secret'
+        assert secret.data == {'a_key': 'YV92YWx1ZQ=='}
+        assert secret.metadata.annotations == {HASH_ANNOTATION: content_hash({'a_key': 'YV92YWx1ZQ=='})}
+        assert secret.metadata.labels == {'app.kubernetes.io/managed-by': 'nephos'}
+
+    def test_secret_body_labels(self):
+        secret = secret_body({'a_key': 'a_value'}, 'a_secret', labels={'a-label': 'a-value'})
+        assert secret.metadata.labels == {'app.kubernetes.io/managed-by': 'nephos', 'a-label': 'a-value'}
+
+
+class TestLabelSelector:
+    def test_label_selector(self):
+        assert label_selector({'b': '2', 'a': '1'}) == 'a=1,b=2'
+
+
+class TestUpsert:
+    BODY = secret_body({'a_key': 'a_value'}, 'a_secret')
+
+    def current(self, content_hash):
+        return Object(Metadata('a_secret', {HASH_ANNOTATION: content_hash}, '42'))
+
+    def test_upsert_created(self):
+        mock_create, mock_read, mock_replace = mock.Mock(), mock.Mock(), mock.Mock()
+        result = upsert(mock_create, mock_read, mock_replace, self.BODY, 'a-namespace')
+        assert result == 'created'
+        mock_create.assert_called_once_with(namespace='a-namespace', body=self.BODY)
+        mock_read.assert_not_called()
+        mock_replace.assert_not_called()
+
+    def test_upsert_unchanged(self):
+        mock_create, mock_read, mock_replace = mock.Mock(), mock.Mock(), mock.Mock()
+        mock_create.side_effect = ApiException(status=409)
+        mock_read.side_effect = [self.current(self.BODY.metadata.annotations[HASH_ANNOTATION])]
+        result = upsert(mock_create, mock_read, mock_replace, self.BODY, 'a-namespace')
+        assert result == 'unchanged'
+        mock_read.assert_called_once_with(name='a_secret', namespace='a-namespace')
+        mock_replace.assert_not_called()
+
+    def test_upsert_updated(self):
+        mock_create, mock_read, mock_replace = mock.Mock(), mock.Mock(), mock.Mock()
+        mock_create.side_effect = ApiException(status=409)
+        mock_read.side_effect = [self.current('an-old-hash')]
+        body = secret_body({'a_key': 'a_value'}, 'a_secret')
+        result = upsert(mock_create, mock_read, mock_replace, body, 'a-namespace')
+        assert result == 'updated'
+        mock_replace.assert_called_once_with(name='a_secret', namespace='a-namespace', body=body)
+        assert body.metadata.resource_version == '42'
+
+    def test_upsert_error(self):
+        mock_create, mock_read, mock_replace = mock.Mock(), mock.Mock(), mock.Mock()
+        mock_create.side_effect = ApiException(status=403)
+        with pytest.raises(ApiException):
+            upsert(mock_create, mock_read, mock_replace, self.BODY, 'a-namespace')
+        mock_read.assert_not_called()
+        mock_replace.assert_not_called()
 
 
-class TestCmCreate:
+class TestCmUpsert:
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.upsert')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_cm_upsert(self, mock_api, mock_upsert, mock_print):
+        mock_upsert.side_effect = ['created']
+        assert cm_upsert({'a_key': 'a_value'}, 'a_configmap', 'a-namespace', verbose=True) == 'created'
+        args = mock_upsert.call_args[0]
+        assert args[:3] == (mock_api.create_namespaced_config_map, mock_api.read_namespaced_config_map,
+                            mock_api.replace_namespaced_config_map)
+        assert args[3].data == {'a_key': 'a_value'}
+        mock_print.assert_called_once_with('Created configmap a_configmap in namespace a-namespace')
+
+
+class TestSecretUpsert:
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.upsert')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_secret_upsert(self, mock_api, mock_upsert, mock_print):
+        mock_upsert.side_effect = ['unchanged']
+        assert secret_upsert({'a_key': 'a_value'}, 'a_secret', 'a-namespace', verbose=True) == 'unchanged'
+        args = mock_upsert.call_args[0]
+        assert args[:3] == (mock_api.create_namespaced_secret, mock_api.read_namespaced_secret,
+                            mock_api.replace_namespaced_secret)
+        assert args[3].data == {'a_key': 'YV92YWx1ZQ=='}
+        mock_print.assert_not_called()
+
+
+class TestNephosLabels:
+    def test_nephos_labels(self):
+        assert nephos_labels(msp='a_MSP', node='peer0', type='idcert') == {
+            'nephos/msp': 'a_MSP', 'nephos/node': 'peer0', 'nephos/type': 'idcert'}
+
+    def test_nephos_labels_missing(self):
+        assert nephos_labels(msp='a_MSP', node=None, type='genesis') == {
+            'nephos/msp': 'a_MSP', 'nephos/type': 'genesis'}
+
+
+class TestObjectsIndex:
+    def test_objects_index(self):
+        secret0 = Object(Metadata('a_secret', {}, '1'))
+        secret1 = Object(Metadata('another_secret', {}, '2'))
+        mock_list = mock.Mock()
+        mock_list.side_effect = [ObjectList([secret0], V1ListMeta(_continue='a-token')),
+                                 ObjectList([secret1], V1ListMeta())]
+        assert objects_index(mock_list, 'a-namespace', limit=1) == {
+            'a_secret': secret0, 'another_secret': secret1}
+        mock_list.assert_has_calls([
+            call(namespace='a-namespace', label_selector='app.kubernetes.io/managed-by=nephos', limit=1),
+            call(namespace='a-namespace', label_selector='app.kubernetes.io/managed-by=nephos', limit=1,
+                 _continue='a-token')
+        ])
+
+    def test_objects_index_labels(self):
+        mock_list = mock.Mock()
+        mock_list.side_effect = [ObjectList([], V1ListMeta(_continue=''))]
+        assert objects_index(mock_list, 'a-namespace', labels={'nephos/type': 'cred', 'nephos/msp': 'a_MSP'}) == {}
+        mock_list.assert_called_once_with(namespace='a-namespace',
+                                          label_selector='nephos/msp=a_MSP,nephos/type=cred', limit=250)
+
+
+class TestSecretList:
+    @mock.patch('nephos.helpers.k8s.objects_index')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_secret_list(self, mock_api, mock_objects_index):
+        mock_objects_index.side_effect = [{'a_secret': 'a-secret-object'}]
+        assert secret_list('a-namespace') == {'a_secret': 'a-secret-object'}
+        mock_objects_index.assert_called_once_with(
+            mock_api.list_namespaced_secret, 'a-namespace', {'app.kubernetes.io/managed-by': 'nephos'})
+
+
+class TestCmList:
+    @mock.patch('nephos.helpers.k8s.objects_index')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_cm_list(self, mock_api, mock_objects_index):
+        mock_objects_index.side_effect = [{'a_cm': 'a-cm-object'}]
+        assert cm_list('a-namespace', labels={'nephos/type': 'connection'}) == {'a_cm': 'a-cm-object'}
+        mock_objects_index.assert_called_once_with(
+            mock_api.list_namespaced_config_map, 'a-namespace', {'nephos/type': 'connection'})
+
+
+class TestSecretSync:
+    SECRETS = {'new_secret': {'a_key': 'new'},
+               'same_secret': {'a_key': 'same'},
+               'changed_secret': {'a_key': 'changed'}}
+
+    @mock.patch('nephos.helpers.k8s.print')
+    @mock.patch('nephos.helpers.k8s.upsert')
+    @mock.patch('nephos.helpers.k8s.secret_list')
+    @mock.patch('nephos.helpers.k8s.api')
+    def test_secret_sync(self, mock_api, mock_secret_list, mock_upsert, mock_print):
+        same_hash = secret_body({'a_key': 'same'}, 'same_secret').metadata.annotations[HASH_ANNOTATION]
+        mock_secret_list.side_effect = [{
+            'same_secret': Object(Metadata('same_secret', {HASH_ANNOTATION: same_hash}, '1')),
+            'changed_secret': Object(Metadata('changed_secret', {HASH_ANNOTATION: 'old-hash'}, '2'))
+        }]
+        mock_upsert.side_effect = ['created']
+        results = secret_sync(self.SECRETS, 'a-namespace', labels={'new_secret': {'nephos/type': 'idcert'}},
+                              verbose=True)
+        assert results == {'new_secret': 'created', 'same_secret': 'unchanged', 'changed_secret': 'updated'}
+        mock_secret_list.assert_called_once_with('a-namespace')
+        mock_upsert.assert_called_once()
+        assert mock_upsert.call_args[0][3].metadata.name == 'new_secret'
+        assert mock_upsert.call_args[0][3].metadata.labels == {
+            'app.kubernetes.io/managed-by': 'nephos', 'nephos/type': 'idcert'}
+        mock_api.replace_namespaced_secret.assert_called_once()
+        replaced = mock_api.replace_namespaced_secret.call_args[1]
+        assert replaced['name'] == 'changed_secret'
+        assert replaced['body'].metadata.resource_version == '2'
+        mock_print.assert_has_calls([
+            call('Created secret new_secret in namespace a-namespace'),
+            call('Updated secret changed_secret in namespace a-namespace')
+        ], any_order=True)
+
+    @mock.patch('nephos.helpers.k8s.upsert')
+    @mock.patch('nephos.helpers.k8s.secret_list')
     @mock.patch('nephos.helpers.k8s.api')
-    def test_cm_create(self, mock_api):
-        cm_create('a-namespace', 'a_configmap', {'a_key': 'a_value'})
-        mock_api.create_namespaced_config_map.assert_called_once()
+    def test_secret_sync_error(self, mock_api, mock_secret_list, mock_upsert):
+        mock_secret_list.side_effect = [{}]
+        mock_upsert.side_effect = [ApiException(status=500), 'created', 'created']
+        with pytest.raises(ParallelError) as error:
+            secret_sync(self.SECRETS, 'a-namespace', max_workers=1)
+        assert [name for name, _ in error.value.errors] == ['new_secret']
+        assert mock_upsert.call_count == 3
 
 
 class TestCmRead:
@@ -245,13 +832,25 @@ class TestSecretFromFile:
     @mock.patch('nephos.helpers.k8s.input_files')
     @mock.patch('nephos.helpers.k8s.secret_create')
     @mock.patch('nephos.helpers.k8s.secret_read')
-    def test_secret_from_file_define(self, mock_secret_read, mock_secret_create, mock_input_files, mock_open):
-        mock_secret_read.side_effect = ApiException()
-        secret_from_file('a_secret', 'a-namespace', filename='./some_file.txt')
+    def test_secret_from_file_again(self, mock_secret_read, mock_secret_create, mock_input_files, mock_open):
+        secret_from_file('a_secret', 'a-namespace')
         mock_secret_read.assert_called_once()
-        mock_secret_create.assert_called_once()
+        mock_secret_create.assert_not_called()
+        mock_input_files.assert_not_called()
+        mock_open.assert_not_called()
+
+    @mock.patch('nephos.helpers.k8s.open')
+    @mock.patch('nephos.helpers.k8s.input_files')
+    @mock.patch('nephos.helpers.k8s.secret_upsert')
+    @mock.patch('nephos.helpers.k8s.secret_read')
+    def test_secret_from_file_define(self, mock_secret_read, mock_secret_upsert, mock_input_files, mock_open):
+        mock_open.return_value.__enter__.return_value.read.side_effect = [b'some-data']
+        secret_from_file('a_secret', 'a-namespace', key='a_key', filename='./some_file.txt', verbose=True)
+        mock_secret_read.assert_not_called()
+        mock_secret_upsert.assert_called_once_with({'a_key': b'some-data'}, 'a_secret', 'a-namespace',
+                                                   labels=None, verbose=True)
         mock_input_files.assert_not_called()
-        mock_open.assert_called_once()
+        mock_open.assert_called_once_with('./some_file.txt', 'rb')
 
 
 class TestGetAppInfo:
@@ -0,0 +1,69 @@
+from threading import Barrier
+from unittest import mock
+from unittest.mock import call
+
+import pytest
+
+from nephos.helpers.parallel import ParallelError, parallel_map, parallel_pipeline, rolling_pipeline
+
+
+class TestParallelError:
+    def test_parallel_error(self):
+        error = ParallelError([('item0', ValueError('bad'))])
+        assert error.errors[0][0] == 'item0'
+        assert str(error) == "1 parallel task(s) failed: item0: ValueError('bad')"
+
+
+class TestParallelPipeline:
+    def test_parallel_pipeline(self):
+        mock_stage0 = mock.Mock(side_effect=lambda item: item + '-0')
+        mock_stage1 = mock.Mock(side_effect=lambda item: item + '-1')
+        result = parallel_pipeline([mock_stage0, mock_stage1], ['a', 'b'])
+        assert result == ['a-1', 'b-1']
+        mock_stage0.assert_has_calls([call('a'), call('b')], any_order=True)
+        mock_stage1.assert_has_calls([call('a'), call('b')], any_order=True)
+
+    def test_parallel_pipeline_concurrent(self):
+        # Both items must be in flight at the same time for the barrier to release
+        barrier = Barrier(2, timeout=5)
+        result = parallel_pipeline([lambda item: barrier.wait() is not None and item], ['a', 'b'])
+        assert result == ['a', 'b']
+
+    def test_parallel_pipeline_empty(self):
+        mock_stage = mock.Mock()
+        assert parallel_pipeline([mock_stage], []) == []
+        mock_stage.assert_not_called()
+
+    def test_parallel_pipeline_fail(self):
+        def stage0(item):
+            if item == 'a':
+                raise ValueError('a failed')
+        mock_stage1 = mock.Mock()
+        with pytest.raises(ParallelError) as error:
+            parallel_pipeline([stage0, mock_stage1], ['a', 'b'])
+        assert [item for item, _ in error.value.errors] == ['a']
+        mock_stage1.assert_called_once_with('b')
+
+
+class TestParallelMap:
+    def test_parallel_map(self):
+        result = parallel_map(lambda item: item * 2, [1, 2, 3], max_workers=2)
+        assert result == [2, 4, 6]
+
+
+class TestRollingPipeline:
+    def test_rolling_pipeline(self):
+        waves = []
+        result = rolling_pipeline([lambda item: waves.append(item) or item], ['a', 'b', 'c'], max_unavailable=2)
+        assert result == ['a', 'b', 'c']
+        assert set(waves[:2]) == {'a', 'b'}
+        assert waves[2] == 'c'
+
+    def test_rolling_pipeline_fail(self):
+        def stage(item):
+            if item == 'a':
+                raise ValueError('a failed')
+        mock_stage = mock.Mock(side_effect=stage)
+        with pytest.raises(ParallelError):
+            rolling_pipeline([mock_stage], ['a', 'b'])
+        mock_stage.assert_called_once_with('a')
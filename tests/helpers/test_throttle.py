@@ -0,0 +1,117 @@
+from threading import Thread
+import time
+from unittest import mock
+from unittest.mock import call
+
+import pytest
+
+from nephos.helpers.throttle import (BULK, DEFAULT, LIMITERS, LIMITS, PROBE, RateLimiter, ThrottledApi,
+                                     configure_limiters, get_limiter, print_throttle_metrics, throttle,
+                                     throttle_metrics)
+
+
+@pytest.fixture(autouse=True)
+def default_limiters():
+    configure_limiters()
+    yield
+    configure_limiters()
+
+
+class TestRateLimiter:
+    @mock.patch('nephos.helpers.throttle.time')
+    def test_acquire_burst(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        limiter = RateLimiter('a-backend', qps=1, burst=2)
+        assert limiter.acquire() == 0
+        assert limiter.acquire() == 0
+        assert limiter.tokens == 0
+        assert limiter.metrics() == {'default': {'requests': 2, 'throttled': 0.0}}
+
+    def test_acquire_wait(self):
+        limiter = RateLimiter('a-backend', qps=100, burst=1)
+        limiter.acquire()
+        waited = limiter.acquire(BULK)
+        assert waited > 0
+        assert limiter.metrics()['bulk']['requests'] == 1
+        assert limiter.metrics()['bulk']['throttled'] == round(waited, 3)
+
+    def test_acquire_unlimited(self):
+        limiter = RateLimiter('a-backend', qps=0, burst=1)
+        for _ in range(10):
+            assert limiter.acquire() < 0.1
+        assert limiter.metrics()['default']['requests'] == 10
+
+    def test_acquire_priority(self):
+        limiter = RateLimiter('a-backend', qps=4, burst=1)
+        limiter.acquire()
+        order = []
+
+        def acquire(priority, lane):
+            limiter.acquire(priority)
+            order.append(lane)
+
+        def wait_for(priority):
+            while not limiter.waiting[priority]:
+                time.sleep(0.001)
+
+        # A bulk request is already waiting when a probe arrives, but the probe goes first
+        bulk = Thread(target=acquire, args=(BULK, 'bulk'))
+        bulk.start()
+        wait_for(BULK)
+        probe = Thread(target=acquire, args=(PROBE, 'probe'))
+        probe.start()
+        bulk.join()
+        probe.join()
+        assert order == ['probe', 'bulk']
+
+
+class TestConfigureLimiters:
+    def test_configure_limiters(self):
+        configure_limiters({'k8s': {'qps': 5}, 'ca': {'qps': 1, 'burst': 2}})
+        assert LIMITS['k8s'] == (5, 100)
+        assert LIMITS['ca'] == (1, 2)
+        assert LIMITS['helm'] == (10, 20)
+
+    def test_get_limiter(self):
+        configure_limiters({'ca': {'qps': 1, 'burst': 2}})
+        limiter = get_limiter('ca:a-ca.example.com')
+        assert (limiter.qps, limiter.burst) == (1, 2)
+        assert get_limiter('ca:a-ca.example.com') is limiter
+        assert get_limiter('ca:another-ca.example.com') is not limiter
+
+    def test_configure_limiters_reset(self):
+        get_limiter('k8s')
+        configure_limiters()
+        assert LIMITERS == {}
+
+
+class TestThrottledApi:
+    def test_throttled_api(self):
+        mock_api = mock.Mock()
+        mock_api.read_namespaced_secret.return_value = 'a-secret'
+        api = ThrottledApi(mock_api)
+        with mock.patch('nephos.helpers.throttle.throttle') as mock_throttle:
+            assert api.read_namespaced_secret(name='a-secret', namespace='a-namespace') == 'a-secret'
+            api.create_namespaced_secret(namespace='a-namespace', body='a-body')
+        mock_throttle.assert_has_calls([call('k8s', DEFAULT), call('k8s', BULK)])
+        mock_api.create_namespaced_secret.assert_called_once_with(namespace='a-namespace', body='a-body')
+
+    def test_throttled_api_missing(self):
+        api = ThrottledApi(object())
+        assert not hasattr(api, 'read_namespaced_ingress')
+
+
+class TestThrottleMetrics:
+    def test_throttle_metrics(self):
+        throttle('helm')
+        throttle('k8s', PROBE)
+        assert throttle_metrics() == {
+            'helm': {'default': {'requests': 1, 'throttled': 0.0}},
+            'k8s': {'probe': {'requests': 1, 'throttled': 0.0}}
+        }
+
+    @mock.patch('nephos.helpers.throttle.print')
+    def test_print_throttle_metrics(self, mock_print):
+        throttle('helm')
+        print_throttle_metrics()
+        mock_print.assert_called_once_with('helm: default 1 requests (0.0s throttled)')
@@ -1,10 +1,35 @@
+import os
 from unittest import mock
 from unittest.mock import call
 
 import pytest
 from kubernetes.client.rest import ApiException
 
-from nephos.upgrade_v11x import extract_credentials, extract_crypto, upgrade_charts
+from nephos.helpers.parallel import ParallelError
+from nephos.upgrade_v11x import Checkpoint, extract_credentials, extract_crypto, upgrade_charts
+
+
+class TestCheckpoint:
+    def test_checkpoint(self):
+        checkpoint = Checkpoint()
+        assert not checkpoint.done('crypto', 'peer', 'peer0')
+        checkpoint.mark('crypto', 'peer', 'peer0')
+        checkpoint.mark('crypto', 'peer', 'peer0')
+        assert checkpoint.done('crypto', 'peer', 'peer0')
+        assert not checkpoint.done('crypto', 'orderer', 'peer0')
+        assert checkpoint.steps == {'peer/peer0': ['crypto']}
+
+    def test_checkpoint_file(self, tmpdir):
+        filename = str(tmpdir.join('upgrade_v11x.json'))
+        checkpoint = Checkpoint(filename)
+        assert checkpoint.steps == {}
+        checkpoint.mark('credentials', 'orderer', 'ord0')
+        checkpoint.mark('crypto', 'orderer', 'ord0')
+        # A new run resumes from the saved progress
+        resumed = Checkpoint(filename)
+        assert resumed.done('crypto', 'orderer', 'ord0')
+        assert resumed.steps == {'orderer/ord0': ['credentials', 'crypto']}
+        assert tmpdir.listdir() == [tmpdir.join('upgrade_v11x.json')]
 
 
 class TestExtractCredentials:
@@ -21,28 +46,34 @@ class TestExtractCredentials:
     @mock.patch('nephos.upgrade_v11x.secret_create')
     @mock.patch('nephos.upgrade_v11x.print')
     def test_extract_credentials(self, mock_print, mock_secret_create, mock_secret_read):
-        secret_data = [
-            {'CA_USERNAME': 'ord0', 'CA_PASSWORD': 'a-password'},
-            {'CA_USERNAME': 'ord1', 'CA_PASSWORD': 'a-password'}
-        ]
-        mock_secret_read.side_effect = [
-            ApiException,
-            secret_data[0],
-            ApiException,
-            secret_data[1]
-        ]
-        extract_credentials(self.OPTS, 'orderer')
+        secret_data = {
+            'ord0-hlf-ord': {'CA_USERNAME': 'ord0', 'CA_PASSWORD': 'a-password'},
+            'ord1-hlf-ord': {'CA_USERNAME': 'ord1', 'CA_PASSWORD': 'a-password'}
+        }
+
+        # Nodes are processed concurrently, so secrets are served by name rather than in order
+        def read(name, namespace):
+            if name not in secret_data:
+                raise ApiException
+            return secret_data[name]
+        mock_secret_read.side_effect = read
+        checkpoint = Checkpoint()
+        extract_credentials(self.OPTS, 'orderer', checkpoint=checkpoint)
         mock_secret_read.assert_has_calls([
             call('hlf--ord0-cred', 'ord-namespace'),
             call('ord0-hlf-ord', 'ord-namespace'),
             call('hlf--ord1-cred', 'ord-namespace'),
             call('ord1-hlf-ord', 'ord-namespace')
-        ])
+        ], any_order=True)
         mock_print.assert_not_called()
         mock_secret_create.assert_has_calls([
-            call(secret_data[0], 'hlf--ord0-cred', 'ord-namespace', verbose=False),
-            call(secret_data[1], 'hlf--ord1-cred', 'ord-namespace', verbose=False),
-        ])
+            call(secret_data['ord0-hlf-ord'], 'hlf--ord0-cred', 'ord-namespace',
+                 labels={'nephos/msp': 'ord_MSP', 'nephos/node': 'ord0', 'nephos/type': 'cred'}, verbose=False),
+            call(secret_data['ord1-hlf-ord'], 'hlf--ord1-cred', 'ord-namespace',
+                 labels={'nephos/msp': 'ord_MSP', 'nephos/node': 'ord1', 'nephos/type': 'cred'}, verbose=False),
+        ], any_order=True)
+        assert checkpoint.done('credentials', 'orderer', 'ord0')
+        assert checkpoint.done('credentials', 'orderer', 'ord1')
 
     @mock.patch('nephos.upgrade_v11x.secret_read')
     @mock.patch('nephos.upgrade_v11x.secret_create')
@@ -57,9 +88,37 @@ class TestExtractCredentials:
         mock_print.assert_has_calls([
             call('hlf--peer0-cred secret already exists'),
             call('hlf--peer1-cred secret already exists')
-        ])
+        ], any_order=True)
         mock_secret_create.assert_not_called()
 
+    @mock.patch('nephos.upgrade_v11x.secret_read')
+    @mock.patch('nephos.upgrade_v11x.secret_create')
+    @mock.patch('nephos.upgrade_v11x.print')
+    def test_extract_credentials_checkpoint(self, mock_print, mock_secret_create, mock_secret_read):
+        checkpoint = Checkpoint()
+        checkpoint.mark('credentials', 'peer', 'peer0')
+        mock_secret_read.side_effect = [None]
+        extract_credentials(self.OPTS, 'peer', checkpoint=checkpoint, verbose=True)
+        mock_secret_read.assert_called_once_with('hlf--peer1-cred', 'peer-namespace')
+        mock_print.assert_has_calls([
+            call('Skipping credentials of peer0, already done'),
+            call('hlf--peer1-cred secret already exists')
+        ], any_order=True)
+        mock_secret_create.assert_not_called()
+
+
+def fake_download(msp_files):
+    # Mimic Executer.download, writing the MSP files (in form {subfolder: [filenames]}) locally
+    def download(remote_path, local_dir):
+        msp_path = os.path.join(local_dir, 'msp')
+        for subfolder, filenames in msp_files.items():
+            os.makedirs(os.path.join(msp_path, subfolder))
+            for filename in filenames:
+                with open(os.path.join(msp_path, subfolder, filename), 'wb') as f:
+                    f.write(b'a-secret')
+        return msp_path
+    return download
+
 
 class TestExtractCrypto:
     OPTS = {
@@ -77,12 +136,8 @@ class TestExtractCrypto:
     @mock.patch('nephos.upgrade_v11x.get_pod')
     def test_extract_crypto(self, mock_get_pod, mock_print, mock_secret_create, mock_secret_read):
         mock_pod_ex = mock.Mock()
-        mock_pod_ex.execute.side_effect = [
-            '1', 'a-secret',  # signcerts
-            '1', 'a-secret',  # keystore
-            '1', 'a-secret',  # cacerts
-            '0'               # intermediatecerts
-        ]
+        mock_pod_ex.download.side_effect = fake_download({
+            'signcerts': ['cert.pem'], 'keystore': ['a_sk'], 'cacerts': ['ca.pem'], 'intermediatecerts': []})
         mock_get_pod.side_effect = [mock_pod_ex]
         mock_secret_read.side_effect = [ApiException, ApiException, ApiException, ApiException]
         extract_crypto(self.OPTS, 'orderer')
@@ -95,20 +150,18 @@ class TestExtractCrypto:
             call('hlf--ord0-cacert', 'ord-namespace'),
             call('hlf--ord0-caintcert', 'ord-namespace')
         ])
-        mock_pod_ex.execute.assert_has_calls([
-            call("bash -c 'ls /var/hyperledger/msp/signcerts' | wc -l"),
-            call("bash -c 'cat /var/hyperledger/msp/signcerts/*'"),
-            call("bash -c 'ls /var/hyperledger/msp/keystore' | wc -l"),
-            call("bash -c 'cat /var/hyperledger/msp/keystore/*'"),
-            call("bash -c 'ls /var/hyperledger/msp/cacerts' | wc -l"),
-            call("bash -c 'cat /var/hyperledger/msp/cacerts/*'"),
-            call("bash -c 'ls /var/hyperledger/msp/intermediatecerts' | wc -l")
-        ])
+        # A single transfer for the whole MSP
+        mock_pod_ex.download.assert_called_once()
+        assert mock_pod_ex.download.call_args[0][0] == '/var/hyperledger/msp'
+        mock_pod_ex.execute.assert_not_called()
         mock_print.assert_called_once_with('Wrong number of files in intermediatecerts directory')
         mock_secret_create.assert_has_calls([
-            call({'cert.pem': 'a-secret'}, 'hlf--ord0-idcert', 'ord-namespace', verbose=False),
-            call({'key.pem': 'a-secret'}, 'hlf--ord0-idkey', 'ord-namespace', verbose=False),
-            call({'cacert.pem': 'a-secret'}, 'hlf--ord0-cacert', 'ord-namespace', verbose=False)
+            call({'cert.pem': b'a-secret'}, 'hlf--ord0-idcert', 'ord-namespace',
+                 labels={'nephos/msp': 'ord_MSP', 'nephos/node': 'ord0', 'nephos/type': 'idcert'}, verbose=False),
+            call({'key.pem': b'a-secret'}, 'hlf--ord0-idkey', 'ord-namespace',
+                 labels={'nephos/msp': 'ord_MSP', 'nephos/node': 'ord0', 'nephos/type': 'idkey'}, verbose=False),
+            call({'cacert.pem': b'a-secret'}, 'hlf--ord0-cacert', 'ord-namespace',
+                 labels={'nephos/msp': 'ord_MSP', 'nephos/node': 'ord0', 'nephos/type': 'cacert'}, verbose=False)
         ])
 
     @mock.patch('nephos.upgrade_v11x.secret_read')
@@ -116,19 +169,14 @@ class TestExtractCrypto:
     @mock.patch('nephos.upgrade_v11x.print')
     @mock.patch('nephos.upgrade_v11x.get_pod')
     def test_extract_crypto_again(self, mock_get_pod, mock_print, mock_secret_create, mock_secret_read):
-        mock_pod_ex = mock.Mock()
-        mock_get_pod.side_effect = [mock_pod_ex]
         extract_crypto(self.OPTS, 'peer', verbose=True)
-        mock_get_pod.assert_has_calls([
-            call('peer-namespace', 'peer0', 'hlf-peer')
-        ])
+        mock_get_pod.assert_not_called()
         mock_secret_read.assert_has_calls([
             call('hlf--peer0-idcert', 'peer-namespace'),
             call('hlf--peer0-idkey', 'peer-namespace'),
             call('hlf--peer0-cacert', 'peer-namespace'),
             call('hlf--peer0-caintcert', 'peer-namespace')
         ])
-        mock_pod_ex.execute.assert_not_called()
         mock_print.assert_has_calls([
             call('hlf--peer0-idcert secret already exists'),
             call('hlf--peer0-idkey secret already exists'),
@@ -143,18 +191,18 @@ class TestExtractCrypto:
     @mock.patch('nephos.upgrade_v11x.get_pod')
     def test_extract_crypto_fail(self, mock_get_pod, mock_print, mock_secret_create, mock_secret_read):
         mock_pod_ex = mock.Mock()
-        mock_pod_ex.execute.side_effect = [
-            '0'  # signcerts
-        ]
+        mock_pod_ex.download.side_effect = fake_download({'signcerts': []})
         mock_get_pod.side_effect = [mock_pod_ex]
-        mock_secret_read.side_effect = [ApiException]
-        with pytest.raises(ValueError):
-            extract_crypto(self.OPTS, 'peer')
+        mock_secret_read.side_effect = [ApiException, None, None, None]
+        checkpoint = Checkpoint()
+        with pytest.raises(ParallelError) as error:
+            extract_crypto(self.OPTS, 'peer', checkpoint=checkpoint)
+        assert isinstance(error.value.errors[0][1], ValueError)
+        assert not checkpoint.done('crypto', 'peer', 'peer0')
         mock_get_pod.assert_has_calls([
             call('peer-namespace', 'peer0', 'hlf-peer')
         ])
-        mock_secret_read.assert_called_once_with('hlf--peer0-idcert', 'peer-namespace')
-        mock_pod_ex.execute.assert_called_once_with("bash -c 'ls /var/hyperledger/msp/signcerts' | wc -l")
+        mock_pod_ex.download.assert_called_once()
         mock_print.assert_not_called()
         mock_secret_create.assert_not_called()
 
@@ -180,7 +228,9 @@ class TestUpgradeCharts:
         mock_pod_ex = mock.Mock()
         mock_pod_ex.execute.side_effect = ['', None]
         mock_get_pod.side_effect = [mock_pod_ex]
-        upgrade_charts(self.OPTS, 'orderer')
+        checkpoint = Checkpoint()
+        upgrade_charts(self.OPTS, 'orderer', checkpoint=checkpoint)
+        assert checkpoint.done('upgrade', 'orderer', 'ord0')
         mock_pod_ex.execute.assert_has_calls([
             call('ls /var/hyperledger/msp_old'),
             call('mv /var/hyperledger/msp /var/hyperledger/msp_old')
@@ -210,3 +260,37 @@ class TestUpgradeCharts:
             'a-repo', 'hlf-peer', 'peer0', 'peer-namespace', config_yaml='./a_dir/hlf-peer/peer0.yaml', verbose=True)
         mock_check_ord.assert_not_called()
         mock_check_peer.assert_called_once_with('peer-namespace', 'peer0', verbose=True)
+
+    @mock.patch('nephos.upgrade_v11x.print')
+    @mock.patch('nephos.upgrade_v11x.helm_upgrade')
+    @mock.patch('nephos.upgrade_v11x.get_pod')
+    @mock.patch('nephos.upgrade_v11x.check_peer')
+    @mock.patch('nephos.upgrade_v11x.check_ord')
+    def test_upgrade_charts_checkpoint(self, mock_check_ord, mock_check_peer,
+                                       mock_get_pod, mock_helm_upgrade, mock_print):
+        checkpoint = Checkpoint()
+        checkpoint.mark('upgrade', 'peer', 'peer0')
+        upgrade_charts(self.OPTS, 'peer', checkpoint=checkpoint, verbose=True)
+        mock_get_pod.assert_not_called()
+        mock_helm_upgrade.assert_not_called()
+        mock_print.assert_called_once_with('Skipping upgrade of peer0, already done')
+        # A resumed upgrade does not read the pods of nodes it already upgraded
+        mock_check_peer.assert_not_called()
+
+    @mock.patch('nephos.upgrade_v11x.print')
+    @mock.patch('nephos.upgrade_v11x.helm_upgrade')
+    @mock.patch('nephos.upgrade_v11x.get_pod')
+    @mock.patch('nephos.upgrade_v11x.check_peer')
+    @mock.patch('nephos.upgrade_v11x.check_ord')
+    def test_upgrade_charts_rolling(self, mock_check_ord, mock_check_peer,
+                                    mock_get_pod, mock_helm_upgrade, mock_print):
+        opts = dict(self.OPTS, orderers={'names': ['ord0', 'ord1', 'ord2'], 'msp': 'ord_MSP', 'max_unavailable': 2})
+        mock_get_pod.return_value.execute.return_value = 'a-res'
+        mock_check_ord.side_effect = [None, ValueError, None]
+        checkpoint = Checkpoint()
+        with pytest.raises(ParallelError):
+            upgrade_charts(opts, 'orderer', checkpoint=checkpoint)
+        # The failed first wave stops the rollout before the third orderer is touched
+        assert mock_helm_upgrade.call_count == 2
+        assert mock_check_ord.call_count == 2
+        assert not checkpoint.done('upgrade', 'orderer', 'ord2')